@@ -0,0 +1,508 @@
+"""Latency percentiles per tier from the node logs.
+
+Every node process writes a matter.js log next to its code (root.log,
+vmb_level_1.log, vmb_level_2_<i>.log, multiendnode_<i>.log), and get_logs
+downloads them into the collect dir. This reads them in large chunks and runs
+one precompiled pattern over each chunk, so only the lines that matter reach
+Python:
+
+    subscribed  Subscription successfully initialized with ID ...
+    received    <node>.<endpoint>.measuredValue = ... (and temperature,
+                average10, average60), logged on every report the node gets
+    sent        ServerSubscription.#sendUpdate, logged on every report the
+                node sends upstream
+    south       South node <name> is node <id>, how a VMB logs which node ID
+                its reports from a child come under
+    error       ERROR/FATAL lines, Error ... messages and failed or timed out
+                subscriptions
+
+The events of every node are folded into mergeable log-linear histograms
+(the HdrHistogram layout, so histograms of nodes, tiers and runs just add):
+
+    latency          report sent upstream to its receipt on the parent, kept
+                     on the sending tier
+    subscribe        node start to every established subscription
+    report_interval  gap between two reports of the same attribute received
+    send_interval    gap between two reports sent upstream
+
+    python applog.py experiments/fanout/vmb-f4x8-e10-d300-r0
+    python applog.py <collect dir> --json applog.json
+
+Timestamps are the hosts' local time, read as UTC (what the testbed hosts
+run), and moved onto the root's clock with clock_offsets.json when it's there.
+Sends carry no identifier, so the latency pairs every send of a child with the
+first report its parent gets from it before the child's next send; the
+topology of the run (its topology.json) says which node is whose parent.
+"""
+
+import argparse
+import calendar
+import json
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from clocks import ClockOffsets
+from topology import Process, Topology, load_topology
+
+CHUNK_SIZE = 4 << 20
+SIGNIFICANT_DIGITS = 2
+# histograms count integer microseconds
+UNIT = 1e-6
+PERCENTILES = [50, 90, 99, 99.9]
+HISTOGRAMS = ["latency", "subscribe", "report_interval", "send_interval"]
+SUMMARY_FILE = "applog.json"
+TOPOLOGY_FILE = "topology.json"
+
+# matter.js colors the fields when started from a terminal (tmux)
+SGR = rb"(?:\x1b\[[0-9;]*m)*"
+TIME = rb"^" + SGR + rb"(?P<ts>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\.(?P<ms>\d{3}) "
+# <LEVEL> <facility> up to the message, the facility is padded on a terminal
+HEAD = rb"[A-Z]+ *" + SGR + rb" +" + SGR + rb"\S+ *" + SGR + rb" +" + SGR
+# the attribute updates logged on every report a node gets
+UPDATE = rb"(?P<key>[\w.-]+?\.(?:measuredValue|temperature|average10|average60)) = "
+EVENT = re.compile(
+    TIME
+    + rb"(?:(?P<failure>ERROR|FATAL) |"
+    + HEAD
+    + rb"(?:(?P<subscribed>Subscription successfully initialized)"
+    + rb"|(?P<sent>ServerSubscription\.#sendUpdate)"
+    + rb"|South node (?P<south>\S+) is node (?P<south_id>\d+)"
+    + rb"|"
+    + UPDATE
+    + rb"|(?P<error>Error\b|Sending update failed"
+    + rb"|Subscription \d+ (?:timed out|update failed))))",
+    re.M,
+)
+FIRST_LINE = re.compile(TIME, re.M)
+# vmb_level_2_3.log and vmb_level_1.log are level_2 and level_1
+LOG_NAME = re.compile(r"^(?:root|vmb_level_(?P<level>\d+)(?:_\d+)?|multiendnode_\d+)$")
+
+
+class Histogram:
+    """Log-linear histogram of non-negative integers, HdrHistogram style
+
+    Values below 2**bits are counted exactly, larger ones in buckets whose
+    width keeps the relative error under 10**-digits. Only used buckets are
+    kept, and two histograms with the same digits merge by adding counts.
+    """
+
+    def __init__(self, digits: int = SIGNIFICANT_DIGITS):
+        self.digits = digits
+        self.bits = (2 * 10**digits - 1).bit_length()
+        self.counts: dict[int, int] = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value: int) -> int:
+        shift = max(0, value.bit_length() - self.bits)
+        return (value >> shift) << shift
+
+    def width(self, bucket: int) -> int:
+        return 1 << max(0, bucket.bit_length() - self.bits)
+
+    def record(self, value: int, count: int = 1):
+        if value < 0:
+            raise ValueError(f"Can't record negative value {value}")
+        self.counts[self.bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def record_seconds(self, seconds: float):
+        self.record(max(0, round(seconds / UNIT)))
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        if other.digits != self.digits:
+            raise ValueError(
+                f"Can't merge histograms of {other.digits} and {self.digits} digits"
+            )
+        for bucket, count in other.counts.items():
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def percentile(self, p: float) -> float | None:
+        """Value below which p percent of the recorded values are"""
+        if not self.count:
+            return None
+        rank = max(1, round(p / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                middle = bucket + (self.width(bucket) - 1) / 2
+                return min(max(middle, self.min), self.max)
+        return self.max
+
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count else None
+
+    def to_dict(self) -> dict:
+        return {
+            "digits": self.digits,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "counts": {str(bucket): n for bucket, n in sorted(self.counts.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        histogram = cls(data["digits"])
+        histogram.counts.update({int(b): n for b, n in data["counts"].items()})
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min, histogram.max = data["min"], data["max"]
+        return histogram
+
+
+@dataclass
+class NodeLog:
+    """Events of one node process"""
+
+    host: str
+    name: str
+    tier: str
+    started: float | None = None
+    subscriptions: int = 0
+    received: int = 0
+    sent: int = 0
+    errors: int = 0
+    # unmatched sends, set once link_latencies paired them with the parent
+    lost: int | None = None
+    histograms: dict[str, Histogram] = field(
+        default_factory=lambda: {name: Histogram() for name in HISTOGRAMS}
+    )
+    # times within the window, for link_latencies
+    sent_times: list[float] = field(default_factory=list, repr=False)
+    # receive times by sender: a south name, or a node ID on a VMB
+    received_times: dict[str, list[float]] = field(
+        default_factory=lambda: defaultdict(list), repr=False
+    )
+    # south names by node ID
+    south: dict[str, str] = field(default_factory=dict, repr=False)
+
+    @property
+    def node(self) -> str:
+        return f"{self.host}/{self.name}"
+
+
+def log_tier(name: str) -> str | None:
+    """Tier of a node log by its file name (without .log)"""
+    match = LOG_NAME.match(name)
+    if match is None:
+        return None
+    if name == "root":
+        return "root"
+    if match["level"] is not None:
+        return f"level_{match['level']}"
+    return "endpoints"
+
+
+def read_chunks(path: str | Path, size: int = CHUNK_SIZE):
+    """Yield the file in chunks of whole lines"""
+    with open(path, "rb") as f:
+        rest = b""
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b"\n") + 1
+            if end == 0:
+                rest = data
+                continue
+            rest = data[end:]
+            yield data[:end]
+        if rest:
+            yield rest
+
+
+class Clock:
+    """Log timestamps to epoch seconds on the reference clock"""
+
+    def __init__(self, host: str, offsets: ClockOffsets | None):
+        self.host = host
+        self.offsets = offsets
+        self.seconds: dict[bytes, int] = {}
+
+    def __call__(self, ts: bytes, ms: bytes) -> float:
+        second = self.seconds.get(ts)
+        if second is None:
+            second = calendar.timegm(time.strptime(ts.decode(), "%Y-%m-%d %H:%M:%S"))
+            self.seconds[ts] = second
+        t = second + int(ms) / 1000
+        if self.offsets is not None:
+            t = self.offsets.to_reference(self.host, t)
+        return t
+
+
+def parse_log(
+    path: str | Path,
+    host: str,
+    offsets: ClockOffsets | None = None,
+    start: float | None = None,
+    end: float | None = None,
+) -> NodeLog:
+    """Fold one node log into a NodeLog
+
+    Reports and errors only count within [start, end), subscriptions always
+    do since they are made before a measurement window starts.
+    """
+    path = Path(path)
+    log = NodeLog(host, path.stem, log_tier(path.stem))
+    clock = Clock(host, offsets)
+    subscribe = log.histograms["subscribe"]
+    report_interval = log.histograms["report_interval"]
+    send_interval = log.histograms["send_interval"]
+    last_received: dict[bytes, float] = {}
+    last_sent = None
+
+    for chunk in read_chunks(path):
+        if log.started is None:
+            first = FIRST_LINE.search(chunk)
+            if first is not None:
+                log.started = clock(first["ts"], first["ms"])
+        for match in EVENT.finditer(chunk):
+            t = clock(match["ts"], match["ms"])
+            if match["subscribed"]:
+                log.subscriptions += 1
+                subscribe.record_seconds(t - (log.started or t))
+                continue
+            if match["south"]:
+                log.south[match["south_id"].decode()] = match["south"].decode()
+                continue
+            if (start is not None and t < start) or (end is not None and t >= end):
+                continue
+            if match["key"]:
+                log.received += 1
+                key = match["key"]
+                if key in last_received:
+                    report_interval.record_seconds(t - last_received[key])
+                last_received[key] = t
+                # <name>.temperature on the root, <node ID>.<endpoint>.<attribute>
+                # on a VMB
+                log.received_times[key.rsplit(b".", 1)[0].decode()].append(t)
+            elif match["sent"]:
+                log.sent += 1
+                log.sent_times.append(t)
+                if last_sent is not None:
+                    send_interval.record_seconds(t - last_sent)
+                last_sent = t
+            else:
+                log.errors += 1
+    return log
+
+
+def senders(log: NodeLog) -> dict[str, list[float]]:
+    """Receive times of a node by the south name of the sender"""
+    by_name = defaultdict(list)
+    for sender, times in log.received_times.items():
+        node_id = sender.split(".", 1)[0]
+        by_name[log.south.get(node_id, sender)].extend(times)
+    for times in by_name.values():
+        times.sort()
+    return by_name
+
+
+def pair_latencies(
+    sent: list[float], received: list[float], histogram: Histogram
+) -> int:
+    """Record every send up to the first receive before the next send
+
+    Returns the number of sends nothing was received for.
+    """
+    lost = 0
+    i = 0
+    for n, t in enumerate(sent):
+        following = sent[n + 1] if n + 1 < len(sent) else None
+        while i < len(received) and received[i] < t:
+            i += 1
+        if i < len(received) and (following is None or received[i] < following):
+            histogram.record_seconds(received[i] - t)
+            i += 1
+        else:
+            lost += 1
+    return lost
+
+
+def link_latencies(logs: list[NodeLog], topology: Topology):
+    """Pair the sends of every child with the receives of its parent
+
+    The latency lands on the child's log, so a tier's latency is that of the
+    hop above it.
+    """
+    by_process: dict[tuple[str, str], NodeLog] = {
+        (log.host, log.name): log for log in logs
+    }
+
+    def log_of(process: Process) -> NodeLog | None:
+        return by_process.get((process.host.split(".")[0], Path(process.log).stem))
+
+    processes = [process for stage in topology.startup_stages() for process in stage]
+    owner = {
+        id(instance): process for process in processes for instance in process.instances
+    }
+    received = {}
+    for process in processes:
+        parent = process.instances[0].parent
+        child, parent_log = log_of(process), None
+        if parent is not None:
+            parent_log = log_of(owner[id(parent)])
+        if child is None or parent_log is None:
+            continue
+        if id(parent_log) not in received:
+            received[id(parent_log)] = senders(parent_log)
+        times = sorted(
+            t
+            for instance in process.instances
+            for t in received[id(parent_log)].get(topology.name(instance), [])
+        )
+        child.lost = pair_latencies(
+            child.sent_times, times, child.histograms["latency"]
+        )
+
+
+def parse_collect_dir(
+    collect_dir: str | Path,
+    start: float | None = None,
+    end: float | None = None,
+    topology: Topology | None = None,
+) -> list[NodeLog]:
+    """Every node log in a collect dir (<host>/<node>.log)
+
+    The latencies need the topology of the run, by default its topology.json.
+    """
+    collect_dir = Path(collect_dir)
+    offsets = ClockOffsets.load(collect_dir)
+    logs = [
+        parse_log(path, path.parent.name, offsets, start, end)
+        for path in sorted(collect_dir.glob("*/*.log"))
+        if log_tier(path.stem) is not None
+    ]
+    if topology is None and (collect_dir / TOPOLOGY_FILE).exists():
+        topology = load_topology(collect_dir / TOPOLOGY_FILE)
+    if topology is not None:
+        link_latencies(logs, topology)
+    return logs
+
+
+def tier_histograms(logs: list[NodeLog]) -> dict[str, dict[str, Histogram]]:
+    """Histograms of every tier, merged over its nodes"""
+    tiers = {}
+    for log in logs:
+        merged = tiers.setdefault(log.tier, {name: Histogram() for name in HISTOGRAMS})
+        for name, histogram in log.histograms.items():
+            merged[name].merge(histogram)
+    return tiers
+
+
+def metrics(logs: list[NodeLog]) -> dict:
+    """Flat per-tier percentiles and counts, in milliseconds"""
+    result = {"app_errors": sum(log.errors for log in logs)}
+    for tier, histograms in tier_histograms(logs).items():
+        for name, histogram in histograms.items():
+            for p in (50, 99):
+                value = histogram.percentile(p)
+                if value is not None:
+                    result[f"{tier}_{name}_p{p}_ms"] = round(value * UNIT * 1000, 3)
+        result[f"{tier}_reports_received"] = sum(
+            log.received for log in logs if log.tier == tier
+        )
+        linked = [log for log in logs if log.tier == tier and log.lost is not None]
+        if linked:
+            result[f"{tier}_reports_lost"] = sum(log.lost for log in linked)
+    return result
+
+
+def to_dict(logs: list[NodeLog]) -> dict:
+    return {
+        "nodes": {
+            log.node: {
+                "tier": log.tier,
+                "started": log.started,
+                "subscriptions": log.subscriptions,
+                "received": log.received,
+                "sent": log.sent,
+                "errors": log.errors,
+                "lost": log.lost,
+            }
+            for log in logs
+        },
+        "tiers": {
+            tier: {name: histogram.to_dict() for name, histogram in histograms.items()}
+            for tier, histograms in tier_histograms(logs).items()
+        },
+    }
+
+
+def report(logs: list[NodeLog]) -> str:
+    lines = []
+    header = "".join(f"{f'p{p:g}':>10}" for p in PERCENTILES)
+    for tier, histograms in sorted(tier_histograms(logs).items()):
+        nodes = [log for log in logs if log.tier == tier]
+        linked = [log for log in nodes if log.lost is not None]
+        lost = f" ({sum(log.lost for log in linked)} lost)" if linked else ""
+        lines.append(
+            f"{tier}: {len(nodes)} nodes, "
+            f"{sum(log.subscriptions for log in nodes)} subscriptions, "
+            f"{sum(log.received for log in nodes)} reports received, "
+            f"{sum(log.sent for log in nodes)} sent{lost}, "
+            f"{sum(log.errors for log in nodes)} errors"
+        )
+        lines.append(f"  {'ms':<16}{'count':>8}{header}")
+        for name, histogram in histograms.items():
+            if not histogram.count:
+                continue
+            values = "".join(
+                f"{histogram.percentile(p) * UNIT * 1000:>10.1f}" for p in PERCENTILES
+            )
+            lines.append(f"  {name:<16}{histogram.count:>8}{values}")
+    noisy = sorted((log for log in logs if log.errors), key=lambda log: -log.errors)
+    if noisy:
+        lines.append("Errors:")
+        lines.extend(f"  {log.node:<40} {log.errors}" for log in noisy)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Latency percentiles per tier from the node logs"
+    )
+    parser.add_argument("collect_dir", help="Directory get_logs collected into")
+    parser.add_argument("--start", type=float, help="Window start (epoch seconds)")
+    parser.add_argument("--end", type=float, help="Window end (epoch seconds)")
+    parser.add_argument(
+        "-t",
+        "--topology",
+        help=f"Topology of the run, for the latencies (default: its {TOPOLOGY_FILE})",
+    )
+    parser.add_argument(
+        "--json",
+        nargs="?",
+        const=SUMMARY_FILE,
+        help=f"Also write the histograms as JSON (default name {SUMMARY_FILE})",
+    )
+    args = parser.parse_args()
+
+    topology = load_topology(args.topology) if args.topology else None
+    logs = parse_collect_dir(args.collect_dir, args.start, args.end, topology)
+    if not logs:
+        print(f"No node logs in {args.collect_dir}")
+        raise SystemExit(1)
+    print(report(logs))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(to_dict(logs), f, indent=1)
+        print(f"Wrote {args.json}")
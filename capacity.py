@@ -0,0 +1,535 @@
+"""Capacity planning for the VMB tree.
+
+Short calibration runs at increasing endpoint density go through the normal
+deploy path, as an experiment.py sweep that samples every node process. From
+the indexed results, CPU and memory per process are fitted as a linear
+function of the endpoints the process serves, for every role (endpoints,
+level_<n> VMBs, root). The plan is the densest tree that keeps every host
+within the CPU and memory headroom, written out as a topology file and the
+matching configs:
+
+    python capacity.py calibrate --endpoints 5,10,20,40
+    python capacity.py plan --cpu-headroom 0.3 --memory-headroom 0.2 --out capacity/
+"""
+
+import argparse
+import copy
+import json
+import math
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from provision import FACTS_FILE, load_cache
+from results import DEFAULT_STORE_DIR, ResultsStore
+from topology import (
+    DEFAULT_TOPOLOGY_FILE,
+    RESERVED_PORTS,
+    Instance,
+    Process,
+    Topology,
+    load_topology,
+    write_configs,
+)
+
+CALIBRATION_SWEEP = "capacity"
+DEFAULT_ENDPOINTS = [5, 10, 20, 40]
+# Bounds of the search, far beyond anything a calibration covers
+MAX_ENDPOINTS = 1000
+MAX_CONFIGS_PER_HOST = 8
+MAX_FANOUT = 64
+
+
+@dataclass
+class Fit:
+    """value = intercept + slope * load, least squares"""
+
+    intercept: float
+    slope: float
+    r2: float
+
+    def __call__(self, load: float) -> float:
+        return self.intercept + self.slope * load
+
+    def __add__(self, other: "Fit") -> "Fit":
+        return Fit(self.intercept + other.intercept, self.slope + other.slope, math.nan)
+
+    def scaled(self, factor: float) -> "Fit":
+        """The same fit over a load factor times smaller"""
+        return Fit(self.intercept, self.slope * factor, self.r2)
+
+    def max_load(self, budget: float) -> float:
+        """Largest load that stays within budget"""
+        if self.intercept > budget:
+            return 0.0
+        if self.slope <= 0:
+            return math.inf
+        return (budget - self.intercept) / self.slope
+
+
+def fit(loads: list[float], values: list[float]) -> Fit:
+    if len(set(loads)) < 2:
+        # a single density only tells the fixed cost
+        return Fit(float(np.mean(values)), 0.0, math.nan)
+    slope, intercept = np.polyfit(loads, values, 1)
+    predicted = intercept + slope * np.asarray(loads)
+    total = np.sum((np.asarray(values) - np.mean(values)) ** 2)
+    r2 = 1 - np.sum((np.asarray(values) - predicted) ** 2) / total if total else 1.0
+    return Fit(float(intercept), float(slope), float(r2))
+
+
+@dataclass
+class RoleModel:
+    role: str
+    # % of one core and resident KiB of one process
+    cpu: Fit
+    rss_kib: Fit
+    # largest load seen during calibration
+    calibrated: float
+
+
+@dataclass
+class Budget:
+    # % of one core, like top, summed over the host's processes
+    cpu: float
+    rss_kib: float
+
+    def per(self, processes: int) -> "Budget":
+        return Budget(self.cpu / processes, self.rss_kib / processes)
+
+
+def endpoints_below(instance: Instance) -> int:
+    if not instance.children:
+        return 1
+    return sum(endpoints_below(child) for child in instance.children)
+
+
+def process_role(topology: Topology, process: Process) -> str:
+    if process.level == 0:
+        return "root"
+    if process.level > topology.depth:
+        return "endpoints"
+    return f"level_{process.level}"
+
+
+def process_load(process: Process) -> int:
+    """Endpoints a node process serves, its own or those below it"""
+    return sum(endpoints_below(instance) for instance in process.instances)
+
+
+def role_loads(topology: Topology) -> dict[str, float]:
+    """Mean load of a process of every role"""
+    loads = {}
+    for stage in topology.startup_stages():
+        for process in stage:
+            loads.setdefault(process_role(topology, process), []).append(
+                process_load(process)
+            )
+    return {role: sum(values) / len(values) for role, values in loads.items()}
+
+
+def calibration_samples(store: ResultsStore, sweep: str) -> list[dict]:
+    """(role, load, cpu, rss_kib) of every role of every calibration run"""
+    samples = []
+    for run in store.runs(sweep=sweep, mode="vmb").itertuples():
+        if not run.topology or not run.metrics:
+            continue
+        topology = Topology(json.loads(run.topology))
+        metrics = json.loads(run.metrics)
+        for role, load in role_loads(topology).items():
+            if f"{role}_cpu_mean" in metrics:
+                samples.append(
+                    {
+                        "role": role,
+                        "load": load,
+                        "cpu": metrics[f"{role}_cpu_mean"],
+                        "rss_kib": metrics[f"{role}_rss_max_kib"],
+                        "endpoints": len(topology.levels[-1]),
+                        "root_bytes_per_s": metrics.get("root_bytes_per_s"),
+                    }
+                )
+    return samples
+
+
+def fit_models(samples: list[dict]) -> dict[str, RoleModel]:
+    models = {}
+    for role in dict.fromkeys(sample["role"] for sample in samples):
+        per_role = [sample for sample in samples if sample["role"] == role]
+        loads = [sample["load"] for sample in per_role]
+        models[role] = RoleModel(
+            role,
+            fit(loads, [sample["cpu"] for sample in per_role]),
+            fit(loads, [sample["rss_kib"] for sample in per_role]),
+            max(loads),
+        )
+    return models
+
+
+def fit_throughput(samples: list[dict]) -> Fit | None:
+    """Bytes per second into the root as a function of the total endpoints"""
+    points = {
+        (sample["endpoints"], sample["root_bytes_per_s"])
+        for sample in samples
+        if sample["role"] == "root" and sample["root_bytes_per_s"] is not None
+    }
+    if not points:
+        return None
+    endpoints, rates = zip(*sorted(points))
+    return fit(list(endpoints), list(rates))
+
+
+def host_fits(
+    topology: Topology, models: dict[str, RoleModel]
+) -> dict[str, tuple[Fit, Fit]]:
+    """CPU % and resident KiB of every host by the endpoints per config
+
+    Every process serves a fixed multiple of the endpoints per config, so the
+    usage of a host is linear in them too and one tree, built with a single
+    endpoint per config, covers every density.
+    """
+    usage = {server: (Fit(0.0, 0.0, math.nan),) * 2 for server in topology.servers}
+    for stage in topology.startup_stages():
+        for process in stage:
+            role = process_role(topology, process)
+            if role not in models:
+                raise ValueError(f"No calibration data for {role} processes")
+            share = process_load(process) / topology.endpoints_per_node
+            cpu, rss = usage[process.host]
+            usage[process.host] = (
+                cpu + models[role].cpu.scaled(share),
+                rss + models[role].rss_kib.scaled(share),
+            )
+    return usage
+
+
+def fits(load_fit: tuple[Fit, Fit], budget: Budget) -> float:
+    """Largest load for which both CPU and memory stay within budget"""
+    cpu, rss = load_fit
+    return min(cpu.max_load(budget.cpu), rss.max_load(budget.rss_kib))
+
+
+def placement_fits(spec: dict) -> bool:
+    """Whether every tier fits on its hosts, without building the topology"""
+    hosts = [host for host in spec["hosts"] if host != spec["root"]]
+    tiers = list(spec.get("tiers", []))
+    count = 1
+    for level, fanout in enumerate(spec["fanout"]):
+        count *= fanout
+        tier = tiers[level] if level < len(tiers) else {}
+        per_host = tier.get("instances_per_host")
+        if per_host and count > per_host * len(tier.get("hosts", hosts)):
+            return False
+    return True
+
+
+def leaf_spec(base: dict, configs: int, endpoints: int) -> dict:
+    """Base spec with this many configs per leaf host and endpoints per config"""
+    depth = len(base["fanout"])
+    spec = copy.deepcopy(base)
+    spec["endpoints_per_node"] = endpoints
+    tiers = [dict(tier) for tier in spec.get("tiers", [])]
+    tiers += [{} for _ in range(depth - len(tiers))]
+    tiers[depth - 1]["instances_per_host"] = configs
+    spec["tiers"] = tiers
+    return spec
+
+
+def widest_fanout(
+    spec: dict, models: dict[str, RoleModel], budget: Budget
+) -> list[int]:
+    """Fan-out a host of every tier can take, from the bottom up"""
+    depth = len(spec["fanout"])
+    tiers = spec["tiers"]
+    fanout = [1] * depth
+    load = spec["endpoints_per_node"]
+    for level in range(depth - 1, 0, -1):
+        model = models[f"level_{level}"]
+        per_host = tiers[level - 1].get("instances_per_host", 1)
+        limit = fits((model.cpu, model.rss_kib), budget.per(per_host))
+        fanout[level] = max(1, min(int(limit // load), MAX_FANOUT))
+        load *= fanout[level]
+    root = models["root"]
+    limit = fits((root.cpu, root.rss_kib), budget)
+    fanout[0] = max(1, min(int(limit // load), MAX_FANOUT))
+    return fanout
+
+
+def shape(
+    spec: dict, models: dict[str, RoleModel], shapes: dict
+) -> tuple[Topology, dict[str, tuple[Fit, Fit]]] | None:
+    """Tree of a spec with one endpoint per config and its host usage fits
+
+    None if the tree can't be placed. Only the fan-out and the leaf configs
+    per host tell trees of the same base apart, so shapes, keyed by those, is
+    shared by all the densities tried.
+    """
+    key = (tuple(spec["fanout"]), spec["tiers"][-1]["instances_per_host"])
+    if key not in shapes:
+        try:
+            topology = Topology({**spec, "endpoints_per_node": 1})
+        except ValueError:
+            shapes[key] = None
+        else:
+            shapes[key] = topology, host_fits(topology, models)
+    return shapes[key]
+
+
+def endpoint_ports_fit(tree: Topology, endpoints: int) -> bool:
+    """Whether the endpoint ports of a shape stay valid at this density
+
+    The endpoints take consecutive ports after the VMB tiers, which a large
+    tree can push over a reserved port or the top of the range.
+    """
+    low = tree.levels[-1][0].port
+    high = low + len(tree.levels[-1]) * endpoints - 1
+    if high > 65535 or any(low <= port <= high for port in RESERVED_PORTS):
+        return False
+    return all(
+        high < level[0].port or level[-1].port < low for level in tree.vmb_levels
+    )
+
+
+def fitting_tree(
+    base: dict,
+    models: dict[str, RoleModel],
+    budget: Budget,
+    configs: int,
+    endpoints: int,
+    shapes: dict | None = None,
+    floor: int = 0,
+) -> tuple[dict, Topology, dict[str, tuple[float, float]]] | None:
+    """Largest tree with this leaf density whose every host stays within budget
+
+    Every tier gets the fan-out a host of it can take, from the bottom up, and
+    the tree is then narrowed until it fits on the base hosts, or until it has
+    fewer than floor endpoints. Only a fitting tree is built in full.
+    """
+    depth = len(base["fanout"])
+    shapes = {} if shapes is None else shapes
+    spec = leaf_spec(base, configs, endpoints)
+    spec["fanout"] = widest_fanout(spec, models, budget)
+
+    while math.prod(spec["fanout"]) * endpoints >= floor:
+        tree = shape(spec, models, shapes) if placement_fits(spec) else None
+        if tree is not None and endpoint_ports_fit(tree[0], endpoints):
+            usage = {
+                server: (cpu(endpoints), rss(endpoints))
+                for server, (cpu, rss) in tree[1].items()
+            }
+            if all(
+                cpu <= budget.cpu and rss <= budget.rss_kib
+                for cpu, rss in usage.values()
+            ):
+                try:
+                    return spec, Topology(spec), usage
+                except ValueError:
+                    # endpoint_ports_fit only covers what a denser tree can break
+                    pass
+        # the widest tier gives way first, the top one on a tie
+        widest = max(range(depth), key=lambda i: spec["fanout"][i])
+        if spec["fanout"][widest] == 1:
+            return None
+        spec["fanout"][widest] -= 1
+    return None
+
+
+def recommend(
+    base: dict, models: dict[str, RoleModel], budget: Budget
+) -> tuple[dict, Topology, dict[str, tuple[float, float]]]:
+    """Tree with the most endpoints whose every host stays within budget
+
+    Leaf hosts run an endpoints process and a leaf VMB per config. For every
+    number of configs per leaf host, the densest config that fits and a few
+    lighter ones (hosts shared with upper tiers need room) are tried, densest
+    first, and no tree is narrowed below the endpoints of the best one so far.
+    """
+    depth = len(base["fanout"])
+    leaf = f"level_{depth}"
+    for role in ["root", "endpoints", *(f"level_{n}" for n in range(1, depth + 1))]:
+        if role not in models:
+            raise ValueError(f"No calibration data for {role} processes")
+
+    per_config = (
+        models["endpoints"].cpu + models[leaf].cpu,
+        models["endpoints"].rss_kib + models[leaf].rss_kib,
+    )
+    best = None
+    shapes = {}
+    for configs in range(1, MAX_CONFIGS_PER_HOST + 1):
+        densest = int(min(fits(per_config, budget.per(configs)), MAX_ENDPOINTS))
+        if densest < 1:
+            break
+        densities = {max(1, densest * n // 10) for n in range(10, 0, -1)}
+        for endpoints in sorted(densities, reverse=True):
+            floor = 0 if best is None else best[0][0]
+            tree = fitting_tree(base, models, budget, configs, endpoints, shapes, floor)
+            if tree is None:
+                continue
+            _, topology, _ = tree
+            # most endpoints, then the fewest hosts and processes
+            score = (
+                len(topology.levels[-1]),
+                -len(topology.servers),
+                -configs,
+            )
+            # going down in density, a tie goes to the lighter config
+            if best is None or score >= best[0]:
+                best = (score, tree)
+    if best is None:
+        raise ValueError("Not even the smallest tree fits on these hosts")
+    return best[1]
+
+
+def host_budget(
+    cores: float | None,
+    memory_mib: float | None,
+    cpu_headroom: float,
+    memory_headroom: float,
+) -> Budget:
+    """Budget of one host, from the flags or the smallest host in the facts cache"""
+    facts = [f for f in load_cache(FACTS_FILE).values() if f.get("cpus")]
+    if cores is None:
+        if not facts:
+            raise ValueError("No host facts cached yet, pass --cores")
+        cores = min(f["cpus"] for f in facts)
+    if memory_mib is None:
+        if not facts:
+            raise ValueError("No host facts cached yet, pass --memory-mib")
+        memory_mib = min(f["mem_kib"] for f in facts) / 1024
+    return Budget(
+        cores * 100 * (1 - cpu_headroom), memory_mib * 1024 * (1 - memory_headroom)
+    )
+
+
+def report(
+    models: dict[str, RoleModel],
+    throughput: Fit | None,
+    budget: Budget,
+    spec: dict,
+    topology: Topology,
+    usage: dict[str, tuple[float, float]],
+) -> str:
+    lines = ["Per process model (load = endpoints served):"]
+    for role, model in models.items():
+        lines.append(
+            f"  {role:<10} cpu {model.cpu.intercept:6.2f} + {model.cpu.slope:.4f}/ep % "
+            f"(r2 {model.cpu.r2:.2f}), "
+            f"rss {model.rss_kib.intercept / 1024:6.1f} + "
+            f"{model.rss_kib.slope / 1024:.3f}/ep MiB (r2 {model.rss_kib.r2:.2f})"
+        )
+    leaf_tier = spec["tiers"][len(spec["fanout"]) - 1]
+    total = len(topology.levels[-1])
+    lines += [
+        "",
+        f"Budget per host: {budget.cpu:.0f}% CPU, {budget.rss_kib / 1024:.0f} MiB",
+        f"Recommended: {spec['endpoints_per_node']} endpoints per config, "
+        f"{leaf_tier['instances_per_host']} configs per leaf host, "
+        f"fan-out {','.join(str(n) for n in spec['fanout'])} "
+        f"({total} endpoints on {len(topology.servers)} hosts)",
+    ]
+    for role, load in role_loads(topology).items():
+        if load > 2 * models[role].calibrated:
+            lines.append(
+                f"  {role} serves {load:.0f} endpoints, calibrated up to "
+                f"{models[role].calibrated:.0f}: extrapolated, calibrate further"
+            )
+    busiest = max(usage, key=lambda server: usage[server][0] / budget.cpu)
+    cpu, rss = usage[busiest]
+    lines.append(
+        f"Busiest host {busiest}: {cpu:.0f}% CPU, {rss / 1024:.0f} MiB predicted"
+    )
+    if throughput is not None:
+        lines.append(f"Root ingress predicted at {throughput(total):.0f} B/s")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan endpoint density and fan-out")
+    parser.add_argument("--sweep", default=CALIBRATION_SWEEP)
+    parser.add_argument("--topology", default=str(DEFAULT_TOPOLOGY_FILE))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    calibrate = subparsers.add_parser(
+        "calibrate", help="Short runs at increasing endpoint density"
+    )
+    calibrate.add_argument(
+        "--endpoints",
+        default=",".join(str(n) for n in DEFAULT_ENDPOINTS),
+        help="Comma separated endpoints per config to calibrate at",
+    )
+    calibrate.add_argument(
+        "--fanout", nargs="*", help="Fan-outs to calibrate at, e.g. 4,8 2,4"
+    )
+    calibrate.add_argument("--warmup", type=int, default=30)
+    calibrate.add_argument("--duration", type=int, default=60)
+    calibrate.add_argument("-u", "--user", type=str, help="Username for SSH login")
+    calibrate.add_argument(
+        "-l", "--local", action="store_true", help="Calibrate on emulated hosts"
+    )
+
+    plan = subparsers.add_parser("plan", help="Fit the models and recommend a tree")
+    plan.add_argument("--store", default=DEFAULT_STORE_DIR)
+    plan.add_argument("--cores", type=float, help="CPUs per host (default: facts)")
+    plan.add_argument(
+        "--memory-mib", type=float, help="Memory per host (default: facts)"
+    )
+    plan.add_argument(
+        "--cpu-headroom", type=float, default=0.3, help="Fraction of CPU kept free"
+    )
+    plan.add_argument(
+        "--memory-headroom",
+        type=float,
+        default=0.2,
+        help="Fraction of memory kept free",
+    )
+    plan.add_argument("--out", help="Write the topology and its configs here")
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        # deploy reads the topology at import, which plan doesn't need
+        import experiment
+
+        sweep = {
+            "name": args.sweep,
+            "topology": args.topology,
+            "modes": ["vmb"],
+            "endpoints_per_node": [int(n) for n in args.endpoints.split(",")],
+            "warmup": args.warmup,
+            "duration": [args.duration],
+            "collect": "aggregate",
+            "capture": "headers",
+            "sample_processes": True,
+        }
+        if args.fanout:
+            sweep["fanout"] = [
+                [int(n) for n in fanout.split(",")] for fanout in args.fanout
+            ]
+        experiment.configure(sweep, args.user, args.local)
+        experiment.run_sweep(sweep, experiment.EXPERIMENTS_DIR)
+    else:
+        store = ResultsStore(args.store)
+        samples = calibration_samples(store, args.sweep)
+        store.close()
+        if not samples:
+            parser.error(
+                f"No per process samples in sweep '{args.sweep}', run calibrate first"
+            )
+        models = fit_models(samples)
+        try:
+            budget = host_budget(
+                args.cores, args.memory_mib, args.cpu_headroom, args.memory_headroom
+            )
+            spec, topology, usage = recommend(
+                load_topology(args.topology).spec, models, budget
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        print(report(models, fit_throughput(samples), budget, spec, topology, usage))
+        if args.out:
+            out = Path(args.out)
+            out.mkdir(parents=True, exist_ok=True)
+            with open(out / "topology.json", "w") as f:
+                json.dump(spec, f, indent=4)
+            write_configs(topology, out)
+            print(f"Topology and configs written to {out}")
@@ -0,0 +1,66 @@
+"""tcpdump capture profiles.
+
+A profile decides how much of a host's traffic is captured: only the UDP
+ports of the nodes it runs (derived from the topology), only the headers,
+and whether the capture is rotated into several files. pcap_aggregate.py,
+parse-pcap.py and results.py read rotated sets as one capture, and byte
+counts use the original frame length, so header-only captures measure the
+same traffic.
+"""
+
+from dataclasses import dataclass
+
+# Enough for SLL2 + IPv6 with a few extension headers + UDP
+HEADER_SNAPLEN = 128
+
+
+@dataclass
+class CaptureProfile:
+    # only the Matter/VMB ports of the host's role, instead of everything
+    filtered: bool = True
+    # bytes kept per packet, 0 for whole packets
+    snaplen: int = 0
+    # start a new file after this many MB (tcpdump -C) or seconds (-G)
+    rotate_mb: int | None = None
+    rotate_seconds: int | None = None
+
+
+PROFILES = {
+    "full": CaptureProfile(filtered=False),
+    "matter": CaptureProfile(),
+    "headers": CaptureProfile(snaplen=HEADER_SNAPLEN),
+    "rotating": CaptureProfile(snaplen=HEADER_SNAPLEN, rotate_mb=100),
+}
+
+
+def bpf_filter(ranges: list[tuple[int, int]]) -> str:
+    """BPF filter for UDP traffic from or to any of the port ranges"""
+    ports = [
+        f"port {low}" if low == high else f"portrange {low}-{high}"
+        for low, high in ranges
+    ]
+    return f"udp and ({' or '.join(ports)})"
+
+
+def tcpdump_command(
+    output_prefix: str, ranges: list[tuple[int, int]], profile: CaptureProfile
+) -> str:
+    """tcpdump invocation writing to <output_prefix>.pcap (or a rotated set)"""
+    output = f"{output_prefix}.pcap"
+    options = ["-i any", "-U"]
+    if profile.snaplen:
+        options.append(f"-s {profile.snaplen}")
+    if profile.rotate_seconds:
+        # -G needs a time in the file name, pcap_aggregate.capture_sets orders by it
+        output = f"{output_prefix}.%Y%m%d%H%M%S.pcap"
+        options.append(f"-G {profile.rotate_seconds}")
+    if profile.rotate_mb:
+        options.append(f"-C {profile.rotate_mb}")
+    if profile.rotate_seconds or profile.rotate_mb:
+        # tcpdump drops to its own user after the first file, which can't
+        # create the next ones in the server directory
+        options.append("-Z root")
+    options.append(f"-w {output}")
+    if profile.filtered and ranges:
+        options.append(f"'{bpf_filter(ranges)}'")
+    return f"tcpdump {' '.join(options)}"
@@ -0,0 +1,161 @@
+"""Clock offsets of the testbed hosts.
+
+pcap timestamps, the epoch column of the CPU logs and the epoch_ms of the
+results files all come from different VMs, so their clocks have to agree
+before per-host timelines can be merged. Offsets are measured NTP style over
+the deploy's SSH connections: a probe brackets a remote `date` between two
+local timestamps, the offset is the remote time minus the midpoint and is off
+by at most half the round trip. Out of a burst of probes the one with the
+shortest round trip is kept. A burst at deploy and one at collect give every
+host's drift.
+
+The samples are written as clock_offsets.json next to the collected files,
+and the analysis tools move every host's timestamps onto the root
+controller's clock:
+
+    python clocks.py experiments/fanout/vmb-f4x8-e10-d300-r0
+"""
+
+import json
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+CLOCK_FILE = "clock_offsets.json"
+PROBES = 8
+
+
+@dataclass
+class ClockSample:
+    # local time of the probe, and the host's clock minus ours, in seconds
+    t: float
+    offset: float
+    rtt: float
+
+
+def probe(conn) -> ClockSample:
+    start = time.time()
+    result = conn.run("date +%s.%N", hide=True, warn=True)
+    end = time.time()
+    try:
+        remote = float(result.stdout.strip())
+    except ValueError:
+        raise ValueError(f"Can't read the clock: {result.stdout.strip()!r}") from None
+    midpoint = (start + end) / 2
+    return ClockSample(midpoint, remote - midpoint, end - start)
+
+
+def burst(conn, probes: int = PROBES) -> ClockSample:
+    """The probe with the shortest round trip, which bounds the error best"""
+    return min((probe(conn) for _ in range(probes)), key=lambda sample: sample.rtt)
+
+
+def fit_drift(samples: list[ClockSample]) -> tuple[float, float, float]:
+    """(t0, offset at t0, drift in s/s) through a host's samples"""
+    t0 = samples[0].t
+    if len(samples) < 2:
+        return t0, samples[0].offset, 0.0
+    ts = [sample.t - t0 for sample in samples]
+    offsets = [sample.offset for sample in samples]
+    mean_t, mean_offset = sum(ts) / len(ts), sum(offsets) / len(offsets)
+    var = sum((t - mean_t) ** 2 for t in ts)
+    if var == 0:
+        return t0, mean_offset, 0.0
+    drift = sum((t - mean_t) * (o - mean_offset) for t, o in zip(ts, offsets)) / var
+    return t0, mean_offset - drift * mean_t, drift
+
+
+class ClockTracker:
+    """Clock samples of every host during a deploy, keyed by host name prefix"""
+
+    def __init__(self):
+        self.samples: dict[str, list[ClockSample]] = {}
+        self.lock = threading.Lock()
+
+    def sample(self, conn, server: str) -> ClockSample:
+        sample = burst(conn)
+        with self.lock:
+            self.samples.setdefault(server.split(".")[0], []).append(sample)
+        return sample
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def write(self, path: str | Path, reference: str):
+        """Write the samples and the fitted offset and drift of every host"""
+        with self.lock:
+            hosts = {}
+            for host, samples in self.samples.items():
+                t0, offset, drift = fit_drift(samples)
+                hosts[host] = {
+                    "t0": t0,
+                    "offset": offset,
+                    "drift_ppm": drift * 1e6,
+                    "error": min(sample.rtt for sample in samples) / 2,
+                    "samples": [asdict(sample) for sample in samples],
+                }
+            data = {"reference": reference.split(".")[0], "hosts": hosts}
+            path = Path(path)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=1)
+            tmp.replace(path)
+
+
+class ClockOffsets:
+    """Moves timestamps of any host onto the reference host's clock"""
+
+    def __init__(self, data: dict):
+        self.reference = data["reference"]
+        self.hosts = data["hosts"]
+
+    @classmethod
+    def load(cls, directory: str | Path) -> "ClockOffsets | None":
+        path = Path(directory) / CLOCK_FILE
+        if not path.exists():
+            return None
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def offset(self, host: str, t):
+        """Host clock minus the local clock at local time t (0 if never measured)"""
+        fit = self.hosts.get(host.split(".")[0])
+        if fit is None:
+            return 0.0
+        return fit["offset"] + fit["drift_ppm"] * 1e-6 * (t - fit["t0"])
+
+    def relative(self, host: str, t):
+        """Host clock minus the reference host's clock at local time t"""
+        return self.offset(host, t) - self.offset(self.reference, t)
+
+    def to_reference(self, host: str, t):
+        """Timestamps (a number, array or Series) of a host on the reference clock"""
+        return t - self.relative(host, t)
+
+    def local_to_reference(self, t):
+        """Times taken on the machine running deploy.py, on the reference clock"""
+        return t + self.offset(self.reference, t)
+
+    def summary(self) -> str:
+        lines = [f"Offsets against {self.reference}:"]
+        for host, fit in self.hosts.items():
+            lines.append(
+                f"  {host:<20} {self.relative(host, fit['t0']) * 1000:+9.2f} ms "
+                f"(+-{fit['error'] * 1000:.2f} ms, drift {fit['drift_ppm']:+.1f} ppm, "
+                f"{len(fit['samples'])} samples)"
+            )
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: python {sys.argv[0]} <collect dir>")
+        sys.exit(1)
+    offsets = ClockOffsets.load(sys.argv[1])
+    if offsets is None:
+        print(f"No {CLOCK_FILE} in {sys.argv[1]}")
+        sys.exit(1)
+    print(offsets.summary())
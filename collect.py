@@ -0,0 +1,252 @@
+"""Compressed, parallel and resumable download of captures and logs.
+
+Files are compressed on the remote side (zstd when both ends have it, gzip
+otherwise) into a staging folder, downloaded a few at a time and checked
+against a sha256 of the original. A partial download is resumed from where it
+stopped, and files that haven't changed since the last collection are skipped
+using a manifest kept next to the downloads.
+"""
+
+import gzip
+import hashlib
+import json
+import shlex
+import shutil
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Callable
+
+REMOTE_STAGING_DIR = ".cs525-collect"
+MANIFEST_FILE = ".collect_manifest.json"
+PARALLEL_FILES = 4
+CHUNK_SIZE = 1 << 20
+COMPRESSORS = {
+    "zstd": ("zstd -q -c -3", ".zst"),
+    "gzip": ("gzip -n -c -6", ".gz"),
+}
+
+
+def stat_remote(conn, patterns: list[str]) -> dict[str, tuple[int, int]]:
+    """Size and mtime of every remote file matching the globs, in one round-trip"""
+    result = conn.run(
+        f"stat -c '%n|%s|%Y' {' '.join(patterns)} 2>/dev/null", warn=True, hide=True
+    )
+    files = {}
+    for line in result.stdout.strip().splitlines():
+        name, size, mtime = line.rsplit("|", 2)
+        files[name] = (int(size), int(mtime))
+    return files
+
+
+def pick_compressor(conn) -> str:
+    if shutil.which("zstd") is None:
+        return "gzip"
+    result = conn.run("command -v zstd", warn=True, hide=True)
+    return "zstd" if not result.failed else "gzip"
+
+
+def _load_manifest(path: Path) -> dict:
+    if path.exists():
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def _staged_name(remote: str, size: int, mtime: int, suffix: str) -> str:
+    # size and mtime in the name let an interrupted collection reuse the file
+    return f"{PurePosixPath(remote).name}.{size}.{mtime}{suffix}"
+
+
+def _stage(conn, files: dict[str, tuple[int, int]], compressor: str) -> dict:
+    """Compress and checksum all files on the remote side in parallel"""
+    command, suffix = COMPRESSORS[compressor]
+    jobs = []
+    for remote, (size, mtime) in files.items():
+        staged = f"{REMOTE_STAGING_DIR}/{_staged_name(remote, size, mtime, suffix)}"
+        src = shlex.quote(remote)
+        jobs.append(
+            f"( [ -f {staged} ] || {{ {command} {src} > {staged}.tmp && mv {staged}.tmp {staged}; }}; "
+            f"[ -s {staged}.sha256 ] || {{ sha256sum {src} | cut -d' ' -f1 > {staged}.sha256.tmp "
+            f"&& mv {staged}.sha256.tmp {staged}.sha256; }} ) &"
+        )
+    conn.run(
+        f"mkdir -p {REMOTE_STAGING_DIR}; {' '.join(jobs)} wait", warn=True, hide=True
+    )
+
+    staged = {}
+    for remote, (size, mtime) in files.items():
+        staged[remote] = (
+            f"{REMOTE_STAGING_DIR}/{_staged_name(remote, size, mtime, suffix)}"
+        )
+    names = " ".join(staged.values())
+    result = conn.run(
+        f'for f in {names}; do echo "$f|$(stat -c %s $f)|$(cat $f.sha256)"; done',
+        warn=True,
+        hide=True,
+    )
+    info = {}
+    for line in result.stdout.strip().splitlines():
+        path, size, digest = line.split("|")
+        info[path] = (int(size) if size else -1, digest)
+    return {
+        remote: (path, *info.get(path, (-1, ""))) for remote, path in staged.items()
+    }
+
+
+def _download(conn, remote: str, part: Path, size: int):
+    """Download a remote file into part, resuming from its current length"""
+    offset = part.stat().st_size if part.exists() else 0
+    if offset > size:
+        part.unlink()
+        offset = 0
+    if offset == size:
+        return
+    if hasattr(conn, "client"):
+        # One SFTP channel per file, so several transfers share the SSH session
+        sftp = conn.client.open_sftp()
+        try:
+            with sftp.open(remote, "rb") as src, open(part, "ab") as dst:
+                src.seek(offset)
+                # prefetch reads from the current position up to file_size
+                src.prefetch(size)
+                while chunk := src.read(CHUNK_SIZE):
+                    dst.write(chunk)
+        finally:
+            sftp.close()
+    else:
+        conn.get(remote, str(part))
+
+
+def _decompress(part: Path, target: Path, compressor: str) -> str:
+    """Decompress a download into target and return the sha256 of the result"""
+    digest = hashlib.sha256()
+    tmp = target.with_name(target.name + ".tmp")
+    if compressor == "zstd":
+        proc = subprocess.Popen(
+            ["zstd", "-q", "-d", "-c", str(part)], stdout=subprocess.PIPE
+        )
+        src = proc.stdout
+    else:
+        proc = None
+        src = gzip.open(part, "rb")
+    with src, open(tmp, "wb") as dst:
+        while chunk := src.read(CHUNK_SIZE):
+            digest.update(chunk)
+            dst.write(chunk)
+    if proc is not None and proc.wait() != 0:
+        raise IOError(f"zstd failed to decompress {part}")
+    tmp.replace(target)
+    return digest.hexdigest()
+
+
+def aggregate_remote(conn, pcap_glob: str, min_port: int, max_port: int) -> str:
+    """Run pcap_aggregate.py next to the captures and return a glob of the tables"""
+    script = f"{REMOTE_STAGING_DIR}/pcap_aggregate.py"
+    tables = f"{REMOTE_STAGING_DIR}/tables"
+    conn.run(f"mkdir -p {tables}", hide=True)
+    conn.put(str(Path(__file__).parent / "pcap_aggregate.py"), script)
+    conn.run(
+        f"python3 {script} {pcap_glob} --min-port {min_port} --max-port {max_port} "
+        f"--out {tables}",
+        warn=True,
+        hide=True,
+    )
+    return f"{tables}/*.csv"
+
+
+def flatten_command(directory: str, suffix: str) -> str:
+    """Move <directory>/<name>/<file><suffix> up to <directory>/<name>.<file><suffix>
+
+    Per-process diagnostic dirs (heap snapshots, CPU profiles) are written by
+    root with mode 0600, so they're also made readable for the download.
+    """
+    script = (
+        f"cd {shlex.quote(directory)} 2>/dev/null || exit 0; "
+        f'for f in */*{suffix}; do [ -e "$f" ] || continue; '
+        'mv "$f" "${f%%/*}.${f##*/}"; done; '
+        f"chmod a+r *{suffix} 2>/dev/null; true"
+    )
+    return f"sh -c {shlex.quote(script)}"
+
+
+def collect_files(
+    conn,
+    patterns: list[str],
+    local_dir: str | Path,
+    update: Callable[[str], None] = lambda msg: None,
+) -> list[Path]:
+    """Collect every remote file matching the globs into local_dir"""
+    local_dir = Path(local_dir)
+    local_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = local_dir / MANIFEST_FILE
+    manifest = _load_manifest(manifest_path)
+
+    files = stat_remote(conn, patterns)
+    changed = {}
+    for remote, (size, mtime) in files.items():
+        known = manifest.get(remote)
+        target = local_dir / PurePosixPath(remote).name
+        if (
+            known
+            and known["size"] == size
+            and known["mtime"] == mtime
+            and target.exists()
+            and target.stat().st_size == size
+        ):
+            continue
+        changed[remote] = (size, mtime)
+    update(f"{len(changed)} / {len(files)} files changed since last collection")
+    if not changed:
+        return []
+
+    compressor = pick_compressor(conn)
+    update(f"Compressing {len(changed)} files with {compressor}")
+    staged = _stage(conn, changed, compressor)
+
+    def fetch(remote: str) -> Path | None:
+        staged_path, staged_size, digest = staged[remote]
+        target = local_dir / PurePosixPath(remote).name
+        part = local_dir / (PurePosixPath(staged_path).name + ".part")
+        if staged_size < 0 or not digest:
+            update(f"Failed to compress {remote}")
+            return None
+        update(f"Downloading {target.as_posix()}")
+        _download(conn, staged_path, part, staged_size)
+        try:
+            decompressed = _decompress(part, target, compressor)
+        except (OSError, EOFError, zlib.error) as e:
+            # A complete but corrupt part would otherwise be kept and skipped
+            part.unlink(missing_ok=True)
+            target.with_name(target.name + ".tmp").unlink(missing_ok=True)
+            update(f"Checksum failure for {target.as_posix()}: {e}")
+            return None
+        if decompressed != digest:
+            # Corrupt download: start over next time
+            part.unlink()
+            target.unlink()
+            update(f"Checksum mismatch for {target.as_posix()}")
+            return None
+        part.unlink()
+        return target
+
+    with ThreadPoolExecutor(max_workers=PARALLEL_FILES) as pool:
+        results = dict(zip(changed, pool.map(fetch, changed)))
+
+    done = [remote for remote, target in results.items() if target is not None]
+    for remote in done:
+        size, mtime = changed[remote]
+        manifest[remote] = {
+            "size": size,
+            "mtime": mtime,
+            "sha256": staged[remote][2],
+        }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    if done:
+        cleanup = " ".join(f"{staged[r][0]} {staged[r][0]}.sha256" for r in done)
+        conn.run(f"rm -f {cleanup}", warn=True, hide=True)
+    update(f"Downloaded {len(done)} / {len(changed)} files")
+    return [results[remote] for remote in done]
@@ -0,0 +1,315 @@
+"""Bounded-window V8 CPU profiles of the node processes, merged per role.
+
+Processes of the selected roles start with a small preload (NODE_OPTIONS
+--require) that opens an inspector session inside the process, profiles it
+for a window after a delay and writes CPU.<date>.<time>.<pid>.cpuprofile to a
+directory of its own, so the node keeps running. Collecting renames the
+profiles to <session>.CPU... and downloads them with the logs.
+
+The aggregator merges the profiles of every role (root, level_<n>, endpoints)
+across hosts into folded stacks, prints the functions with the most self and
+total time and draws a flamegraph per role. With --compare, the share of CPU
+of every function is compared against another collection, e.g. the baseline.
+
+    python cpuprof.py <collect dir>                         # top functions per role
+    python cpuprof.py <vmb collect dir> --compare <baseline collect dir>
+    python cpuprof.py <collect dir> --out flame --top 30    # also folded stacks and SVGs
+"""
+
+import argparse
+import hashlib
+import json
+import re
+from html import escape
+from pathlib import Path
+
+import numpy as np
+
+PROFILE_DIR = "cpuprofile"
+SUFFIX = ".cpuprofile"
+PRELOAD_FILE = "cpuprofile.cjs"
+DEFAULT_DELAY = 60
+DEFAULT_SECONDS = 60
+# microseconds between samples, node's --cpu-prof default
+SAMPLING_INTERVAL = 1000
+# only the node scripts, not npm or tsc started with the same environment
+SCRIPT_DIR = "dist/esm/"
+NAME = re.compile(
+    r"^(?P<session>.+)\.CPU\.(?P<date>\d{8})\.(?P<time>\d{6})\.(?P<pid>\d+)\.cpuprofile$"
+)
+IDLE = "(idle)"
+ROOT_FRAME = "(root)"
+
+PRELOAD = """\
+// Written by cpuprof.py: profiles this process for a window, then writes it out
+const fs = require("node:fs");
+const inspector = require("node:inspector");
+const path = require("node:path");
+
+const dir = process.env.CPU_PROFILE_DIR;
+const script = process.argv[1] || "";
+if (dir && script.includes(%(script_dir)s)) {
+    const session = new inspector.Session();
+    session.connect();
+    const post = (method, params) =>
+        new Promise((resolve, reject) =>
+            session.post(method, params, (err, result) => (err ? reject(err) : resolve(result))),
+        );
+    const stamp = () => new Date().toISOString().replace(/[-:]/g, "").replace("T", ".").slice(0, 15);
+    const seconds = Number(process.env.CPU_PROFILE_SECONDS || %(seconds)d);
+    setTimeout(async () => {
+        const name = `CPU.${stamp()}.${process.pid}.cpuprofile`;
+        await post("Profiler.enable");
+        await post("Profiler.setSamplingInterval", { interval: %(interval)d });
+        await post("Profiler.start");
+        setTimeout(async () => {
+            const { profile } = await post("Profiler.stop");
+            const file = path.join(dir, name);
+            fs.writeFileSync(`${file}.tmp`, JSON.stringify(profile));
+            fs.renameSync(`${file}.tmp`, file);
+            session.disconnect();
+        }, seconds * 1000).unref();
+    }, Number(process.env.CPU_PROFILE_DELAY || 0) * 1000).unref();
+}
+"""
+
+
+def preload_script() -> str:
+    return PRELOAD % {
+        "script_dir": json.dumps(SCRIPT_DIR),
+        "seconds": DEFAULT_SECONDS,
+        "interval": SAMPLING_INTERVAL,
+    }
+
+
+def node_options(preload: str) -> str:
+    """NODE_OPTIONS loading the profiler preload"""
+    return f"--require {preload}"
+
+
+def environment(profile_dir: str, delay: int, seconds: int) -> str:
+    """Variables telling the preload where and when to profile"""
+    return (
+        f"CPU_PROFILE_DIR={profile_dir} CPU_PROFILE_DELAY={delay} "
+        f"CPU_PROFILE_SECONDS={seconds}"
+    )
+
+
+def role(session: str) -> str:
+    """Role of a session: root, level_<n> or endpoints"""
+    if match := re.match(r"vmb_level_(\d+)", session):
+        return f"level_{match[1]}"
+    if session.startswith(("multiendnode", "endnodes")):
+        return "endpoints"
+    return session
+
+
+def frame(call_frame: dict) -> str:
+    """function (file:line), with the path cut to the package or module"""
+    name = call_frame["functionName"] or "(anonymous)"
+    url = call_frame["url"]
+    if not url:
+        return name
+    url = re.sub(r"^file://", "", url)
+    for marker in ("node_modules/", "packages/"):
+        if marker in url:
+            url = url.rsplit(marker, 1)[1]
+            break
+    return f"{name} ({url}:{call_frame['lineNumber'] + 1})"
+
+
+def folded(path: str | Path) -> dict[str, float]:
+    """Self time in microseconds of every stack of a profile, root first"""
+    with open(path, "r") as f:
+        profile = json.load(f)
+    nodes = profile["nodes"]
+    index = {node["id"]: i for i, node in enumerate(nodes)}
+    parent = [-1] * len(nodes)
+    for i, node in enumerate(nodes):
+        for child in node.get("children", []):
+            parent[index[child]] = i
+
+    samples = np.array([index[s] for s in profile.get("samples", [])], np.int64)
+    if not len(samples):
+        return {}
+    # a sample lasts until the next one
+    deltas = np.asarray(profile["timeDeltas"], np.float64)
+    durations = np.append(deltas[1:], np.median(deltas[1:]) if len(deltas) > 1 else 0)
+    self_time = np.bincount(samples, weights=durations.clip(0), minlength=len(nodes))
+
+    stacks, names = {}, [frame(node["callFrame"]) for node in nodes]
+    for i in np.nonzero(self_time)[0].tolist():
+        stack, j = [], i
+        while j >= 0:
+            if names[j] != ROOT_FRAME:
+                stack.append(names[j])
+            j = parent[j]
+        key = ";".join(reversed(stack))
+        stacks[key] = stacks.get(key, 0) + float(self_time[i])
+    return stacks
+
+
+def profiles(collect_dir: str | Path) -> dict[str, list[Path]]:
+    """Collected profiles of every role"""
+    found = {}
+    for path in sorted(Path(collect_dir).glob(f"*/*{SUFFIX}")):
+        match = NAME.match(path.name)
+        if match is not None:
+            found.setdefault(role(match["session"]), []).append(path)
+    return found
+
+
+def merge(paths: list[Path]) -> dict[str, float]:
+    merged = {}
+    for path in paths:
+        for stack, value in folded(path).items():
+            merged[stack] = merged.get(stack, 0) + value
+    return merged
+
+
+def busy(stacks: dict[str, float]) -> float:
+    """CPU time of the stacks, without idle"""
+    return sum(value for stack, value in stacks.items() if stack != IDLE)
+
+
+def top_functions(stacks: dict[str, float]) -> dict[str, list[float]]:
+    """function: [self time, total time], recursion counted once per stack"""
+    functions = {}
+    for stack, value in stacks.items():
+        if stack == IDLE:
+            continue
+        names = stack.split(";")
+        for name in set(names):
+            functions.setdefault(name, [0.0, 0.0])[1] += value
+        functions[names[-1]][0] += value
+    return functions
+
+
+def write_folded(stacks: dict[str, float], path: str | Path):
+    """Folded stacks in microseconds, as flamegraph.pl and speedscope read them"""
+    with open(path, "w") as f:
+        for stack, value in sorted(stacks.items()):
+            if stack != IDLE and round(value):
+                f.write(f"{stack} {round(value)}\n")
+
+
+def _color(name: str) -> str:
+    """Warm colour, the same for a function in every graph"""
+    digest = hashlib.md5(name.encode()).digest()
+    return f"rgb({205 + digest[0] % 50},{digest[1] % 200},{digest[2] % 55})"
+
+
+def flamegraph(stacks: dict[str, float], title: str, width: int = 1200) -> str:
+    """SVG flamegraph of folded stacks, root at the bottom"""
+    tree = {}
+    for stack, value in stacks.items():
+        if stack == IDLE:
+            continue
+        node = tree
+        for name in stack.split(";"):
+            entry = node.setdefault(name, [0.0, {}])
+            entry[0] += value
+            node = entry[1]
+    total = busy(stacks) or 1
+    row, pad, min_width = 16, 30, 0.5
+
+    def depth(node: dict) -> int:
+        return 1 + max((depth(children) for _, children in node.values()), default=0)
+
+    height = depth(tree) * row + 2 * pad
+    rects = []
+
+    def draw(node: dict, x: float, level: int):
+        for name, (value, children) in sorted(node.items()):
+            w = value / total * (width - 20)
+            if w >= min_width:
+                y = height - pad - (level + 1) * row
+                label = escape(f"{name} ({value / 1e3:.1f} ms, {value / total:.1%})")
+                text = escape(name[: int(w / 7)]) if w > 21 else ""
+                rects.append(
+                    f'<g><title>{label}</title><rect x="{10 + x:.1f}" y="{y}" '
+                    f'width="{w:.1f}" height="{row - 1}" fill="{_color(name)}"/>'
+                    f'<text x="{13 + x:.1f}" y="{y + row - 4}">{text}</text></g>'
+                )
+                draw(children, x, level + 1)
+            x += w
+
+    draw(tree, 0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        'font-family="monospace" font-size="11">\n'
+        f'<rect width="100%" height="100%" fill="#f8f8f8"/>\n'
+        f'<text x="{width / 2}" y="20" text-anchor="middle" font-size="15">'
+        f"{escape(title)}</text>\n" + "\n".join(rects) + "\n</svg>\n"
+    )
+
+
+def report(
+    collect_dir: str | Path,
+    top: int = 15,
+    out_dir: str | Path | None = None,
+    compare_dir: str | Path | None = None,
+) -> str:
+    found = profiles(collect_dir)
+    other = profiles(compare_dir) if compare_dir else {}
+    lines = []
+    for name, paths in found.items():
+        stacks = merge(paths)
+        total = busy(stacks)
+        seconds = sum(stacks.values())
+        lines.append(
+            f"{name}: {len(paths)} profiles, {total / 1e6:.1f} s CPU of "
+            f"{seconds / 1e6:.1f} s profiled ({total / (seconds or 1):.0%} busy)"
+        )
+        functions = top_functions(stacks)
+        by_self = sorted(functions.items(), key=lambda kv: -kv[1][0])
+        lines.append(f"  {'self':>7} {'total':>7}  function")
+        for function, (self_time, total_time) in by_self[:top]:
+            lines.append(
+                f"  {self_time / total:7.1%} {total_time / total:7.1%}  {function[:90]}"
+            )
+        if name in other:
+            theirs = merge(other[name])
+            their_total = busy(theirs) or 1
+            their_functions = top_functions(theirs)
+            shift = sorted(
+                (
+                    functions.get(f, [0, 0])[0] / total
+                    - their_functions.get(f, [0, 0])[0] / their_total,
+                    f,
+                )
+                for f in set(functions) | set(their_functions)
+            )
+            lines.append(
+                f"  vs {compare_dir}: {their_total / 1e6:.1f} s CPU over "
+                f"{len(other[name])} profiles, self time share change"
+            )
+            for change, function in shift[::-1][:top]:
+                if change <= 0:
+                    break
+                lines.append(f"  {change * 100:+6.1f} pp  {function[:90]}")
+            for change, function in shift[:top]:
+                if change >= 0:
+                    break
+                lines.append(f"  {change * 100:+6.1f} pp  {function[:90]}")
+        if out_dir:
+            out = Path(out_dir)
+            out.mkdir(parents=True, exist_ok=True)
+            write_folded(stacks, out / f"{name}.folded")
+            with open(out / f"{name}.svg", "w") as f:
+                f.write(flamegraph(stacks, f"{name}: {len(paths)} profiles"))
+    if out_dir and found:
+        lines.append(f"Folded stacks and flamegraphs in {Path(out_dir).resolve()}")
+    return "\n".join(lines) if lines else f"No CPU profiles in {collect_dir}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge collected V8 CPU profiles per role"
+    )
+    parser.add_argument("collect_dir", help="Directory get_logs collected into")
+    parser.add_argument("--top", type=int, default=15, help="Functions per table")
+    parser.add_argument("--out", help="Write <role>.folded and <role>.svg here")
+    parser.add_argument("--compare", help="Another collection, e.g. the baseline's")
+    args = parser.parse_args()
+    print(report(args.collect_dir, args.top, args.out, args.compare))
@@ -0,0 +1,110 @@
+"""One entry point for the testbed tools.
+
+    python cs525.py deploy --vmb            pull, build and start (deploy.py)
+    python cs525.py restart --vmb --local   restart the node processes
+    python cs525.py stop --vmb              stop them
+    python cs525.py collect --vmb --collect-dir run1
+                                            stop and download logs and captures
+    python cs525.py pcap baseline.pcap vmb.pcap
+    python cs525.py cpu baseline_cpu_usage.txt vmb_cpu_usage.txt
+    python cs525.py report run1             traffic, clocks and app latencies
+
+Everything after the command goes to the tool, so `python cs525.py deploy -h`
+lists the deploy options. Tools are only imported once their command runs:
+fabric, pyshark, pandas and matplotlib take seconds to load, a usage error
+here takes none of that.
+"""
+
+import argparse
+import csv
+import importlib
+import sys
+from pathlib import Path
+
+# command: (module, arguments put in front, help)
+COMMANDS = {
+    "deploy": ("deploy", [], "Pull, build and start the testbed"),
+    "restart": ("deploy", ["--restart"], "Restart the node processes"),
+    "stop": ("deploy", ["--kill"], "Stop the node processes"),
+    "collect": ("deploy", ["--get-logs"], "Stop and download logs and captures"),
+    "pcap": ("parse-pcap", [], "Plot baseline vs VMB traffic from two captures"),
+    "cpu": ("parse-cpu", [], "Plot baseline vs VMB CPU usage"),
+    "report": (__name__, [], "Summarize a collect dir"),
+}
+
+
+def traffic(collect_dir: Path) -> list[str]:
+    """Packets and bytes of every per-second table aggregated on the hosts"""
+    lines = []
+    for path in sorted(collect_dir.glob("*/*.per_second.csv")):
+        packets = total = 0
+        first = last = None
+        with open(path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                packets += int(row["packets"])
+                total += int(row["bytes_sent"])
+                t = float(row["timestamp"])
+                first = t if first is None else first
+                last = t
+        if first is None:
+            continue
+        seconds = last - first + 1
+        lines.append(
+            f"  {path.parent.name:<20} {packets:>10} packets {total:>14} bytes "
+            f"{total / seconds:>12.1f} B/s over {seconds:.0f}s"
+        )
+    return lines
+
+
+def main(argv: list[str] | None = None):
+    """report <collect dir>: traffic per host, clock offsets and app latencies"""
+    parser = argparse.ArgumentParser(
+        prog="cs525.py report", description="Summarize a collect dir"
+    )
+    parser.add_argument("collect_dir", help="Directory get_logs collected into")
+    parser.add_argument("--start", type=float, help="Window start (epoch seconds)")
+    parser.add_argument("--end", type=float, help="Window end (epoch seconds)")
+    args = parser.parse_args(argv)
+
+    from applog import parse_collect_dir
+    from applog import report as latency_report
+    from clocks import ClockOffsets
+
+    collect_dir = Path(args.collect_dir)
+    if not collect_dir.is_dir():
+        parser.error(f"{collect_dir} is not a directory")
+    lines = traffic(collect_dir)
+    if lines:
+        print("Traffic (aggregated captures):")
+        print("\n".join(lines))
+    offsets = ClockOffsets.load(collect_dir)
+    if offsets is not None:
+        print(offsets.summary())
+    logs = parse_collect_dir(collect_dir, args.start, args.end)
+    if logs:
+        print(latency_report(logs))
+    if not (lines or offsets or logs):
+        print(f"Nothing to report in {collect_dir}")
+
+
+def run(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="cs525.py",
+        description="Deploy and analyze the Matter testbed",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n"
+        + "\n".join(f"  {name:<10}{help}" for name, (_, _, help) in COMMANDS.items()),
+    )
+    parser.add_argument("command", choices=list(COMMANDS), metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    module, prefix, _ = COMMANDS[args.command]
+    tool = sys.modules[__name__] if module == __name__ else None
+    if tool is None:
+        tool = importlib.import_module(module)
+    tool.main(prefix + args.args)
+
+
+if __name__ == "__main__":
+    run()
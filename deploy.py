@@ -5,15 +5,47 @@ import json
 import logging
 import os
 import re
+import shlex
 import threading
+import weakref
+from collections import deque
 from fabric import Connection, Config
 from invoke.watchers import StreamWatcher
 from queue import Queue
 
-from getpass import getpass
+from getpass import getpass, getuser
 from pathlib import Path, PurePosixPath
-from time import sleep
+from time import sleep, time
 from dotenv import load_dotenv
+from capture import PROFILES, tcpdump_command
+from clocks import CLOCK_FILE, ClockTracker
+from collect import aggregate_remote, collect_files, flatten_command
+import cpuprof
+from emulation import NamespaceConnection, emulated_topology, setup_hosts
+import heapsnap
+import netem
+from livemetrics import LiveMetrics, sampler_command
+from provision import FACTS_FILE, batch, gather_facts, plan, save_facts
+from resilience import POLICIES, Policy, retry
+from sync import MANIFEST_FILE, SourceSync, needs_install
+from topology import (
+    BASELINE_PORT_RANGE,
+    DEFAULT_TOPOLOGY_FILE,
+    Process,
+    Topology,
+    load_topology,
+)
+from tracing import TracedConnection, Tracer, summary
+from warmstart import (
+    RECORD_FILE,
+    commissioned_command,
+    fingerprint,
+    recorded_generation,
+    restore_command,
+    save_command,
+    save_record,
+    snapshot_path,
+)
 
 
 class SnapshotQueue(Queue):
@@ -21,6 +53,17 @@ class SnapshotQueue(Queue):
         with self.mutex:
             return list(self.queue)
 
+    def _put(self, item):
+        super()._put(item)
+        # wake every waiter, not just one consumer
+        self.not_empty.notify_all()
+
+    def wait_for_more(self, seen: int, timeout: float):
+        """Block until more than seen items were put, or timeout"""
+        with self.not_empty:
+            if len(self.queue) <= seen:
+                self.not_empty.wait(timeout)
+
 
 load_dotenv()
 # logging.basicConfig(level=logging.DEBUG)
@@ -32,131 +75,162 @@ LOCAL_SERVER_DIR = "./"
 REMOTE_SERVER_DIR = f"{MP_DIR}/cs525-G25/"
 REMOTE_GROUP = "csvm525-stu"
 GIT_REPO = "https://github.com/eihart123/cs525-G25.git"
-# List of servers
-CONTROLLER_SERVER = "sp25-cs525-2501.cs.illinois.edu"
-LEVEL_1_VMB_SERVERS = [
-    "sp25-cs525-2502.cs.illinois.edu",
-    "sp25-cs525-2503.cs.illinois.edu",
-    "sp25-cs525-2504.cs.illinois.edu",
-    "sp25-cs525-2505.cs.illinois.edu",
-]
-
-SERVERS = [
-    "sp25-cs525-2501.cs.illinois.edu",
-    "sp25-cs525-2502.cs.illinois.edu",
-    "sp25-cs525-2503.cs.illinois.edu",
-    "sp25-cs525-2504.cs.illinois.edu",
-    "sp25-cs525-2505.cs.illinois.edu",
-    "sp25-cs525-2506.cs.illinois.edu",
-    "sp25-cs525-2507.cs.illinois.edu",
-    "sp25-cs525-2508.cs.illinois.edu",
-    "sp25-cs525-2509.cs.illinois.edu",
-    "sp25-cs525-2510.cs.illinois.edu",
-    "sp25-cs525-2511.cs.illinois.edu",
-    "sp25-cs525-2512.cs.illinois.edu",
-    "sp25-cs525-2513.cs.illinois.edu",
-    "sp25-cs525-2514.cs.illinois.edu",
-    "sp25-cs525-2515.cs.illinois.edu",
-    "sp25-cs525-2516.cs.illinois.edu",
-    "sp25-cs525-2517.cs.illinois.edu",
-    "sp25-cs525-2518.cs.illinois.edu",
-    "sp25-cs525-2519.cs.illinois.edu",
-    "sp25-cs525-2520.cs.illinois.edu",
-]
-
-
-ip_mappings = {
-    "sp25-cs525-2501.cs.illinois.edu": "fe80::250:56ff:fe8c:8777",
-    "sp25-cs525-2502.cs.illinois.edu": "fe80::250:56ff:fe8c:57da",
-    "sp25-cs525-2503.cs.illinois.edu": "fe80::250:56ff:fe8c:dc43",
-    "sp25-cs525-2504.cs.illinois.edu": "fe80::250:56ff:fe8c:34c3",
-    "sp25-cs525-2505.cs.illinois.edu": "fe80::250:56ff:fe8c:50b4",
-    "sp25-cs525-2506.cs.illinois.edu": "fe80::250:56ff:fe8c:bfd9",
-    "sp25-cs525-2507.cs.illinois.edu": "fe80::250:56ff:fe8c:69e1",
-    "sp25-cs525-2508.cs.illinois.edu": "fe80::250:56ff:fe8c:cc0b",
-    "sp25-cs525-2509.cs.illinois.edu": "fe80::250:56ff:fe8c:9744",
-    "sp25-cs525-2510.cs.illinois.edu": "fe80::250:56ff:fe8c:d55",
-    "sp25-cs525-2511.cs.illinois.edu": "fe80::250:56ff:fe8c:1ec1",
-    "sp25-cs525-2512.cs.illinois.edu": "fe80::250:56ff:fe8c:1814",
-    "sp25-cs525-2513.cs.illinois.edu": "fe80::250:56ff:fe8c:643e",
-    "sp25-cs525-2514.cs.illinois.edu": "fe80::250:56ff:fe8c:b863",
-    "sp25-cs525-2515.cs.illinois.edu": "fe80::250:56ff:fe8c:7b42",
-    "sp25-cs525-2516.cs.illinois.edu": "fe80::250:56ff:fe8c:6c49",
-    "sp25-cs525-2517.cs.illinois.edu": "fe80::250:56ff:fe8c:4ebd",
-    "sp25-cs525-2518.cs.illinois.edu": "fe80::250:56ff:fe8c:c3b8",
-    "sp25-cs525-2519.cs.illinois.edu": "fe80::250:56ff:fe8c:7915",
-    "sp25-cs525-2520.cs.illinois.edu": "fe80::250:56ff:fe8c:8ca6",
-}
-
+# Hosts, fan-out and port plan, see topology.py
+TOPOLOGY = load_topology(os.getenv("TOPOLOGY") or DEFAULT_TOPOLOGY_FILE)
+CONTROLLER_SERVER = ""
+LEVEL_1_VMB_SERVERS = []
+SERVERS = []
+ip_mappings = {}
 # Level 1 to level 2 mappings
-vmb_vmb_mappings = [
-    {
-        "sp25-cs525-2502.cs.illinois.edu": [
-            "sp25-cs525-2505.cs.illinois.edu",
-            "sp25-cs525-2506.cs.illinois.edu",
-            "sp25-cs525-2507.cs.illinois.edu",
-            "sp25-cs525-2508.cs.illinois.edu",
-        ]
-    },
-    {
-        "sp25-cs525-2503.cs.illinois.edu": [
-            "sp25-cs525-2509.cs.illinois.edu",
-            "sp25-cs525-2510.cs.illinois.edu",
-            "sp25-cs525-2511.cs.illinois.edu",
-            "sp25-cs525-2512.cs.illinois.edu",
-        ]
-    },
-    {
-        "sp25-cs525-2504.cs.illinois.edu": [
-            "sp25-cs525-2513.cs.illinois.edu",
-            "sp25-cs525-2514.cs.illinois.edu",
-            "sp25-cs525-2515.cs.illinois.edu",
-            "sp25-cs525-2516.cs.illinois.edu",
-        ]
-    },
-    {
-        "sp25-cs525-2505.cs.illinois.edu": [
-            "sp25-cs525-2517.cs.illinois.edu",
-            "sp25-cs525-2518.cs.illinois.edu",
-            "sp25-cs525-2519.cs.illinois.edu",
-            "sp25-cs525-2520.cs.illinois.edu",
-        ]
-    },
-]
-
-status = {server: {"msg": "Waiting"} for server in SERVERS}
+vmb_vmb_mappings = []
+
+
+def apply_topology(topology: Topology, keep_status: bool = False):
+    """Point the deploy globals at a (new) topology
+
+    keep_status keeps the status of hosts that are running already (and of
+    hosts no longer in the topology) when a spare is swapped in mid-deploy.
+    """
+    global TOPOLOGY, CONTROLLER_SERVER, LEVEL_1_VMB_SERVERS, SERVERS
+    global ip_mappings, vmb_vmb_mappings, status, started_warm
+    TOPOLOGY = topology
+    CONTROLLER_SERVER = topology.root
+    LEVEL_1_VMB_SERVERS = topology.tier_hosts(1)
+    SERVERS = topology.servers
+    ip_mappings = topology.hosts
+    vmb_vmb_mappings = topology.vmb_vmb_mappings()
+    if not keep_status:
+        status = {server: {"msg": "Waiting"} for server in SERVERS}
+        replaced.clear()
+        dropped.clear()
+        restored.clear()
+        started_warm = None
+        return
+    with mutex:
+        for server in SERVERS:
+            status.setdefault(server, {"msg": "Waiting"})
+            dirty.add(server)
+    status_changed.set()
+
+
+status = {}
 mutex = threading.Lock()
+# Servers whose status changed since the dashboard last drew them
+dirty = set()
+status_changed = threading.Event()
+# Lines of command output kept per server
+OUTPUT_LINES = 200
+OUTPUT_LINE_LIMIT = 1000
+# Hosts whose roles moved to a spare, and hosts left out by a quorum
+replaced = {}
+dropped = set()
+# Whether each host restored the topology's storage snapshot set, and whether
+# the deploy decided to start warm from it, see warmstart.py
+restored = {}
+started_warm = None
+apply_topology(TOPOLOGY)
+# Spans of every deploy phase and remote command, see tracing.py
+tracer = Tracer()
+TRACE_DIR = "traces"
+# Longest a remote command of each phase may run, in seconds
+PHASE_TIMEOUTS = {
+    "connect": 30,
+    "git pull": 300,
+    "git clone": 300,
+    "sync": 300,
+    "npm ci": 1200,
+    "build": 1200,
+    "tcpdump start": 30,
+    "node start": 30,
+}
+# Tries per command that fails for a transient reason (network, npm registry)
+RETRY_ATTEMPTS = 3
+# Clock offset of every host against this machine, see clocks.py
+clocks = ClockTracker()
+# CPU, memory and UDP traffic streamed from online hosts, see livemetrics.py
+live = LiveMetrics()
+live_metrics = False
+monitored = set()
 
 
 def update_status(server: str, new_status: str):
     """Helper function to update the status of a server"""
     with mutex:
         status[server]["msg"] = new_status
+        dirty.add(server)
         logger.debug(f"{server}: {new_status}")
+    status_changed.set()
+
+
+def set_output(server: str, output: str):
+    """Show a line of output (e.g. the command just started) for a server"""
+    append_output(server, [output], "")
+
+
+def append_output(server: str, lines: list[str], pending: str):
+    """Add complete output lines to a server's ring buffer"""
+    with mutex:
+        buffer = status[server].setdefault("lines", deque(maxlen=OUTPUT_LINES))
+        buffer.extend(lines)
+        last = pending or (buffer[-1] if buffer else "")
+        if last != status[server].get("output"):
+            status[server]["output"] = last
+            dirty.add(server)
+    status_changed.set()
+
+
+@tracer.phase("clock")
+def sample_clock(conn: Connection, server: str):
+    """Measure the server's clock offset against ours, see clocks.py"""
+    update_status(server, "Measuring clock offset")
+    try:
+        sample = clocks.sample(conn, server)
+    except ValueError:
+        update_status(server, "Failed to read the clock")
+        return
+    set_output(
+        server,
+        f"Clock offset {sample.offset * 1000:+.2f} ms (+-{sample.rtt * 500:.2f} ms)",
+    )
+
+
+def kill_command(name: str) -> str:
+    """Kill the processes called name in the network namespace of the shell
 
+    The emulated hosts share one PID namespace, so a plain killall would also
+    stop the processes of every other host.
+    """
+    return f"pkill --ns $$ --nslist net -x {name}"
 
+
+@tracer.phase("stop")
 def stop_server(conn: Connection, server: str):
     """Stop the server process on the remote server"""
     update_status(server, "Stopping")
-    # killall node
-    result = conn.sudo("killall node", warn=True)
+    result = conn.sudo(kill_command("node"), warn=True)
     if result.failed:
         # Try again for the bit
-        result = conn.sudo("killall node", warn=True)
+        result = conn.sudo(kill_command("node"), warn=True)
         if result.failed:
             update_status(server, "Failed to stop server")
             # return
 
-    result = conn.sudo("rm -rf ~/.matter", warn=True)
-    if result.failed:
-        update_status(server, "Failed to cached metadata")
-        # return
+    if not warm_start:
+        result = conn.sudo("rm -rf ~/.matter", warn=True)
+        if result.failed:
+            update_status(server, "Failed to cached metadata")
+            # return
 
-    result = conn.sudo("killall tcpdump", warn=True)
+    result = conn.sudo(kill_command("tcpdump"), warn=True)
     if result.failed:
         update_status(server, "Failed to stop tcpdump")
         # return
 
+    # whatever an earlier run left, even if this one has no impairments
+    result = conn.sudo(netem.clear_command(), warn=True, hide=True)
+    if result.failed:
+        update_status(server, "Failed to remove network impairments")
+
     result = conn.sudo("tmux kill-server", warn=True)
     if result.failed:
         update_status(server, "Failed to stop tmux")
@@ -193,272 +267,608 @@ def stop_server(conn: Connection, server: str):
     update_status(server, "Stopped")
 
 
+@tracer.phase("setup")
 def setup_server(conn: Connection, server: str, username: str):
+    """Provision only what the host's facts say is missing"""
+    if local:
+        # Emulated hosts are provisioned by emulation.setup_hosts
+        update_status(server, "Initializing")
+        return
+
+    update_status(server, "Gathering facts")
+    repo_dir = REMOTE_SERVER_DIR.rstrip("/")
+    facts = gather_facts(conn, MP_DIR, repo_dir)
     # Check that user logged in
-    result = conn.run("whoami", warn=True)
-    if result.failed or result.stdout.strip() != username:
+    if facts.get("user") != username:
         update_status(server, "Failed to login")
 
     update_status(server, "Initializing")
+    steps = plan(facts, MP_DIR, repo_dir, REMOTE_GROUP)
+    for sudo in [False, True]:
+        batched = [step for step in steps if step.sudo == sudo]
+        if not batched:
+            continue
+        update_status(server, ", ".join(step.name for step in batched).capitalize())
+        script = f"sh -c {shlex.quote(batch(batched))}"
+        result = conn.sudo(script, warn=True) if sudo else conn.run(script, warn=True)
+        if result.failed:
+            errors = result.stderr.strip().splitlines()
+            update_status(server, errors[-1] if errors else "Failed to provision")
+            return
 
-    # Install tmux
-    conn.run("git config --global --add safe.directory /opt/matter/cs525-G25")
-    result = conn.sudo("dnf install -y tmux", warn=True)
-    if result.failed:
-        update_status(server, "Failed to install tmux")
-        return
+    if steps:
+        facts = gather_facts(conn, MP_DIR, repo_dir)
+    save_facts(server, facts, Path(LOCAL_SERVER_DIR) / FACTS_FILE)
 
-    # result = conn.sudo(
-    #     f"dnf install -y wireshark && usermod -a -G wireshark {username}", warn=True
-    # )
-    # if result.failed:
-    #     update_status(server, "Failed to install wireshark")
-    #     pass
-    # Install node
-    # result = conn.sudo("dnf module install -y nodejs:20/common", warn=True)
-    # if result.failed:
-    #     update_status(server, "Failed to install node")
-    #     return
 
-    # Check if MP_DIR exists and create it if it doesn't
-    result = conn.run(f"test -d {MP_DIR}", warn=True)
-    if result.failed:
-        result = conn.sudo(f"mkdir -p {MP_DIR}", warn=True)
-        if result.failed:
-            update_status(server, f"Failed to create {MP_DIR}")
-            return
-        result = conn.sudo(f"chown root:{REMOTE_GROUP} {MP_DIR}", warn=True)
-        if result.failed:
-            update_status(server, f"Failed to change owner for {MP_DIR}")
-            return
-        result = conn.sudo(f"chmod 2775 {MP_DIR}", warn=True)
-        if result.failed:
-            update_status(server, f"Failed to change permissions for {MP_DIR}")
-            return
-        result = conn.sudo(f"setfacl -d -m g:{REMOTE_GROUP}:rwx {MP_DIR}", warn=True)
-        if result.failed:
-            update_status(server, f"Failed to set default group ACL for {MP_DIR}")
-            return
-        result = conn.sudo(f"setfacl -d -m o::0 {MP_DIR}", warn=True)
-        if result.failed:
-            update_status(server, f"Failed to set default other ACL for {MP_DIR}")
-            return
+def run_retrying(
+    conn: Connection, server: str, command: str, phase: str, sudo: bool = False
+):
+    """Run a phase's command with its timeout, retrying transient failures"""
+
+    def on_retry(attempt: int, reason: str, delay: float):
+        update_status(
+            server,
+            f"{phase}: {reason}, retry {attempt}/{RETRY_ATTEMPTS - 1} in {delay:.0f}s",
+        )
+
+    run = conn.sudo if sudo else conn.run
+    with tracer.span(server, phase):
+        return retry(
+            lambda: run(command, warn=True, timeout=PHASE_TIMEOUTS[phase]),
+            RETRY_ATTEMPTS,
+            on_retry,
+        )
 
 
-def build_server(conn: Connection, server: str):
+def build_server(conn: Connection, server: str, install: bool = True):
     """Build the server on the remote server"""
-    update_status(server, "Installing dependencies...")
-    result = conn.sudo(
-        f"/bin/sh -c 'cd {REMOTE_SERVER_DIR}/matter.js && npm ci'", warn=True
-    )
-    if result.failed:
-        update_status(server, "Failed to install dependencies")
-        return
+    if install:
+        update_status(server, "Installing dependencies...")
+        result = run_retrying(
+            conn,
+            server,
+            f"/bin/sh -c 'cd {REMOTE_SERVER_DIR}/matter.js && npm ci'",
+            "npm ci",
+            sudo=True,
+        )
+        if result.failed:
+            update_status(server, "Failed to install dependencies")
+            return
 
     update_status(server, "Building...")
-    result = conn.sudo(
-        f"/bin/sh -c 'cd {REMOTE_SERVER_DIR}/matter.js && npm run build'", warn=True
+    result = run_retrying(
+        conn,
+        server,
+        f"/bin/sh -c 'cd {REMOTE_SERVER_DIR}/matter.js && npm run build'",
+        "build",
+        sudo=True,
     )
     if result.failed:
         update_status(server, "Failed to build")
         return
 
 
-filter = ""
-
-
-def start_root_controller(
-    conn: Connection, server: str, with_vmb: bool, message_queue: SnapshotQueue
-):
-    """Start the root controller on the remote server"""
-    # update_status(server, f"{0} / {len(SERVERS) - 1} endnodes started")
-
-    # Use this like a semaphore: block until we have all the endnodes AND level 1 vmbs
-    if not not not with_vmb:  # :troll:
-        # pass
-        # while True:
-        #     items = message_queue.snapshot()
-        #     got += 1
-        #     if items[0]
-        #         break
-        # wait until we have (most) of the endnodes
-        update_status(server, "Waiting for endnodes")
-        while True:
-            items = message_queue.snapshot()
-            if len(items) >= 19:
-                break
-            sleep(1)
-        update_status(server, "Starting...")
-        sleep(5)
-
-    else:
-        while True:
-            items = message_queue.snapshot()
-            if len(items) >= 16:
-                update_status(server, f"{len(items) - 16} / {4} level 1 vmbs started")
-            elif len(items) <= 16:
-                update_status(server, f"{len(items)} / {16} endnodes started")
-
-            if len(items) >= 16 + 4:
-                break
-            sleep(1)
+# Which part of the traffic tcpdump keeps, see capture.py
+capture_profile = "matter"
+# Time given to processes that just started before their parents may start
+STAGE_SETTLE_SECONDS = 10
 
-    update_status(server, "Starting root controller")
-    dir = "cs525" if with_vmb else "cs525-baseline"
-    serverFile = "RootControllerNode.js" if with_vmb else "ControllerNode.js"
-    # These shouldn't run in the background, otherwise the session immediately exits
 
+@tracer.phase("tcpdump start")
+def start_tcpdump(conn: Connection, server: str) -> bool:
+    """Start capturing on the remote server in its own tmux session"""
     update_status(server, "Starting tcpdump")
-    dir = "cs525" if with_vmb else "cs525-baseline"
-    pcap_dump_file = f"tcpdump_{server.split('.')[0]}.pcap"
-    # filter = "'src portrange 5540-5560 or dst portrange 5540-5560'"
+    pcap_dump_prefix = f"{REMOTE_SERVER_DIR}/tcpdump_{server.split('.')[0]}"
+    ranges = TOPOLOGY.capture_ports(server) if with_vmb else [BASELINE_PORT_RANGE]
     # https://github.com/the-tcpdump-group/tcpdump/issues/485
-    cmd1 = f'tmux new-session -d -s tcpdump "tcpdump -i any -U -w {REMOTE_SERVER_DIR}/{pcap_dump_file} {filter}"'
+    tcpdump = tcpdump_command(pcap_dump_prefix, ranges, PROFILES[capture_profile])
+    cmd1 = f'tmux new-session -d -s tcpdump "{tcpdump}"'
     result = conn.sudo(
         cmd1,
         warn=True,
+        timeout=PHASE_TIMEOUTS["tcpdump start"],
     )
     if result.failed:
         update_status(server, "Failed to start tcpdump")
+        return False
+    return True
+
+
+def start_root_controller(
+    conn: Connection, server: str, with_vmb: bool, message_queue: SnapshotQueue
+):
+    """Start the baseline root controller on the remote server"""
+    assert with_vmb is False
+
+    # Use this like a semaphore: block until we have all the endnodes
+    update_status(server, "Waiting for endnodes")
+    wait_for_stage(server, 0, message_queue)
+    update_status(server, "Starting...")
+    with tracer.span(server, "settle"):
+        sleep(5)
+
+    update_status(server, "Starting root controller")
+    dir = "cs525-baseline"
+    serverFile = "ControllerNode.js"
+    # These shouldn't run in the background, otherwise the session immediately exits
+
+    if not start_tcpdump(conn, server):
         return
-    if with_vmb:
-        cmd2 = f"tmux new-session -d -s server 'bash {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/startup_root.sh'"
-    else:
-        cmd2 = f"tmux new-session -d -s server 'node {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/dist/esm/{serverFile} -- --storage-clear  2>&1 | tee {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/root.log'"
-    result = conn.sudo(
-        cmd2,
-        warn=True,
-    )
+    package_dir = f"{REMOTE_SERVER_DIR}/matter.js/packages/{dir}"
+    upload_profiler(conn, package_dir)
+    profiling = profiling_prefix(package_dir, "root", 0)
+    cmd2 = f"tmux new-session -d -s server '{profiling}node {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/dist/esm/{serverFile} -- --storage-clear  2>&1 | tee {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/root.log'"
+    with tracer.span(server, "node start"):
+        result = conn.sudo(
+            cmd2,
+            warn=True,
+            timeout=PHASE_TIMEOUTS["node start"],
+        )
     if result.failed:
         update_status(server, "Failed to start root controller")
         return
-    with mutex:
-        status[server]["output"] = cmd2
-    # update_status(server, "Waiting plz")
-    # sleep(20)
-
-    server_num = int(server.split(".")[0][-2:])
-    if not with_vmb:
-        message_queue.put(server_num)
+    set_output(server, cmd2)
 
     update_status(server, "Online")
 
 
-def start_level_1_vmb(
-    conn: Connection, server: str, with_vmb: bool, message_queue: SnapshotQueue
-):
-    """Start the root controller on the remote server"""
-    #
+def profiling_prefix(package_dir: str, name: str, level: int) -> str:
+    """Shell prefix starting a node process with the heap and CPU profilers
+
+    Each profiled process (or group of baseline processes) gets a directory
+    of its own, and the last run's files go.
+    """
+    setup, options, env = [], [], ""
+    for selected, directory, suffix in [
+        (level in heap_levels, heapsnap.HEAP_DIR, heapsnap.SUFFIX),
+        (level in cpu_levels, cpuprof.PROFILE_DIR, cpuprof.SUFFIX),
+    ]:
+        if selected:
+            path = f"{package_dir}/{directory}/{name}"
+            setup.append(f"rm -rf {path} {path}.*{suffix} && mkdir -p {path}")
+    if level in heap_levels:
+        options.append(
+            heapsnap.node_options(f"{package_dir}/{heapsnap.HEAP_DIR}/{name}")
+        )
+    if level in cpu_levels:
+        options.append(cpuprof.node_options(f"{package_dir}/{cpuprof.PRELOAD_FILE}"))
+        env = cpuprof.environment(
+            f"{package_dir}/{cpuprof.PROFILE_DIR}/{name}", cpu_delay, cpu_seconds
+        )
+    if not options:
+        return ""
+    return " && ".join(setup) + f' && NODE_OPTIONS="{" ".join(options)}" {env} '
 
-    assert with_vmb is True
 
-    # Use this like a semaphore: block until we have all the endnodes
-    while True:
-        items = message_queue.snapshot()
-        update_status(server, f"{len(items)} / {16} endnodes started")
-        if len(items) >= 16:
-            break
-        sleep(1)
-    # while msg_gotten < 16:
-    #     try:
-    #         server_gotten = message_queue.get(timeout=None)
-    #         msg_gotten += 1
-    #         update_status(server, f"{msg_gotten} / {len(SERVERS) - 1} endnodes started")
-    #         status[server]["output"] = "Last from" + server_gotten
-    #     except Exception as e:
-    #         raise e
+def upload_profiler(conn: Connection, package_dir: str):
+    """Put the CPU profiler preload next to the node scripts"""
+    if cpu_levels:
+        conn.put(
+            StringIO(cpuprof.preload_script()),
+            f"{package_dir}/{cpuprof.PRELOAD_FILE}",
+        )
 
-    update_status(server, "Starting tcpdump")
-    dir = "cs525"
-    pcap_dump_file = f"tcpdump_{server.split('.')[0]}.pcap"
-    # filter = "'src portrange 5540-5560 or dst portrange 5540-5560'"
-    # https://github.com/the-tcpdump-group/tcpdump/issues/485
-    cmd1 = f'tmux new-session -d -s tcpdump "tcpdump -i any -U -w {REMOTE_SERVER_DIR}/{pcap_dump_file} {filter}"'
-    result = conn.sudo(
-        cmd1,
-        warn=True,
+
+def process_command(
+    process: Process,
+    clear_storage: bool = True,
+    warm: bool = False,
+    reuse: list[str] = (),
+) -> str:
+    """tmux command that runs one node process of the topology
+
+    warm: reconnect to every south node in the storage, reuse: to these only
+    """
+    package_dir = f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525"
+    storage = " --storage-clear" if clear_storage else ""
+    if warm:
+        storage += " --warm-start"
+    elif reuse:
+        storage += f" --reuse-south {','.join(reuse)}"
+    profiling = profiling_prefix(package_dir, process.session, process.level)
+    return (
+        f"tmux new-session -d -s {process.session} "
+        f"'cd {package_dir} && {profiling}./dist/esm/{process.script} "
+        f"--configFile {process.config}{storage} > {process.log} 2>&1'"
     )
+
+
+def impair_network(conn: Connection, server: str) -> bool:
+    """Apply the run's netem profiles to the host's traffic, see netem.py"""
+    rules = netem.host_rules(
+        TOPOLOGY, server, impairments, None if with_vmb else BASELINE_PORT_RANGE
+    )
+    if not rules:
+        return True
+    update_status(server, "Impairing network")
+    # the trace keeps what every host was shaped with
+    described = [
+        f"{direction} {low}-{high}: {profile.args()}"
+        for profile, direction, (low, high) in rules
+    ]
+    with tracer.span(server, "impair network", rules=described):
+        result = conn.sudo(
+            netem.apply_command(TOPOLOGY.hosts[server], rules), warn=True, hide=True
+        )
     if result.failed:
-        update_status(server, "Failed to start tcpdump")
-        return
-    cmd2 = f"tmux new-session -d -s server 'bash {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/startup_level1_vmb.sh'"
+        update_status(server, "Failed to impair network")
+    return not result.failed
+
+
+def start_heap_snapshots(conn: Connection, server: str) -> bool:
+    """Signal the host's selected processes to snapshot their heap every interval"""
+    targets = [
+        (process.script, process.config)
+        for process in TOPOLOGY.processes_for(server)
+        if process.level in heap_levels
+    ]
+    if not targets:
+        return True
+    package_dir = f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525"
+    conn.put(
+        StringIO(heapsnap.trigger_script(targets, heap_interval)),
+        f"{package_dir}/heapsnap.sh",
+    )
+    # node runs as root, so does whatever signals it
     result = conn.sudo(
-        cmd2,
-        warn=True,
+        f"tmux new-session -d -s heapsnap 'sh {package_dir}/heapsnap.sh'", warn=True
     )
     if result.failed:
-        update_status(server, "Failed to start level 1 vmb")
-        return
+        update_status(server, "Failed to start heap snapshots")
+    return not result.failed
+
+
+@tracer.phase("restore storage")
+def restore_storage(conn: Connection, server: str) -> bool:
+    """Put the topology's last complete storage snapshot set back on a host"""
+    topology = fingerprint(TOPOLOGY)
+    generation = recorded_generation(topology, Path(LOCAL_SERVER_DIR) / RECORD_FILE)
+    ok = False
+    if generation is not None:
+        update_status(server, "Restoring storage snapshot")
+        path = snapshot_path(SNAPSHOT_DIR, topology, generation)
+        ok = not conn.sudo(restore_command(path), warn=True, hide=True).failed
     with mutex:
-        status[server]["output"] = cmd2
+        restored[server] = ok
+    return ok
+
+
+def starts_warm(server: str) -> bool:
+    """Whether the tree starts from its storage snapshots, decided once per deploy
+
+    Waits for every host to have tried restoring the set. One that failed,
+    or has no snapshot, makes every host start cold.
+    """
+    global started_warm
+    if not warm_start:
+        return False
+    waited = time()
+    with tracer.span(server, "wait", waits_on=[h for h in SERVERS if h != server]):
+        while started_warm is None:
+            hosts = [host for host in SERVERS if host not in dropped]
+            with mutex:
+                pending = [
+                    host
+                    for host in hosts
+                    if host not in restored
+                    and not any(f in status[host]["msg"] for f in FAILED_STATUSES)
+                ]
+                warm = all(restored.get(host, False) for host in hosts)
+            if not pending or time() - waited > policy.stage_timeout:
+                with policy_lock:
+                    if started_warm is None:
+                        started_warm = warm and not pending
+                break
+            update_status(
+                server, f"Waiting for {len(pending)} hosts to restore storage"
+            )
+            sleep(1)
+    return started_warm
 
-    update_status(server, "Waiting")
-    sleep(10)
 
-    server_num = int(server.split(".")[0][-2:])
-    message_queue.put(f"L1-{server_num}")
+def current_stages() -> list[list[Process]]:
+    return TOPOLOGY.startup_stages() if scope is None else TOPOLOGY.scoped_stages(scope)
+
+
+def stage_done(stage: int, message_queue: SnapshotQueue) -> set[str]:
+    """Hosts whose share of a startup stage is up
+
+    The baseline reports (stage, host) per host, the VMB hierarchy
+    (stage, host, session) per process.
+    """
+    snapshot = message_queue.snapshot()
+    if not with_vmb:
+        return {item[1] for item in snapshot if item[0] == stage}
+    ready = {item[1:] for item in snapshot}
+    pending = {p.host for p in current_stages()[stage] if p.key not in ready}
+    return {host for host in stage_hosts(stage) if host not in pending}
+
+
+def stage_hosts(stage: int) -> list[str]:
+    """Hosts a startup stage consists of, without those left out by the policy"""
+    if with_vmb:
+        hosts = dict.fromkeys(process.host for process in current_stages()[stage])
+    else:
+        # the baseline's only stage is its endnode hosts
+        hosts = [host for host in SERVERS if host != CONTROLLER_SERVER]
+    return [host for host in hosts if host not in dropped]
+
+
+def lost_hosts(hosts: list[str], waited: float) -> dict[str, str]:
+    """Hosts of a stage that can't be expected to come up in time, with why"""
+    stragglers = tracer.stragglers(policy.straggler_factor)
+    lost = {}
+    for host in hosts:
+        with mutex:
+            msg = status[host]["msg"]
+        if any(failed in msg for failed in FAILED_STATUSES):
+            lost[host] = "failed"
+        elif host in stragglers:
+            phase, elapsed, median = stragglers[host]
+            lost[host] = f"straggling in {phase} ({elapsed:.0f}s, median {median:.0f}s)"
+        elif waited > policy.stage_timeout:
+            lost[host] = f"not up after {waited:.0f}s"
+    return lost
+
+
+def substitute(host: str, message_queue: SnapshotQueue) -> str | None:
+    """Move every role of a lost host to a spare and deploy the spare
+
+    Returns the spare, or None when there is none left.
+    """
+    global threads
+    if host in replaced:
+        return replaced[host]
+    spares = TOPOLOGY.spares
+    if not spares:
+        return None
+    spare = next(iter(spares))
+    apply_topology(TOPOLOGY.with_host_replaced(host, spare), keep_status=True)
+    replaced[host] = spare
+    update_status(host, f"Replaced by {spare}")
+    threads += start_threads(deploy_action, message_queue, [spare])
+    return spare
+
+
+def apply_policy(
+    stage: int,
+    hosts: list[str],
+    done: set,
+    lost: dict[str, str],
+    message_queue: SnapshotQueue,
+):
+    """Decide what to do about the lost hosts of a stage, see resilience.py
+
+    Raises when the stage can't complete under the policy.
+    """
+    if policy.mode == "spare":
+        for host in list(lost):
+            if substitute(host, message_queue) is not None:
+                del lost[host]
+        # once the spares run out, the rest is handled like with quorum
+    # stragglers may still finish, failed and timed out hosts won't
+    stuck = {h: r for h, r in lost.items() if not r.startswith("straggling")}
+    if policy.mode == "wait":
+        if stuck:
+            host, reason = next(iter(stuck.items()))
+            raise RuntimeError(f"{host} {reason}, stage {stage} can't complete")
+        return
+    if not lost or len(lost) < len(hosts) - len(done):
+        # some hosts are still on their way, decide once they're in
+        return
+    if len(done) < policy.quorum_size(len(hosts)):
+        if len(stuck) == len(lost):
+            raise RuntimeError(
+                f"Only {len(done)} / {len(hosts)} stage {stage} hosts up, "
+                f"quorum is {policy.quorum_size(len(hosts))}"
+            )
+        return
+    dropped.update(lost)
+    for host, reason in lost.items():
+        update_status(host, f"Left out: {reason}")
+
+
+def wait_for_stage(server: str, stage: int, message_queue: SnapshotQueue):
+    """Block until every host in a startup stage has reported its processes
+
+    Hosts that fail, straggle or miss the stage timeout are dealt with by the
+    deploy policy: wait for them anyway, go on with a quorum, or use a spare.
+    """
+    label = "endnode hosts" if stage == 0 else f"stage {stage} hosts"
+    # filled in as the policy swaps hosts, so the span names who it waited for
+    waits_on = stage_hosts(stage)
+    previous = None
+    with tracer.span(server, "wait", waits_on=waits_on, stage=stage):
+        while True:
+            hosts = stage_hosts(stage)
+            if hosts != previous:
+                # a swapped in spare gets the full stage timeout
+                started, previous = time(), hosts
+                waits_on[:] = list(dict.fromkeys(waits_on + hosts))
+            done = stage_done(stage, message_queue) & set(hosts)
+            update_status(server, f"{len(done)} / {len(hosts)} {label} started")
+            missing = [host for host in hosts if host not in done]
+            if not missing:
+                break
+            lost = lost_hosts(missing, time() - started)
+            if lost:
+                with policy_lock:
+                    apply_policy(stage, hosts, done, lost, message_queue)
+            sleep(1)
+
+
+def wait_for_dependencies(
+    server: str, sessions: list[str], message_queue: SnapshotQueue
+) -> list[Process]:
+    """Block until some of a host's pending processes have all their children up
+
+    Returns those processes. Children on hosts the policy left out don't
+    count, and hosts that fail, straggle or time out are dealt with by the
+    policy of their startup stage, like in wait_for_stage.
+    """
+    waits_on = []
+    previous = None
+    with tracer.span(server, "wait", waits_on=waits_on):
+        while True:
+            snapshot = message_queue.snapshot()
+            ready = {item[1:] for item in snapshot}
+            # recomputed every time, a spare may have taken over a child's host
+            stages = current_stages()
+            stage_of = {p.key: i for i, stage in enumerate(stages) for p in stage}
+            processes = [p for stage in stages for p in stage]
+            graph = TOPOLOGY.startup_dependencies(processes)
+            pending = [
+                p for p in processes if p.host == server and p.session in sessions
+            ]
+            missing = {
+                p.key: {
+                    key
+                    for key in graph[p.key]
+                    if key not in ready and key[0] not in dropped
+                }
+                for p in pending
+            }
+            runnable = [p for p in pending if not missing[p.key]]
+            if runnable or not pending:
+                return runnable
+
+            blocking = set().union(*missing.values())
+            hosts = list(dict.fromkeys(h for h, _ in sorted(blocking)))
+            if hosts != previous:
+                # a swapped in spare gets the full stage timeout
+                started, previous = time(), hosts
+                waits_on[:] = list(dict.fromkeys(waits_on + hosts))
+            update_status(
+                server,
+                f"Waiting for {len(blocking)} child processes on {len(hosts)} hosts",
+            )
+            lost = lost_hosts([h for h in hosts if h != server], time() - started)
+            if lost:
+                with policy_lock:
+                    for stage in sorted(
+                        {stage_of[key] for key in blocking if key[0] in lost}
+                    ):
+                        stage_lost = {
+                            h: r for h, r in lost.items() if h in stage_hosts(stage)
+                        }
+                        apply_policy(
+                            stage,
+                            stage_hosts(stage),
+                            stage_done(stage, message_queue),
+                            stage_lost,
+                            message_queue,
+                        )
+            message_queue.wait_for_more(len(snapshot), 1)
+
+
+def start_vmb_processes(conn: Connection, server: str, message_queue: SnapshotQueue):
+    """Start this server's node processes as soon as their children are up
+
+    Endpoints have nothing to wait for, a VMB waits for the processes of its
+    own children only and the root for the level 1 VMBs, so a subtree comes
+    up without waiting for the rest of its tier. With a scope only its
+    processes are started, and tcpdump is left alone.
+    """
+    # every host captures, reduction.py needs the leaf hosts' side of the
+    # endpoint links too
+    capture = scope is None
+    capturing = False
+    # what the installed configs were made for
+    installed = (TOPOLOGY, frozenset(dropped))
+    warm = starts_warm(server)
+    upload_profiler(conn, f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525")
+    pending = [
+        process.session
+        for stage in current_stages()
+        for process in stage
+        if process.host == server
+    ]
+    while pending:
+        processes = wait_for_dependencies(server, pending, message_queue)
+        if not processes:
+            break
+
+        # A spare took over or hosts were left out while waiting, so the
+        # south lists have to point at the hosts that are actually up
+        if installed != (TOPOLOGY, frozenset(dropped)):
+            installed = (TOPOLOGY, frozenset(dropped))
+            install_config(conn, server)
+
+        if capture and not capturing:
+            if not start_tcpdump(conn, server):
+                return
+            capturing = True
+
+        stage_of = {p.key: i for i, stage in enumerate(current_stages()) for p in stage}
+        with tracer.span(server, "node start", level=processes[0].level):
+            for process in processes:
+                update_status(server, f"Starting {process.session}")
+                # The top of a scope keeps its storage, so that its parent,
+                # still running, reconnects instead of having to commission it.
+                # It pairs again with its children restarted in the scope.
+                top = scope is not None and TOPOLOGY.is_scope_top(process, scope)
+                cmd2 = process_command(
+                    process,
+                    clear_storage=not warm and not top,
+                    warm=warm,
+                    reuse=TOPOLOGY.running_children(process, scope) if top else [],
+                )
+                result = conn.sudo(
+                    cmd2,
+                    warn=True,
+                    timeout=PHASE_TIMEOUTS["node start"],
+                )
+                set_output(server, cmd2)
+                if result.failed:
+                    update_status(server, f"Failed to start {process.session}")
+                    return
+
+        # nothing waits for the root
+        if any(process.level > 0 for process in processes):
+            update_status(server, "Waiting some time so that it can start")
+            with tracer.span(server, "settle", level=processes[0].level):
+                sleep(STAGE_SETTLE_SECONDS)
+        for process in processes:
+            message_queue.put((stage_of[process.key], *process.key))
+            pending.remove(process.session)
+
+    # a scope leaves the running trigger alone
+    if heap_levels and scope is None:
+        start_heap_snapshots(conn, server)
     update_status(server, "Online")
 
 
 def startup_endnodes(
     conn: Connection, server: str, with_vmb: bool, message_queue: SnapshotQueue
 ):
-    """Start the endnodes on the remote server"""
-    # update_status(server, "Waiting for controlla")
-    # message_queue.get()
-    server_num = int(server.split(".")[0][-2:])
+    """Start the baseline endnodes on the remote server"""
+    assert with_vmb is False
 
-    with_vmb_sleep = [10, 10]
-    without_vmb_sleep = [0, 5]
-    sleep_time = with_vmb_sleep if with_vmb else without_vmb_sleep
+    sleep_time = [0, 5]
 
-    # server_num 2 should be the first end node
-    if not with_vmb:
-        pass
-        # update_status(server, f"Waiting for node {server_num - 1} to start")
-        # while True:
-        #     items = message_queue.snapshot()
-        #     if len(items) == 1:
-        #         # If the previous finished, kick off ours
-        #         if items[0] == server_num - 1:
-        #             _ = message_queue.get()
-        #             break
-        #     sleep(1)
-
-    update_status(server, "Starting tcpdump")
-    dir = "cs525" if with_vmb else "cs525-baseline"
-    startup_scripts = (
-        # endnodes need to start up *before* the level 2 vmbs
-        ["startup_endnodes.sh", "startup_level2_vmb.sh"]
-        if with_vmb
-        else [
-            "startup.sh",
-        ]
-    )
-    # we don't need tcpdump for the level 2/endnodes
-    if not with_vmb:
-        pcap_dump_file = f"tcpdump_{server.split('.')[0]}.pcap"
-        # filter = "'src portrange 5540-5560 or dst portrange 5540-5560'"
-        # https://github.com/the-tcpdump-group/tcpdump/issues/485
-        cmd1 = f'tmux new-session -d -s tcpdump "tcpdump -i any -U -w {REMOTE_SERVER_DIR}/{pcap_dump_file} {filter}"'
-        result = conn.sudo(
-            cmd1,
-            warn=True,
-        )
-        if result.failed:
-            update_status(server, "Failed to start tcpdump")
-            return
+    dir = "cs525-baseline"
+    startup_scripts = [
+        "startup.sh",
+    ]
+    if not start_tcpdump(conn, server):
+        return
 
     update_status(server, "Starting endnodes")
+    package_dir = f"{REMOTE_SERVER_DIR}/matter.js/packages/{dir}"
+    upload_profiler(conn, package_dir)
+    # the script's node processes share one directory
+    profiling = profiling_prefix(package_dir, "endnodes", TOPOLOGY.depth + 1)
     for i, script in enumerate(startup_scripts):
-        cmd2 = f"tmux new-session -d -s server{i} 'bash {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/{script}'"
-        result = conn.sudo(
-            cmd2,
-            warn=True,
-        )
+        cmd2 = f"tmux new-session -d -s server{i} '{profiling}bash {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/{script}'"
+        with tracer.span(server, "node start"):
+            result = conn.sudo(
+                cmd2,
+                warn=True,
+                timeout=PHASE_TIMEOUTS["node start"],
+            )
 
-        with mutex:
-            status[server]["output"] = cmd2
+        set_output(server, cmd2)
         if result.failed:
             update_status(server, f"Failed to start {script}")
             return
@@ -467,167 +877,59 @@ def startup_endnodes(
 
     update_status(server, "Waiting")
     # for giggles
-    sleep(sleep_time[1])
+    with tracer.span(server, "settle"):
+        sleep(sleep_time[1])
     update_status(server, "Online")
-    message_queue.put(server_num)
-    # if not with_vmb:
-    #     message_queue.put(server_num)
+    message_queue.put((0, server))
 
 
+@tracer.phase("install config")
 def install_config(conn: Connection, server: str):
-    """Install the config on the remote server"""
-
-    ip_mappings[server]
-    is_root = server == CONTROLLER_SERVER
-    is_level_1_vmb = server in LEVEL_1_VMB_SERVERS
-
-    if is_root:
-        root_config_file = "root_config.json"
-        root_config = []
-        for i, vmb_server in enumerate(LEVEL_1_VMB_SERVERS):
-            root_config.append(
-                {
-                    "name": f"level_1_vmb_{vmb_server}",
-                    "ip": ip_mappings[vmb_server],
-                    "port": 3100 + i,
-                }
-            )
-
-        root_config_file_io = StringIO()
-        json.dump({"south": root_config}, root_config_file_io, indent=4)
-
-        result = conn.put(
-            root_config_file_io,
-            f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{root_config_file}",
-        )
-        update_status(
-            server,
-            f"Installed config '{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{root_config_file}'",
-        )
-
-    if is_level_1_vmb:
-        my_own_port = 3100 + LEVEL_1_VMB_SERVERS.index(server)
-        level_2_vmb_port = 3200 + LEVEL_1_VMB_SERVERS.index(server) * 8
-
-        level1_config_file = "vmb_level_1_config.json"
-        level1_config = []
-        for vmb_server in vmb_vmb_mappings:
-            if server in vmb_server:
-                for i, level_2_vmb_server in enumerate(vmb_server[server]):
-                    level1_config.extend(
-                        [
-                            {
-                                "name": f"level_2_vmb_{level_2_vmb_server}_1",
-                                "ip": ip_mappings[level_2_vmb_server],
-                                "port": level_2_vmb_port + i * 2,
-                            },
-                            {
-                                "name": f"level_2_vmb_{level_2_vmb_server}_2",
-                                "ip": ip_mappings[level_2_vmb_server],
-                                "port": level_2_vmb_port + i * 2 + 1,
-                            },
-                        ]
-                    )
-                break
+    """Install the topology's config files on the remote server"""
+    package_dir = f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525"
+    # Drop configs left behind by a previous topology
+    conn.run(
+        f"rm -f {package_dir}/root_config.json {package_dir}/vmb_level_*_config*.json",
+        warn=True,
+    )
+    for config_file, config in TOPOLOGY.configs_for(server, dropped).items():
+        config_file_io = StringIO()
+        json.dump(config, config_file_io, indent=4)
 
-        level1_config_file_io = StringIO()
-        json.dump(
-            {
-                "north": {"ip": ip_mappings[server], "port": my_own_port},
-                "south": level1_config,
-            },
-            level1_config_file_io,
-            indent=4,
-        )
+        conn.put(config_file_io, f"{package_dir}/{config_file}")
+        update_status(server, f"Installed config '{package_dir}/{config_file}'")
 
-        result = conn.put(
-            level1_config_file_io,
-            f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{level1_config_file}",
-        )
-        update_status(
-            server,
-            f"Installed config '{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{level1_config_file}'",
-        )
 
-    server_num = int(server.split(".")[0][-2:])
-    if server_num >= 5:
-        # it's a level 2 vmb (1 is root, 2,3,4,5 are level 1 vmbs)
-        # node 5 runs both a level 1 and level 2 vmb
-        level2_config_file_1 = "vmb_level_2_config_1.json"
-        level2_config_file_2 = "vmb_level_2_config_2.json"
-        level2_config_1 = []
-        level2_config_2 = []
-        # We assume
-
-        server_num_0_idx = server_num - 5
-        # 2 vmbs per server, 10 nodes per vmb
-        port_start = 3300 + server_num_0_idx * 2 * 10
-        for i in range(10):
-            level2_config_1.append(
-                {
-                    "name": f"endpoint_{server}_1_{i}",
-                    "ip": ip_mappings[server],
-                    "port": port_start + i,
-                }
-            )
-            level2_config_2.append(
-                {
-                    "name": f"endpoint_{server}_2_{i}",
-                    "ip": ip_mappings[server],
-                    "port": port_start + i + 10,
-                }
-            )
+def stop_processes(conn: Connection, server: str, processes: list[Process]):
+    """Stop only the given node processes by their tmux sessions"""
+    update_status(server, f"Stopping {len(processes)} processes")
+    sessions = " ".join(process.session for process in processes)
+    result = conn.sudo(
+        f"for s in {sessions}; do tmux kill-session -t $s || true; done", warn=True
+    )
+    if result.failed:
+        update_status(server, "Failed to stop processes")
+        return
+    update_status(server, "Stopped")
 
-        update_status(server, "Installing config")
-        node_above = None
-        my_own_idx = None
-        for _, item in enumerate(vmb_vmb_mappings):
-            l1_server = list(item.keys())[0]
-            for i, level_2_vmb_server in enumerate(item[l1_server]):
-                if level_2_vmb_server == server:
-                    node_above = l1_server
-                    my_own_idx = i
-                    break
-
-        my_own_port = 3200 + LEVEL_1_VMB_SERVERS.index(node_above) * 8 + my_own_idx * 2
-
-        level2_config_file_1_io = StringIO()
-        json.dump(
-            {
-                "north": {"ip": ip_mappings[server], "port": my_own_port},
-                "south": level2_config_1,
-            },
-            level2_config_file_1_io,
-            indent=4,
-        )
 
-        level2_config_file_2_io = StringIO()
-        json.dump(
-            {
-                "north": {"ip": ip_mappings[server], "port": my_own_port + 1},
-                "south": level2_config_2,
-            },
-            level2_config_file_2_io,
-            indent=4,
-        )
+def scoped_servers() -> list[str]:
+    """Servers running anything in the scope, or every server without one"""
+    if scope is None:
+        return SERVERS
+    hosts = {
+        process.host for stage in TOPOLOGY.scoped_stages(scope) for process in stage
+    }
+    return [server for server in SERVERS if server in hosts]
 
-        result = conn.put(
-            level2_config_file_1_io,
-            f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{level2_config_file_1}",
-        )
-        update_status(
-            server,
-            f"Installed config '{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{level2_config_file_1}'",
-        )
 
-        result = conn.put(
-            level2_config_file_2_io,
-            f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{level2_config_file_2}",
-        )
-        update_status(
-            server,
-            f"Installed config '{REMOTE_SERVER_DIR}/matter.js/packages/cs525/{level2_config_file_2}'",
-        )
+def scoped_processes(server: str) -> list[Process]:
+    return [
+        process
+        for stage in TOPOLOGY.scoped_stages(scope)
+        for process in stage
+        if process.host == server
+    ]
 
 
 # def start_server(conn, server):
@@ -668,19 +970,25 @@ def ssh_connect_and_restart(
     message_queue: SnapshotQueue,
 ):
     """Connect to a server using SSH and restart the server"""
+    conn = None
     try:
         update_status(server, "Connecting")
 
-        # Establish SSH connection using Fabric
-        conn = Connection(
-            host=server,
-            user=username,
-            connect_kwargs={"password": password, "allow_agent": False},
-            config=make_config(server),
-        )
+        conn = connect(server, username, password)
+        sample_clock(conn, server)
+
+        if scope is not None:
+            # Leave the rest of the tree, its storage and tcpdump running
+            stop_processes(conn, server, scoped_processes(server))
+            start_vmb_processes(conn, server, message_queue=message_queue)
+            return
 
         setup_server(conn, server, username)
         stop_server(conn, server)
+        if warm_start and with_vmb:
+            restore_storage(conn, server)
+        if not impair_network(conn, server):
+            return
         # start_root_controller(conn, server, with_vmb=with_vmb)
         if not with_vmb:
             # install_config(conn, server)
@@ -693,29 +1001,17 @@ def ssh_connect_and_restart(
                     conn, server, with_vmb=with_vmb, message_queue=message_queue
                 )
         else:
-            # This code needs to be first
-            if is_level_2_vmb:
-                startup_endnodes(
-                    conn, server, with_vmb=with_vmb, message_queue=message_queue
-                )
-
-            if is_root:
-                # start the root controller
-                start_root_controller(
-                    conn, server, with_vmb=with_vmb, message_queue=message_queue
-                )
-
-            if is_level_1_vmb:
-                start_level_1_vmb(
-                    conn, server, with_vmb=with_vmb, message_queue=message_queue
-                )
+            install_config(conn, server)
+            # Every VMB as soon as its own children are up, root last
+            start_vmb_processes(conn, server, message_queue=message_queue)
 
         # start_server(conn, server)
 
     except Exception as e:
         update_status(server, f"Error: {str(e)}")
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
 
 def ssh_connect_and_get_logs(
@@ -731,56 +1027,194 @@ def ssh_connect_and_get_logs(
     """Connect to a server using SSH and get the logs"""
 
     server_prefix = server.split(".")[0]
+    conn = None
     try:
         update_status(server, "Connecting")
 
-        # Establish SSH connection using Fabric
-        conn = Connection(
-            host=server,
-            user=username,
-            connect_kwargs={"password": password, "allow_agent": False},
-            config=make_config(server),
-        )
+        conn = connect(server, username, password)
+        # a second sample, a while after the deploy's, gives the drift
+        sample_clock(conn, server)
 
-        # Get the logs
-        result = conn.run(f"ls {REMOTE_SERVER_DIR}/*.pcap", warn=True)
         stop_server(conn, server)
-        if not result.failed:
-            for pcap_file in result.stdout.strip().splitlines():
-                name = Path(pcap_file.strip()).name
-                local_path = Path(LOCAL_SERVER_DIR) / server_prefix / name
-                local_path.parent.mkdir(parents=True, exist_ok=True)
-                update_status(server, f"Downloading {local_path.as_posix()}")
-                conn.get(
-                    (Path(REMOTE_SERVER_DIR) / name).as_posix(), local_path.as_posix()
-                )
-                update_status(server, f"Downloaded {local_path.as_posix()}")
 
         # /opt/matter/cs525-G25/matter.js/packages/cs525
         dir = "cs525" if with_vmb else "cs525-baseline"
-        result = conn.run(
-            f"ls {REMOTE_SERVER_DIR}/matter.js/packages/{dir}/*.log", warn=True
-        )
-
-        if result.failed:
-            update_status(server, "Failed to get logs")
-            return
-
-        for log_file in result.stdout.strip().splitlines():
-            name = Path(log_file.strip()).name
-            local_path = Path(LOCAL_SERVER_DIR) / server_prefix / name
-            local_path.parent.mkdir(parents=True, exist_ok=True)
-            remote_path = (
-                Path(REMOTE_SERVER_DIR) / "matter.js" / "packages" / dir / name
+        patterns = [f"{REMOTE_SERVER_DIR}/matter.js/packages/{dir}/*.log"]
+        for directory, suffix in [
+            (heapsnap.HEAP_DIR, heapsnap.SUFFIX),
+            (cpuprof.PROFILE_DIR, cpuprof.SUFFIX),
+        ]:
+            path = f"{REMOTE_SERVER_DIR}/matter.js/packages/{dir}/{directory}"
+            conn.sudo(flatten_command(path, suffix), warn=True, hide=True)
+            patterns.append(f"{path}/*{suffix}")
+        if collect_mode in ["raw", "both"]:
+            # rotated captures continue in .pcap1, .pcap2, ...
+            patterns.append(f"{REMOTE_SERVER_DIR}/*.pcap*")
+        if collect_mode in ["aggregate", "both"]:
+            update_status(server, "Aggregating captures")
+            min_port, max_port = (
+                TOPOLOGY.port_range() if with_vmb else BASELINE_PORT_RANGE
             )
-            update_status(server, f"Downloading {remote_path.as_posix()}")
-            conn.get(remote_path.as_posix(), local_path.as_posix())
-            update_status(server, f"Downloaded {local_path.as_posix()}")
+            patterns.append(
+                aggregate_remote(
+                    conn, f"{REMOTE_SERVER_DIR}/*.pcap*", min_port, max_port
+                )
+            )
+        with tracer.span(server, "collect"):
+            collected = collect_files(
+                conn,
+                patterns,
+                Path(collect_dir) / server_prefix,
+                update=lambda msg: update_status(server, msg),
+            )
+        # rewritten by every host, the last one has everybody's samples
+        clocks.write(Path(collect_dir) / CLOCK_FILE, CONTROLLER_SERVER)
+        update_status(server, f"Collected {len(collected)} files (Success)")
 
     except Exception as e:
         update_status(server, f"Error: {str(e)}")
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
+
+
+def ssh_connect_and_snapshot(
+    server: str,
+    username: str,
+    password: str,
+    with_vmb: bool,
+    is_root: bool,
+    is_level_1_vmb: bool,
+    is_level_2_vmb: bool,
+    message_queue: SnapshotQueue,
+):
+    """Archive a host's storage once every root and VMB on it is commissioned"""
+    conn = None
+    with tracer.span(server, "snapshot storage"):
+        try:
+            update_status(server, "Connecting")
+
+            conn = connect(server, username, password)
+            package_dir = f"{REMOTE_SERVER_DIR}/matter.js/packages/cs525"
+            # device nodes don't log it, their parent's log covers them
+            logs = [
+                process.log
+                for process in TOPOLOGY.processes_for(server)
+                if process.level <= TOPOLOGY.depth
+            ]
+            if logs:
+                result = conn.sudo(
+                    commissioned_command(package_dir, logs), warn=True, hide=True
+                )
+                done = int(result.stdout.strip() or 0)
+                if done < len(logs):
+                    update_status(
+                        server,
+                        f"Failed to snapshot: {done} / {len(logs)} nodes commissioned",
+                    )
+                    return
+
+            update_status(server, "Saving storage snapshot")
+            path = snapshot_path(
+                SNAPSHOT_DIR, fingerprint(TOPOLOGY), snapshot_generation
+            )
+            result = conn.sudo(save_command(path), warn=True, hide=True)
+            if result.failed:
+                update_status(server, "Failed to save storage snapshot")
+                return
+            update_status(server, "Storage snapshot saved")
+
+        except Exception as e:
+            update_status(server, f"Error: {str(e)}")
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def snapshot_storage() -> dict[str, str]:
+    """Snapshot the storage of every host, recorded as a set if all of them did"""
+    global snapshot_generation
+    snapshot_generation = int(time())
+    final_status = run_headless(ssh_connect_and_snapshot)
+    if not failed_servers(final_status):
+        save_record(
+            fingerprint(TOPOLOGY),
+            snapshot_generation,
+            list(final_status),
+            Path(LOCAL_SERVER_DIR) / RECORD_FILE,
+        )
+    return final_status
+
+
+# Where hosts get the source from: git pull, or a delta of this checkout
+source = "git"
+# Start from the last storage snapshot set instead of commissioning
+warm_start = False
+SNAPSHOT_DIR = f"{MP_DIR}/storage-snapshots"
+snapshot_generation = 0
+checkout = SourceSync(LOCAL_SERVER_DIR)
+# Levels whose processes take heap snapshots every heap_interval, see heapsnap.py
+heap_levels = set()
+heap_interval = heapsnap.DEFAULT_INTERVAL
+# Levels whose processes are CPU profiled for a window, see cpuprof.py
+cpu_levels = set()
+cpu_delay = cpuprof.DEFAULT_DELAY
+cpu_seconds = cpuprof.DEFAULT_SECONDS
+# netem profile of every impaired role or link, see netem.py
+impairments = {}
+
+
+def sync_checkout(conn: Connection, server: str) -> list[str] | None:
+    """Send the host what changed in this checkout, None if that failed"""
+    update_status(server, "Syncing checkout")
+    try:
+        with tracer.span(server, "sync"):
+            changed = checkout.push(
+                conn, REMOTE_SERVER_DIR, timeout=PHASE_TIMEOUTS["sync"]
+            )
+    except Exception as e:
+        update_status(server, f"Failed to sync checkout: {e}")
+        return None
+    update_status(server, f"Synced {len(changed)} changed files")
+    return changed
+
+
+def pull_repository(conn: Connection, server: str) -> bool:
+    """git pull the repo, or clone it if the host doesn't have it yet"""
+    # Check if the server directory exists
+    result = conn.run(f"test -d {REMOTE_SERVER_DIR}/.git", warn=True)
+
+    if not result.failed:
+        # git pull
+        result = run_retrying(
+            conn,
+            server,
+            # a checkout sync's manifest no longer says what's on the host
+            f"cd {REMOTE_SERVER_DIR} && rm -f {MANIFEST_FILE}"
+            " && git reset --hard HEAD && git pull",
+            # f"cd {REMOTE_SERVER_DIR} && git pull",
+            "git pull",
+        )
+        if result.failed:
+            update_status(server, "Failed to pull repository")
+            return False
+    else:
+        # git clone
+        result = run_retrying(
+            conn,
+            server,
+            f"rm -rf {REMOTE_SERVER_DIR} && git clone {GIT_REPO} {REMOTE_SERVER_DIR}",
+            "git clone",
+        )
+        if result.failed:
+            update_status(server, "Failed to clone repository")
+            return False
+        # Check if the server directory was created
+        result = conn.run(f"test -d {REMOTE_SERVER_DIR}/.git", warn=True)
+        if result.failed:
+            update_status(server, "Failed to create server directory")
+            return False
+    return True
 
 
 def ssh_connect_and_setup(
@@ -794,19 +1228,19 @@ def ssh_connect_and_setup(
     message_queue: SnapshotQueue,
 ):
     """Connect to a server using SSH and setup the server"""
+    conn = None
     try:
         update_status(server, "Connecting")
 
-        # Establish SSH connection using Fabric
-        conn = Connection(
-            host=server,
-            user=username,
-            connect_kwargs={"password": password, "allow_agent": False},
-            config=make_config(server),
-        )
+        conn = connect(server, username, password)
 
         setup_server(conn, server, username)
+        sample_clock(conn, server)
         stop_server(conn, server)
+        if warm_start and with_vmb:
+            restore_storage(conn, server)
+        if not impair_network(conn, server):
+            return
         # Update files
         # update_status(server, "Installing config")
         # install_config(conn, server)
@@ -830,34 +1264,17 @@ def ssh_connect_and_setup(
         # recursive_upload(conn, LOCAL_SERVER_DIR, REMOTE_SERVER_DIR)
 
         # git clone the repo into the remote directory, if it does, run git pull, else git clone
-        # Check if the server directory exists
-        result = conn.run(f"test -d {REMOTE_SERVER_DIR}/.git", warn=True)
-
-        if not result.failed:
-            # git pull
-            result = conn.run(
-                f"cd {REMOTE_SERVER_DIR} && git reset --hard HEAD && git pull",
-                # f"cd {REMOTE_SERVER_DIR} && git pull",
-                warn=True,
-            )
-            if result.failed:
-                update_status(server, "Failed to pull repository")
+        # or only send what changed in this checkout since the host's last sync
+        if source == "checkout":
+            changed = sync_checkout(conn, server)
+            if changed is None:
                 return
+            # node_modules is kept unless the lockfile moved
+            build_server(conn, server, install=needs_install(changed))
         else:
-            # git clone
-            result = conn.run(
-                f"rm -rf {REMOTE_SERVER_DIR} && git clone {GIT_REPO} {REMOTE_SERVER_DIR}",
-                warn=True,
-            )
-            if result.failed:
-                update_status(server, "Failed to clone repository")
-                return
-            # Check if the server directory was created
-            result = conn.run(f"test -d {REMOTE_SERVER_DIR}/.git", warn=True)
-            if result.failed:
-                update_status(server, "Failed to create server directory")
+            if not pull_repository(conn, server):
                 return
-        build_server(conn, server)
+            build_server(conn, server)
         # start_server(conn, server)
         if not with_vmb:
             # install_config(conn, server)
@@ -870,25 +1287,15 @@ def ssh_connect_and_setup(
                     conn, server, with_vmb=with_vmb, message_queue=message_queue
                 )
         else:
-            # This code needs to be first
-            if is_level_2_vmb:
-                startup_endnodes(
-                    conn, server, with_vmb=with_vmb, message_queue=message_queue
-                )
-            if is_root:
-                # start the root controller
-                start_root_controller(
-                    conn, server, with_vmb=with_vmb, message_queue=message_queue
-                )
-            if is_level_1_vmb:
-                start_level_1_vmb(
-                    conn, server, with_vmb=with_vmb, message_queue=message_queue
-                )
+            install_config(conn, server)
+            # Every VMB as soon as its own children are up, root last
+            start_vmb_processes(conn, server, message_queue=message_queue)
 
     except Exception as e:
         update_status(server, f"Error: {str(e)}")
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
 
 def ssh_connect_and_stop(
@@ -902,42 +1309,94 @@ def ssh_connect_and_stop(
     message_queue: SnapshotQueue,
 ):
     """Connect to a server using SSH and stop the server process"""
+    conn = None
     try:
         update_status(server, "Connecting")
-        # Establish SSH connection using Fabric
-        conn = Connection(
-            host=server,
-            user=username,
-            connect_kwargs={"password": password, "allow_agent": False},
-            config=make_config(server),
-        )
+        conn = connect(server, username, password)
         # Stop server process
-        stop_server(conn, server)
+        if scope is not None:
+            stop_processes(conn, server, scoped_processes(server))
+        else:
+            stop_server(conn, server)
     except Exception as e:
         update_status(server, f"Error: {str(e)}")
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
+
+
+def stream_metrics(server: str):
+    """Feed the dashboard's live metrics from a sampler on the server"""
+    conn = None
+    try:
+        conn = connect(server, username, password)
+        ranges = TOPOLOGY.capture_ports(server) if with_vmb else [BASELINE_PORT_RANGE]
+        result = conn.sudo(
+            sampler_command(ranges),
+            hide=True,
+            warn=True,
+            watchers=[live.watcher(server)],
+        )
+        if result.failed:
+            live.error(server, f"sampler exited: {result.stderr.strip()[-200:]}")
+    except Exception as e:
+        live.error(server, str(e))
+    finally:
+        if conn is not None:
+            conn.close()
 
 
 def make_watcher(server: str):
     ansi_escape = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
 
     class OutputWatcher(StreamWatcher):
+        """Feeds only the newly arrived part of a command's output to the status
+
+        invoke hands over the whole accumulated stream on every call, once per
+        stdout/stderr reader thread, so progress is tracked per reader thread.
+        """
+
+        def __init__(self):
+            super().__init__()
+            self.seen = weakref.WeakKeyDictionary()
+
         def submit(self, stream):
-            # with mutex:
-            # print(stream)
-            result = ansi_escape.sub("", stream)
-            status[server]["output"] = result
+            reader = threading.current_thread()
+            offset, pending = self.seen.get(reader, (0, ""))
+            text = pending + stream[offset:]
+            *lines, pending = text.split("\n")
+            # progress bars redraw the same line with \r
+            pending = pending[pending.rfind("\r") + 1 :][-OUTPUT_LINE_LIMIT:]
+            self.seen[reader] = (len(stream), pending)
+            lines = [ansi_escape.sub("", line.split("\r")[-1]) for line in lines]
+            append_output(server, lines, ansi_escape.sub("", pending))
             return []
 
     return OutputWatcher()
 
 
+OK_STATUSES = ["Online", "Stopped", "Success"]
+FAILED_STATUSES = ["Failed", "Error"]
+
+
+def status_color(server_status: str):
+    # Assign colors based on the status
+    if any(status in server_status for status in OK_STATUSES):
+        return curses.color_pair(1)
+    elif any(status in server_status for status in FAILED_STATUSES):
+        return curses.color_pair(2)
+    return curses.color_pair(3)
+
+
 # Function to display the dynamic status matrix using curses
 def display_status(stdscr):
     global threads
     global password
-    """Display the status of all servers using curses"""
+    """Display the status of all servers using curses
+
+    Only rows whose text changed are redrawn, and the loop sleeps until a
+    status update arrives (or a short timeout so key presses stay responsive).
+    """
     curses.curs_set(0)  # Hide cursor
     stdscr.nodelay(True)  # Make getch() non-blocking
     curses.start_color()
@@ -948,64 +1407,173 @@ def display_status(stdscr):
     curses.init_pair(3, curses.COLOR_YELLOW, curses.COLOR_BLACK)
     collect_logs = False
 
+    header = [
+        ("CS 625 Server Status Monitor", curses.A_BOLD),
+        ("Press 'q' to quit, 'c' to collect logs", curses.A_BOLD),
+        ("", curses.A_NORMAL),
+        ("", curses.A_NORMAL),
+    ]
+    # Named stragglers are rechecked every so often, they change without updates
+    last_straggler_check = 0
+    drawn = {}
+    with mutex:
+        dirty.update(SERVERS)
+
     while True:
-        stdscr.clear()
-        stdscr.addstr(0, 0, "CS 625 Server Status Monitor", curses.A_BOLD)
-        stdscr.addstr(1, 0, "Press 'q' to quit, 'c' to collect logs", curses.A_BOLD)
+        status_changed.wait(timeout=0.1)
+        status_changed.clear()
 
+        # Copy out what changed, then draw without holding the lock
         with mutex:
-            line_idx = 3
-            for idx, server in enumerate(SERVERS):
-                server_status = status[server]["msg"]
-                # Assign colors based on the status
-                if any(
-                    status in server_status
-                    for status in ["Online", "Stopped", "Success"]
-                ):
-                    color = curses.color_pair(1)
-                elif any(status in server_status for status in ["Failed", "Error"]):
-                    color = curses.color_pair(2)
-                else:
-                    color = curses.color_pair(3)
-                # Display the status with color
-                stdscr.addstr(line_idx, 0, f"{server}: {server_status}", color)
-                line_idx += 1
-                output = status[server].get("output", "-" * 50)
-                # get the last two lines of the output
-                output = "\n".join(output.splitlines()[-1:])
-
-                stdscr.addstr(line_idx, 0, output, curses.A_BOLD)
-                line_idx += output.count("\n") + 1
+            changed = {
+                server: (status[server]["msg"], status[server].get("output"))
+                for server in dirty
+                if server in status
+            }
+            dirty.clear()
+            # hosts replaced by a spare keep their row, the spare gets a new one
+            servers = list(status)
+
+        rows = {i: row for i, row in enumerate(header)}
+        if time() - last_straggler_check > 1:
+            last_straggler_check = time()
+            stragglers = tracer.stragglers(policy.straggler_factor)
+            rows[len(header) - 2] = (
+                (
+                    "Stragglers: "
+                    + ", ".join(
+                        f"{host} ({phase} {elapsed:.0f}s, median {median:.0f}s)"
+                        for host, (phase, elapsed, median) in stragglers.items()
+                    )
+                    if stragglers
+                    else ""
+                ),
+                curses.color_pair(3),
+            )
+            if live_metrics:
+                rows[len(header) - 1] = (live.totals(), curses.A_BOLD)
+                for idx, server in enumerate(servers):
+                    if server not in monitored and "Online" in status[server]["msg"]:
+                        monitored.add(server)
+                        threading.Thread(
+                            target=stream_metrics, args=(server,), daemon=True
+                        ).start()
+                    metrics_row = live.row(server)
+                    if metrics_row is not None and server not in changed:
+                        rows[len(header) + idx * 2 + 1] = (metrics_row, curses.A_BOLD)
+        for idx, server in enumerate(servers):
+            if server not in changed:
+                continue
+            server_status, output = changed[server]
+            line_idx = len(header) + idx * 2
+            rows[line_idx] = (f"{server}: {server_status}", status_color(server_status))
+            # once a host streams metrics they take the place of its output
+            metrics_row = live.row(server) if live_metrics else None
+            rows[line_idx + 1] = (metrics_row or output or "-" * 50, curses.A_BOLD)
+
+        height, width = stdscr.getmaxyx()
+        for line_idx, (text, attr) in rows.items():
+            if line_idx >= height or drawn.get(line_idx) == (text, attr):
+                continue
+            stdscr.addnstr(line_idx, 0, text, width - 1, attr)
+            stdscr.clrtoeol()
+            drawn[line_idx] = (text, attr)
         stdscr.refresh()
+
+        key = stdscr.getch()
+        if key == curses.KEY_RESIZE:
+            stdscr.clear()
+            drawn.clear()
+            with mutex:
+                dirty.update(status)
         # Exit if 'q' is pressed
-        if stdscr.getch() == ord("q"):
+        if key == ord("q"):
             break
-        if stdscr.getch() == ord("c") and not collect_logs:
+        if key == ord("c") and not collect_logs:
             # collect logs
             collect_logs = True
             for server in SERVERS:
                 update_status(server, "Collecting logs")
-                is_root = server == CONTROLLER_SERVER
-                is_level_1_vmb = server in LEVEL_1_VMB_SERVERS
-                server_num = int(server.split(".")[0][-2:])
-                is_level_2_vmb = server_num >= 5
-                thread = threading.Thread(
-                    target=ssh_connect_and_get_logs,
-                    args=(
-                        server,
-                        username,
-                        password,
-                        with_vmb,
-                        is_root,
-                        is_level_1_vmb,
-                        is_level_2_vmb,
-                        message_queue,
-                    ),
-                )
-                thread.start()
-                threads.append(thread)
-        # Refresh the display every second
-        sleep(1)
+            # Collecting stops everything, so it covers the whole tree
+            threads += start_threads(ssh_connect_and_get_logs, message_queue, SERVERS)
+
+
+def start_threads(
+    target_action, message_queue: SnapshotQueue, servers: list[str] | None = None
+) -> list:
+    """Run target_action for every server in scope, one thread each"""
+    started = []
+    for server in servers or scoped_servers():
+        is_root = server == CONTROLLER_SERVER
+        is_level_1_vmb = server in LEVEL_1_VMB_SERVERS
+        is_level_2_vmb = TOPOLOGY.depth in TOPOLOGY.host_levels(server)
+        thread = threading.Thread(
+            target=target_action,
+            args=(
+                server,
+                username,
+                password,
+                with_vmb,
+                is_root,
+                is_level_1_vmb,
+                is_level_2_vmb,
+                message_queue,
+            ),
+        )
+        thread.start()
+        started.append(thread)
+    return started
+
+
+def run_headless(target_action) -> dict[str, str]:
+    """Run target_action on every server without the dashboard
+
+    Returns the final status message of every server.
+    """
+    global threads, deploy_action
+    for server in SERVERS:
+        update_status(server, "Waiting")
+    deploy_action = target_action
+    threads = start_threads(target_action, SnapshotQueue())
+    # spares swapped in along the way are appended to threads
+    for thread in threads:
+        thread.join()
+    with mutex:
+        return {server: status[server]["msg"] for server in SERVERS}
+
+
+def failed_servers(final_status: dict[str, str]) -> list[str]:
+    """Servers whose final status is a failure or an error"""
+    return [
+        server
+        for server, msg in final_status.items()
+        if any(status in msg for status in FAILED_STATUSES)
+    ]
+
+
+def connect(server: str, username: str, password: str):
+    """Open a connection to a server, or to its namespace when emulating locally"""
+    if local:
+        conn = NamespaceConnection(server, config=make_config(server))
+    else:
+        # Establish SSH connection using Fabric
+        conn = Connection(
+            host=server,
+            user=username,
+            connect_kwargs={"password": password, "allow_agent": False},
+            config=make_config(server),
+            connect_timeout=PHASE_TIMEOUTS["connect"],
+        )
+        with tracer.span(server, "connect"):
+            retry(
+                conn.open,
+                RETRY_ATTEMPTS,
+                lambda attempt, reason, delay: update_status(
+                    server, f"Connecting: {reason}, retry {attempt} in {delay:.0f}s"
+                ),
+            )
+    # Every command run through it ends up in the deploy trace
+    return TracedConnection(conn, server, tracer)
 
 
 def make_config(server: str):
@@ -1030,17 +1598,45 @@ def make_config(server: str):
 
 threads = []
 username = ""
+password = ""
 with_vmb = False
+local = False
+collect_mode = "raw"
+# Instances a restart or kill is limited to, None for the whole tree
+scope = None
+# Where collected files end up, one folder per server
+collect_dir = LOCAL_SERVER_DIR
+# What to do about failed and straggling hosts, see resilience.py
+policy = Policy()
+policy_lock = threading.Lock()
+# Action the running deploy started with, spares are started with it too
+deploy_action = None
 
 
 message_queue = SnapshotQueue()
 
 
-def main():
+def main(argv: list[str] | None = None):
     global password
     global username
     global threads
     global with_vmb
+    global local
+    global collect_mode
+    global capture_profile
+    global scope
+    global policy
+    global deploy_action
+    global collect_dir
+    global live_metrics
+    global source
+    global warm_start
+    global heap_levels
+    global heap_interval
+    global cpu_levels
+    global cpu_delay
+    global cpu_seconds
+    global impairments
     parser = argparse.ArgumentParser(
         prog="CS 525 Deployment Script",
         description="Deploy the Matter testbed to multiple servers",
@@ -1059,17 +1655,226 @@ def main():
     parser.add_argument(
         "-v", "--vmb", action="store_true", help="Use VMB version of the server"
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "-t",
+        "--topology",
+        type=str,
+        help="Topology file describing hosts, fan-out and endpoints (default: topology.json)",
+    )
+    parser.add_argument(
+        "--fanout", type=str, help="Override the fan-out per VMB tier, e.g. 4,8"
+    )
+    parser.add_argument(
+        "--endpoints", type=int, help="Override the endpoints per device node"
+    )
+    parser.add_argument(
+        "-l",
+        "--local",
+        action="store_true",
+        help="Emulate every host in a network namespace on this machine (needs root)",
+    )
+    parser.add_argument(
+        "-c",
+        "--collect",
+        choices=["raw", "aggregate", "both"],
+        default="raw",
+        help="What 'c' downloads: raw captures, tables aggregated on each host, or both",
+    )
+    parser.add_argument(
+        "--capture",
+        choices=list(PROFILES),
+        default="matter",
+        help="tcpdump profile: all traffic, the role's Matter ports, headers only, or rotated",
+    )
+    parser.add_argument(
+        "--subtree",
+        type=str,
+        help="Only restart/kill the level 1 VMB on this host (host[:n]) and everything below it",
+    )
+    parser.add_argument(
+        "--role",
+        type=str,
+        help="Only restart/kill one role: root, level_<n> or endpoints (within --subtree if given)",
+    )
+    parser.add_argument(
+        "--policy",
+        choices=POLICIES,
+        default="wait",
+        help="Failed or straggling hosts: wait for every host, go on with a quorum, or swap in spares",
+    )
+    parser.add_argument(
+        "--quorum",
+        type=float,
+        default=Policy.quorum,
+        help="Fraction of a startup stage that has to be up to go on with --policy quorum",
+    )
+    parser.add_argument(
+        "--get-logs",
+        action="store_true",
+        help="Stop the processes and download logs and captures, without the dashboard",
+    )
+    parser.add_argument(
+        "--collect-dir",
+        type=str,
+        default=LOCAL_SERVER_DIR,
+        help="Where collected files go, one folder per host (default: here)",
+    )
+    parser.add_argument(
+        "--live-metrics",
+        action="store_true",
+        help="Stream CPU, memory and UDP traffic of every online host into the dashboard",
+    )
+    parser.add_argument(
+        "--source",
+        choices=["git", "checkout"],
+        default="git",
+        help="Where hosts get the source: git pull from GitHub, or the files changed in this checkout",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="Restore every host's last storage snapshot and skip commissioning (--vmb)",
+    )
+    parser.add_argument(
+        "--snapshot-storage",
+        action="store_true",
+        help="Snapshot the storage of a commissioned tree for --warm-start, without the dashboard",
+    )
+    parser.add_argument(
+        "--heap-snapshots",
+        type=str,
+        help="Snapshot the V8 heap of these roles every --heap-interval: root, level_<n>, endpoints, comma separated (--vmb)",
+    )
+    parser.add_argument(
+        "--heap-interval",
+        type=int,
+        default=heapsnap.DEFAULT_INTERVAL,
+        help="Seconds between heap snapshots, on wall-clock multiples so hosts line up",
+    )
+    parser.add_argument(
+        "--cpu-profile",
+        type=str,
+        help="CPU profile these roles for a window: root, level_<n>, endpoints, comma separated (root and endpoints without --vmb)",
+    )
+    parser.add_argument(
+        "--cpu-profile-delay",
+        type=int,
+        default=cpuprof.DEFAULT_DELAY,
+        help="Seconds after a process starts that its CPU profile begins",
+    )
+    parser.add_argument(
+        "--cpu-profile-seconds",
+        type=int,
+        default=cpuprof.DEFAULT_SECONDS,
+        help="Length of the CPU profile window",
+    )
+    parser.add_argument(
+        "--netem",
+        type=str,
+        help=f"Impair roles or links, e.g. level_1=wan,link:endpoints=lossy (profiles: {', '.join(netem.PROFILES)})",
+    )
+    args = parser.parse_args(argv)
+    source = args.source
+    heap_interval = args.heap_interval
+    cpu_delay = args.cpu_profile_delay
+    cpu_seconds = args.cpu_profile_seconds
+    warm_start = args.warm_start
+    live_metrics = args.live_metrics
+    collect_mode = args.collect
+    collect_dir = args.collect_dir
+    policy = Policy(args.policy, args.quorum)
+    capture_profile = args.capture
+
+    if args.topology or args.fanout or args.endpoints:
+        apply_topology(
+            load_topology(
+                args.topology or os.getenv("TOPOLOGY") or DEFAULT_TOPOLOGY_FILE,
+                fanout=(
+                    [int(x) for x in args.fanout.split(",")] if args.fanout else None
+                ),
+                endpoints_per_node=args.endpoints,
+            )
+        )
 
-    default_username = args.user
-    if not default_username:
-        username = os.getenv("USERNAME") or input("Enter your username: ")
+    local = args.local
+    if local:
+        if not (args.restart or args.kill or args.get_logs):
+            # No network for git inside the namespaces, the checkout is overlaid
+            parser.error(
+                "--local needs --restart, --kill or --get-logs, build the checkout first"
+            )
+        apply_topology(emulated_topology(TOPOLOGY))
+        setup_hosts(TOPOLOGY, LOCAL_SERVER_DIR, REMOTE_SERVER_DIR)
+        username = getuser()
+        password = ""
     else:
-        print(f"Using username: {default_username}")
-        username = default_username
-    password = os.getenv("PASSWORD") or getpass("Enter your password: ")
+        default_username = args.user
+        if not default_username:
+            username = os.getenv("USERNAME") or input("Enter your username: ")
+        else:
+            print(f"Using username: {default_username}")
+            username = default_username
+        password = os.getenv("PASSWORD") or getpass("Enter your password: ")
 
     with_vmb = args.vmb
+    if args.subtree or args.role:
+        if not (with_vmb and (args.restart or args.kill)):
+            parser.error("--subtree/--role need --vmb and --restart or --kill")
+        try:
+            scope = TOPOLOGY.scope(args.subtree, args.role)
+        except ValueError as e:
+            parser.error(str(e))
+        for server in SERVERS:
+            if server not in scoped_servers():
+                update_status(server, "Out of scope, left running")
+
+    if (args.warm_start or args.snapshot_storage) and not with_vmb:
+        parser.error("--warm-start/--snapshot-storage need --vmb")
+    if args.heap_snapshots:
+        if not with_vmb:
+            parser.error("--heap-snapshots needs --vmb")
+        try:
+            heap_levels = {
+                TOPOLOGY.role_level(role.strip())
+                for role in args.heap_snapshots.split(",")
+            }
+        except ValueError as e:
+            parser.error(str(e))
+    if args.cpu_profile:
+        try:
+            cpu_levels = {
+                TOPOLOGY.role_level(role.strip())
+                for role in args.cpu_profile.split(",")
+            }
+        except ValueError as e:
+            parser.error(str(e))
+        if not with_vmb and not cpu_levels <= {0, TOPOLOGY.depth + 1}:
+            parser.error("The baseline only has the root and endpoints roles")
+    if args.netem:
+        try:
+            impairments = netem.parse_spec(args.netem, TOPOLOGY)
+        except ValueError as e:
+            parser.error(str(e))
+        if not with_vmb and not set(impairments) <= netem.BASELINE_TARGETS:
+            parser.error("The baseline only has root, endpoints and link:endpoints")
+        if scope is not None:
+            parser.error("--netem applies to the whole tree, not a --subtree/--role")
+    if args.warm_start and scope is not None:
+        parser.error("--warm-start restarts the whole tree, not a --subtree/--role")
+    if args.snapshot_storage:
+        final_status = snapshot_storage()
+        for server, msg in final_status.items():
+            print(f"{server}: {msg}")
+        if failed_servers(final_status):
+            print("Not every host saved a snapshot, the set isn't recorded")
+        return
+
+    if args.get_logs:
+        final_status = run_headless(ssh_connect_and_get_logs)
+        for server, msg in final_status.items():
+            print(f"{server}: {msg}")
+        print(f"Collected into {Path(collect_dir).resolve()}")
+        return
 
     # Choose target action
     target_action = None
@@ -1081,26 +1886,8 @@ def main():
         target_action = ssh_connect_and_setup
 
     # Start a thread for each server
-    for server in SERVERS:
-        is_root = server == CONTROLLER_SERVER
-        is_level_1_vmb = server in LEVEL_1_VMB_SERVERS
-        server_num = int(server.split(".")[0][-2:])
-        is_level_2_vmb = server_num >= 5
-        thread = threading.Thread(
-            target=target_action,
-            args=(
-                server,
-                username,
-                password,
-                with_vmb,
-                is_root,
-                is_level_1_vmb,
-                is_level_2_vmb,
-                message_queue,
-            ),
-        )
-        thread.start()
-        threads.append(thread)
+    deploy_action = target_action
+    threads += start_threads(target_action, message_queue)
 
     # Start curses to display the status
     try:
@@ -1116,7 +1903,14 @@ def main():
     # Print final status for all servers
     print("Final status of all servers:")
     for server, state in status.items():
-        print(f"{server}: {state}")
+        print(f"{server}: {state['msg']}")
+
+    spans_path, trace_path = tracer.write(
+        Path(LOCAL_SERVER_DIR) / TRACE_DIR, f"deploy_{int(time())}"
+    )
+    print()
+    print(summary(tracer.spans))
+    print(f"Trace written to {spans_path} and {trace_path} (chrome://tracing)")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+"""Single-host emulation of the testbed.
+
+Every logical host of the topology gets its own network namespace, with its
+own IPv6 address on a shared bridge, and its own mount namespace in which the
+local checkout is overlaid at the remote server directory and ~/.matter and
+/tmp are private, so every host has its own tmux server and storage. The PID
+namespace is shared: deploy.py only kills the processes of the host's own
+network namespace, and teardown kills those of every namespace.
+
+NamespaceConnection implements the part of fabric's Connection deploy.py uses
+(run, sudo, put, get, close). Everything runs as root, so this needs to be
+started as root:
+
+    sudo python deploy.py --vmb --local --restart
+    sudo python emulation.py teardown
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+from pathlib import Path
+
+from invoke import Context
+
+from topology import DEFAULT_TOPOLOGY_FILE, Topology, load_topology
+
+STATE_DIR = Path("/var/lib/cs525-emu")
+# Bind mounts keeping the per-host mount namespaces alive
+PIN_DIR = Path("/run/cs525-emu")
+BRIDGE = "cs525br0"
+SUBNET = "fd25:525::"
+
+
+def namespace_name(server: str) -> str:
+    return f"cs525-{server.split('.')[0]}"
+
+
+def emulated_topology(topology: Topology) -> Topology:
+    """Same topology, with every host moved to an address on the local bridge"""
+    spec = dict(topology.spec)
+    spec["hosts"] = {
+        server: f"{SUBNET}{i + 1:x}" for i, server in enumerate(topology.hosts)
+    }
+    spec["spares"] = {
+        spare: f"{SUBNET}{len(topology.hosts) + i + 1:x}"
+        for i, spare in enumerate(topology.spares)
+    }
+    return Topology(spec)
+
+
+def emulated_hosts(topology: Topology) -> dict[str, str]:
+    """Every host that gets a namespace, spares included, with its address"""
+    addresses = {**topology.hosts, **topology.spares}
+    return {
+        server: addresses[server] for server in [*topology.servers, *topology.spares]
+    }
+
+
+def _sh(cmd: str, check: bool = True) -> subprocess.CompletedProcess:
+    return subprocess.run(cmd, shell=True, check=check, capture_output=True, text=True)
+
+
+def setup_hosts(topology: Topology, source_dir: str | Path, remote_dir: str):
+    """Create (or reuse) the namespaces of every host in an emulated topology"""
+    if os.geteuid() != 0:
+        raise PermissionError("The local emulation backend needs to run as root")
+    source_dir = Path(source_dir).resolve()
+
+    if _sh(f"ip link show {BRIDGE}", check=False).returncode != 0:
+        _sh(f"ip link add {BRIDGE} type bridge && ip link set {BRIDGE} up")
+
+    # The namespace handles need a private mount to live on
+    PIN_DIR.mkdir(parents=True, exist_ok=True)
+    if _sh(f"mountpoint -q {PIN_DIR}", check=False).returncode != 0:
+        _sh(f"mount --bind {PIN_DIR} {PIN_DIR} && mount --make-private {PIN_DIR}")
+    Path(remote_dir).mkdir(parents=True, exist_ok=True)
+
+    for i, (server, address) in enumerate(emulated_hosts(topology).items()):
+        ns = namespace_name(server)
+        host_dir = STATE_DIR / ns
+        for sub in ["upper", "work", "matter", "tmp"]:
+            (host_dir / sub).mkdir(parents=True, exist_ok=True)
+
+        if not Path(f"/run/netns/{ns}").exists():
+            veth = f"cs525v{i}"
+            _sh(f"ip netns add {ns}")
+            _sh(f"ip link add {veth} type veth peer name eth0 netns {ns}")
+            _sh(f"ip link set {veth} master {BRIDGE} up")
+            _sh(f"ip -n {ns} link set lo up && ip -n {ns} link set eth0 up")
+            _sh(f"ip -n {ns} -6 addr add {address}/64 dev eth0 nodad")
+
+        pin = PIN_DIR / ns
+        if not pin.exists():
+            pin.touch()
+            mounts = " && ".join(
+                [
+                    f"mount -t overlay overlay -o lowerdir={source_dir},"
+                    f"upperdir={host_dir}/upper,workdir={host_dir}/work {remote_dir}",
+                    "mkdir -p ~/.matter",
+                    f"mount --bind {host_dir}/matter ~/.matter",
+                    f"mount --bind {host_dir}/tmp /tmp",
+                ]
+            )
+            _sh(
+                f"unshare --mount={pin} --propagation private "
+                f"/bin/sh -c {shlex.quote(mounts)}"
+            )
+
+
+def teardown_hosts(topology: Topology):
+    """Remove the namespaces and everything running inside them"""
+    for i, server in enumerate(emulated_hosts(topology)):
+        ns = namespace_name(server)
+        _sh(f"ip netns pids {ns} | xargs -r kill -9", check=False)
+        _sh(f"umount {PIN_DIR / ns} && rm -f {PIN_DIR / ns}", check=False)
+        _sh(f"ip netns delete {ns}", check=False)
+        _sh(f"ip link delete cs525v{i}", check=False)
+    _sh(f"ip link delete {BRIDGE}", check=False)
+
+
+class NamespaceConnection(Context):
+    """Drop-in for fabric's Connection that runs inside a host's namespaces"""
+
+    def __init__(self, host: str, config=None):
+        super().__init__(config=config)
+        self.host = host
+        self.namespace = namespace_name(host)
+
+    def _argv(self, command: str) -> list[str]:
+        return [
+            "nsenter",
+            f"--net=/run/netns/{self.namespace}",
+            f"--mount={PIN_DIR / self.namespace}",
+            "--",
+            # an outer tmux session would otherwise leak in through $TMUX
+            "env",
+            "-u",
+            "TMUX",
+            "-u",
+            "TMUX_TMPDIR",
+            "/bin/sh",
+            "-c",
+            f"cd && {command}",
+        ]
+
+    def run(self, command: str, **kwargs):
+        return super().run(shlex.join(self._argv(command)), **kwargs)
+
+    def sudo(self, command: str, **kwargs):
+        # Already root, sudo's password prompt would only get in the way
+        return self.run(command, **kwargs)
+
+    def put(self, local, remote: str):
+        if hasattr(local, "read"):
+            local.seek(0)
+            data = local.read()
+        else:
+            with open(local, "rb") as f:
+                data = f.read()
+        if isinstance(data, str):
+            data = data.encode()
+        subprocess.run(
+            self._argv(f"cat > {shlex.quote(remote)}"), input=data, check=True
+        )
+
+    def get(self, remote: str, local=None):
+        local = local or Path(remote).name
+        data = subprocess.run(
+            self._argv(f"cat {shlex.quote(remote)}"), capture_output=True, check=True
+        ).stdout
+        if hasattr(local, "write"):
+            local.write(data)
+        else:
+            with open(local, "wb") as f:
+                f.write(data)
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local emulated hosts")
+    parser.add_argument("action", choices=["setup", "teardown"])
+    parser.add_argument("--topology", default=DEFAULT_TOPOLOGY_FILE)
+    parser.add_argument("--source", default="./", help="Checkout to overlay")
+    parser.add_argument("--remote-dir", default="/opt/matter/cs525-G25/")
+    args = parser.parse_args()
+
+    topology = emulated_topology(load_topology(args.topology))
+    if args.action == "setup":
+        setup_hosts(topology, args.source, args.remote_dir)
+        for server, address in emulated_hosts(topology).items():
+            print(f"{namespace_name(server)}: {address}")
+    else:
+        teardown_hosts(topology)
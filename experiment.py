@@ -0,0 +1,508 @@
+"""Unattended parameter sweeps over the testbed.
+
+A sweep file lists the values to try; every combination is one point that is
+deployed, warmed up, measured for a fixed window, collected (which also stops
+every process), and analyzed:
+
+    {
+        "name": "fanout",
+        "topology": "topology.json",
+        "modes": ["baseline", "vmb"],
+        "fanout": [[4, 8], [2, 16]],
+        "endpoints_per_node": [10, 20],
+        "warmup": 60,
+        "duration": [300],
+        "repetitions": 3,
+        "collect": "aggregate",
+        "capture": "headers",
+        "policy": {"mode": "quorum", "quorum": 0.9},
+        "sample_processes": true,
+        "netem": ["", "link:endpoints=thread", "level_1=wan"]
+    }
+
+sample_processes also samples CPU and memory of every node process on every
+host (node_usage.log), which the per-role metrics and capacity.py rely on.
+Every netem spec (see netem.py, "" for none) is another point of each
+combination, with the impairment kept in its state and results. Baseline
+points only get the specs that impair its root or endpoints.
+
+Progress is kept in experiments/<name>/state.json, so running the same sweep
+again skips finished points and retries failed ones. The metrics of every
+finished point end up in experiments/<name>/results.csv.
+
+    python experiment.py sweep.json
+    sudo python experiment.py sweep.json --local
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import re
+import traceback
+from dataclasses import asdict, dataclass
+from getpass import getpass, getuser
+from io import StringIO
+from pathlib import Path
+from time import sleep, strftime, time
+
+import pandas as pd
+
+import applog
+import deploy
+import netem
+import reduction
+from clocks import ClockOffsets
+from emulation import emulated_topology, setup_hosts
+from results import (
+    PROCESS_LOG,
+    ResultsStore,
+    git_commit,
+    ingest_sweep,
+    memory_kib,
+    read_process_log,
+)
+from resilience import Policy
+from topology import DEFAULT_TOPOLOGY_FILE, load_topology
+
+EXPERIMENTS_DIR = "experiments"
+STATE_FILE = "state.json"
+RESULTS_FILE = "results.csv"
+CPU_LOG = "cpu_usage.log"
+DEFAULT_WARMUP = 60
+DEFAULT_DURATION = 300
+
+
+@dataclass
+class Point:
+    mode: str
+    fanout: list[int] | None
+    endpoints_per_node: int | None
+    warmup: int
+    duration: int
+    repetition: int
+    netem: str = ""
+
+    @property
+    def id(self) -> str:
+        parts = [self.mode]
+        if self.mode == "vmb":
+            parts += [
+                f"f{'x'.join(str(n) for n in self.fanout)}",
+                f"e{self.endpoints_per_node}",
+            ]
+        if self.netem:
+            parts.append("n" + re.sub(r"[^\w.]+", "_", self.netem))
+        parts += [f"d{self.duration}", f"r{self.repetition}"]
+        return "-".join(parts)
+
+
+def expand(sweep: dict) -> list[Point]:
+    """Every combination of the sweep's values, repetitions last"""
+    topology_file = sweep.get("topology", DEFAULT_TOPOLOGY_FILE)
+    topology = load_topology(topology_file)
+    fanouts = sweep.get("fanout", [topology.fanout])
+    endpoints = sweep.get("endpoints_per_node", [topology.endpoints_per_node])
+    durations = sweep.get("duration", [DEFAULT_DURATION])
+    warmup = sweep.get("warmup", DEFAULT_WARMUP)
+    repetitions = sweep.get("repetitions", 1)
+    impairments = sweep.get("netem", [""])
+    for spec in impairments:
+        netem.parse_spec(spec, topology)
+
+    points = []
+    for mode in sweep.get("modes", ["baseline", "vmb"]):
+        if mode == "baseline":
+            # startup.sh fixes the baseline's endpoints, only the window varies
+            combinations = [(None, None, duration) for duration in durations]
+        elif mode == "vmb":
+            combinations = list(itertools.product(fanouts, endpoints, durations))
+            # Catch port clashes now rather than halfway through the night
+            for fanout, endpoints_per_node, _ in combinations:
+                load_topology(topology_file, fanout, endpoints_per_node)
+        else:
+            raise ValueError(f"Unknown mode '{mode}', expected baseline or vmb")
+        for fanout, endpoints_per_node, duration in combinations:
+            for spec in impairments:
+                # the baseline has no VMB tiers to impair
+                targets = netem.parse_spec(spec, topology)
+                if mode == "baseline" and not set(targets) <= netem.BASELINE_TARGETS:
+                    continue
+                for repetition in range(repetitions):
+                    points.append(
+                        Point(
+                            mode,
+                            fanout,
+                            endpoints_per_node,
+                            warmup,
+                            duration,
+                            repetition,
+                            spec,
+                        )
+                    )
+    return points
+
+
+def load_state(sweep_dir: Path) -> dict:
+    path = sweep_dir / STATE_FILE
+    if path.exists():
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(sweep_dir: Path, state: dict):
+    tmp = sweep_dir / f"{STATE_FILE}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=4)
+    tmp.replace(sweep_dir / STATE_FILE)
+
+
+def write_results(sweep_dir: Path, state: dict):
+    """One row per finished point: its parameters and its metrics"""
+    rows = []
+    for point_id, entry in state.items():
+        if entry["status"] != "done":
+            continue
+        row = {"point": point_id, **entry["point"], **entry["metrics"]}
+        if row["fanout"]:
+            row["fanout"] = "x".join(str(n) for n in row["fanout"])
+        rows.append(row)
+    if not rows:
+        return
+    fields = list(dict.fromkeys(key for row in rows for key in row))
+    with open(sweep_dir / RESULTS_FILE, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def log(msg: str):
+    print(f"{strftime('%H:%M:%S')} {msg}", flush=True)
+
+
+def apply_point(point: Point, sweep: dict):
+    """Point the deploy globals at the topology and mode of a sweep point"""
+    topology = load_topology(
+        sweep.get("topology", DEFAULT_TOPOLOGY_FILE),
+        fanout=point.fanout,
+        endpoints_per_node=point.endpoints_per_node,
+    )
+    if deploy.local:
+        topology = emulated_topology(topology)
+        setup_hosts(topology, deploy.LOCAL_SERVER_DIR, deploy.REMOTE_SERVER_DIR)
+    deploy.apply_topology(topology)
+    deploy.with_vmb = point.mode == "vmb"
+    deploy.impairments = netem.parse_spec(point.netem, topology)
+
+
+def run_step(target_action, step: str):
+    final_status = deploy.run_headless(target_action)
+    failed = deploy.failed_servers(final_status)
+    if failed:
+        details = "; ".join(f"{server}: {final_status[server]}" for server in failed)
+        raise RuntimeError(f"{step} failed on {len(failed)} hosts ({details})")
+
+
+def start_cpu_sampler(with_vmb: bool):
+    """Sample the root controller's CPU and memory once a second, like parse-cpu.py expects"""
+    server = deploy.CONTROLLER_SERVER
+    package = "cs525" if with_vmb else "cs525-baseline"
+    script = "RootControllerNode.js" if with_vmb else "ControllerNode.js"
+    package_dir = f"{deploy.REMOTE_SERVER_DIR}/matter.js/packages/{package}"
+    sampler = (
+        # the node process itself, not the sh -c tmux runs it in
+        f"pid=$(pgrep -n -f '^node .*{script}')\n"
+        "while sleep 1; do\n"
+        '    top -b -n 1 -p "$pid" | tail -n 1 | sed "s/^/$(date +%s) /"\n'
+        f"done > {package_dir}/{CPU_LOG}\n"
+    )
+    conn = deploy.connect(server, deploy.username, deploy.password)
+    try:
+        conn.put(StringIO(sampler), f"{package_dir}/cpu_sample.sh")
+        result = conn.sudo(
+            f"tmux new-session -d -s cpu 'sh {package_dir}/cpu_sample.sh'", warn=True
+        )
+        if result.failed:
+            raise RuntimeError(f"Failed to start the CPU sampler on {server}")
+    finally:
+        conn.close()
+
+
+def start_process_samplers():
+    """Sample CPU and memory of every node process on every host once a second"""
+    package_dir = f"{deploy.REMOTE_SERVER_DIR}/matter.js/packages/cs525"
+    # -c shows the script and config file, which tell the role apart
+    sampler = (
+        "while sleep 1; do\n"
+        "    t=$(date +%s)\n"
+        "    top -b -c -w 512 -n 1 | grep -E 'dist/esm/[A-Za-z]+[.]js' | sed \"s/^/$t /\"\n"
+        f"done > {package_dir}/{PROCESS_LOG}\n"
+    )
+    for server in deploy.SERVERS:
+        conn = deploy.connect(server, deploy.username, deploy.password)
+        try:
+            conn.put(StringIO(sampler), f"{package_dir}/node_sample.sh")
+            result = conn.sudo(
+                f"tmux new-session -d -s nodes 'sh {package_dir}/node_sample.sh'",
+                warn=True,
+            )
+            if result.failed:
+                raise RuntimeError(f"Failed to start the process sampler on {server}")
+        finally:
+            conn.close()
+
+
+def analyze(point_dir: Path, start: float, end: float) -> dict:
+    """Traffic into the root, CPU/memory and app latencies within the measurement window"""
+    root = deploy.CONTROLLER_SERVER.split(".")[0]
+    metrics = {"window_s": round(end - start, 1)}
+
+    # The window was taken here and the logs on the hosts, so everything is
+    # moved onto the root's clock
+    offsets = ClockOffsets.load(point_dir)
+    if offsets is not None:
+        start, end = offsets.local_to_reference(start), offsets.local_to_reference(end)
+        relative = [
+            offsets.relative(host, fit["t0"])
+            for host, fit in offsets.hosts.items()
+            if host != root
+        ]
+        if relative:
+            metrics["clock_offset_max_ms"] = round(max(map(abs, relative)) * 1000, 2)
+        metrics["clock_error_max_ms"] = round(
+            max(fit["error"] for fit in offsets.hosts.values()) * 1000, 2
+        )
+
+    per_second = point_dir / root / f"tcpdump_{root}.per_second.csv"
+    if per_second.exists():
+        packets = total = 0
+        with open(per_second, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                if start <= float(row["timestamp"]) < end:
+                    packets += int(row["packets"])
+                    total += int(row["bytes_sent"])
+        metrics["root_bytes"] = total
+        metrics["root_bytes_per_s"] = round(total / (end - start), 1)
+        metrics["root_packets_per_s"] = round(packets / (end - start), 2)
+
+    cpu_log = point_dir / root / CPU_LOG
+    if cpu_log.exists():
+        cpu, memory = [], []
+        with open(cpu_log, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 13 or not parts[0].isdigit():
+                    continue
+                if start <= int(parts[0]) < end:
+                    cpu.append(float(parts[9]))
+                    memory.append(memory_kib(parts[6]))
+        if cpu:
+            metrics["root_cpu_mean"] = round(sum(cpu) / len(cpu), 2)
+            metrics["root_cpu_max"] = max(cpu)
+            metrics["root_rss_max_kib"] = max(memory)
+
+    # CPU and memory of one process of each role, averaged over its processes
+    samples = []
+    for path in point_dir.glob(f"*/{PROCESS_LOG}"):
+        df = read_process_log(path)
+        if offsets is not None:
+            df["t"] = offsets.to_reference(path.parent.name, df["t"])
+        samples.append(df[(df["t"] >= start) & (df["t"] < end)])
+    samples = [df for df in samples if not df.empty]
+    if samples:
+        df = pd.concat(samples, ignore_index=True)
+        for role, per_role in df.groupby("role"):
+            metrics[f"{role}_cpu_mean"] = round(float(per_role["cpu"].mean()), 2)
+            peak = per_role.groupby("pid")["rss_kib"].max()
+            metrics[f"{role}_rss_max_kib"] = round(float(peak.mean()), 1)
+            metrics[f"{role}_processes"] = int(per_role["pid"].nunique())
+
+    # Ingress against egress of every tier, from all hosts' captures
+    topology_file = point_dir / reduction.TOPOLOGY_FILE
+    if deploy.with_vmb and topology_file.exists():
+        topology = load_topology(topology_file)
+        sources = reduction.link_sources(point_dir, topology)
+        traffic = reduction.link_traffic(point_dir, topology, offsets, sources)
+        if not traffic.empty:
+            tiers, _ = reduction.summarize(traffic, topology, start, end, sources)
+            counts = reduction.coverage(sources, topology)
+            metrics.update(reduction.metrics(tiers, counts))
+            reduction.node_reduction(traffic, topology).to_csv(
+                point_dir / reduction.REDUCTION_FILE, index=False
+            )
+
+    # Send to receive, subscription and report latencies per tier out of the node logs
+    logs = applog.parse_collect_dir(point_dir, start, end)
+    if logs:
+        metrics.update(applog.metrics(logs))
+    return metrics
+
+
+def run_point(point: Point, sweep: dict, sweep_dir: Path, entry: dict, setup: bool):
+    """Deploy, warm up, measure, collect and analyze one point"""
+    point_dir = sweep_dir / point.id
+    point_dir.mkdir(parents=True, exist_ok=True)
+
+    entry["step"] = "deploy"
+    apply_point(point, sweep)
+    entry["git_commit"] = git_commit()
+    entry["topology"] = deploy.TOPOLOGY.spec
+    entry["port_range"] = (
+        deploy.TOPOLOGY.port_range() if deploy.with_vmb else deploy.BASELINE_PORT_RANGE
+    )
+    entry["netem"] = netem.describe(deploy.impairments)
+    deploy.tracer.clear()
+    deploy.clocks.clear()
+    try:
+        run_step(
+            deploy.ssh_connect_and_setup if setup else deploy.ssh_connect_and_restart,
+            "deploy",
+        )
+    finally:
+        deploy.tracer.write(point_dir, "deploy")
+    # spares may have taken over hosts, and a quorum may have left some out
+    entry["topology"] = deploy.TOPOLOGY.spec
+    entry["replaced"] = dict(deploy.replaced)
+    entry["left_out"] = sorted(deploy.dropped)
+    with open(point_dir / reduction.TOPOLOGY_FILE, "w") as f:
+        json.dump(deploy.TOPOLOGY.spec, f, indent=4)
+
+    entry["step"] = "warmup"
+    start_cpu_sampler(deploy.with_vmb)
+    if sweep.get("sample_processes") and deploy.with_vmb:
+        start_process_samplers()
+    log(f"{point.id}: warming up for {point.warmup}s")
+    sleep(point.warmup)
+    entry["warm_start"] = bool(deploy.started_warm)
+    if deploy.warm_start and deploy.with_vmb and not deploy.started_warm:
+        # commissioned by now, later points of this topology start from it
+        failed = deploy.failed_servers(deploy.snapshot_storage())
+        log(
+            f"{point.id}: storage snapshot "
+            + (f"failed on {len(failed)} hosts" if failed else "saved")
+        )
+
+    entry["step"] = "measure"
+    entry["measure_start"] = time()
+    log(f"{point.id}: measuring for {point.duration}s")
+    sleep(point.duration)
+    entry["measure_end"] = time()
+
+    # Collecting stops every process first, which tears the point down
+    entry["step"] = "collect"
+    deploy.collect_dir = str(point_dir)
+    run_step(deploy.ssh_connect_and_get_logs, "collect")
+
+    entry["step"] = "analyze"
+    entry["metrics"] = analyze(point_dir, entry["measure_start"], entry["measure_end"])
+
+
+def configure(sweep: dict, user: str | None = None, local: bool = False):
+    """Set the deploy options of a sweep and the login for its hosts"""
+    deploy.local = local
+    deploy.collect_mode = sweep.get("collect", "aggregate")
+    deploy.capture_profile = sweep.get("capture", "matter")
+    deploy.policy = Policy(**sweep.get("policy", {}))
+    deploy.warm_start = sweep.get("warm_start", False)
+    if local:
+        deploy.username = getuser()
+        deploy.password = ""
+    else:
+        deploy.username = (
+            user or os.getenv("USERNAME") or input("Enter your username: ")
+        )
+        deploy.password = os.getenv("PASSWORD") or getpass("Enter your password: ")
+
+
+def run_sweep(
+    sweep: dict, out_dir: str | Path, max_attempts: int = 2, setup: bool = False
+):
+    """Run every point of a sweep that isn't done yet"""
+    sweep_dir = Path(out_dir) / sweep.get("name", "sweep")
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    with open(sweep_dir / "sweep.json", "w") as f:
+        json.dump(sweep, f, indent=4)
+    state = load_state(sweep_dir)
+    points = expand(sweep)
+
+    for i, point in enumerate(points):
+        entry = state.setdefault(
+            point.id, {"point": asdict(point), "status": "pending", "attempts": 0}
+        )
+        if entry["status"] == "done":
+            continue
+        if entry["attempts"] >= max_attempts:
+            log(f"{point.id}: skipped after {entry['attempts']} failed attempts")
+            continue
+
+        log(f"[{i + 1}/{len(points)}] {point.id}")
+        entry.update(status="running", attempts=entry["attempts"] + 1, error=None)
+        save_state(sweep_dir, state)
+        try:
+            run_point(point, sweep, sweep_dir, entry, setup)
+            entry["status"] = "done"
+            # Only the first deploy of a run needs to pull and build
+            setup = False
+            log(f"{point.id}: {entry['metrics']}")
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+            (sweep_dir / point.id / "error.txt").write_text(traceback.format_exc())
+            log(f"{point.id}: failed during {entry['step']}: {e}")
+            # Leave nothing running for the next point
+            deploy.run_headless(deploy.ssh_connect_and_stop)
+        save_state(sweep_dir, state)
+        write_results(sweep_dir, state)
+
+    done = sum(entry["status"] == "done" for entry in state.values())
+    log(f"{done} / {len(points)} points done, results in {sweep_dir / RESULTS_FILE}")
+    try:
+        store = ResultsStore()
+        log(f"Indexed {len(ingest_sweep(store, sweep_dir))} runs in {store.root}")
+        store.close()
+    except ImportError as e:
+        log(f"Not indexed: {e}")
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a parameter sweep")
+    parser.add_argument("sweep", help="Sweep file, see experiment.py")
+    parser.add_argument("-u", "--user", type=str, help="Username for SSH login")
+    parser.add_argument("--out", default=EXPERIMENTS_DIR)
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=2,
+        help="Give up on a point after this many failures",
+    )
+    parser.add_argument(
+        "--setup",
+        action="store_true",
+        help="Pull and build on the first deploy instead of just restarting",
+    )
+    parser.add_argument(
+        "-l",
+        "--local",
+        action="store_true",
+        help="Run on emulated hosts on this machine (needs root)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only list the points of the sweep"
+    )
+    args = parser.parse_args()
+
+    with open(args.sweep, "r") as f:
+        sweep = json.load(f)
+    if args.dry_run:
+        for point in expand(sweep):
+            print(point.id)
+        raise SystemExit(0)
+
+    if args.local and args.setup:
+        parser.error("--local can't --setup, build the checkout first")
+    configure(sweep, args.user, args.local)
+
+    run_sweep(sweep, args.out, max_attempts=args.max_attempts, setup=args.setup)
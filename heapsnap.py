@@ -0,0 +1,493 @@
+"""Scheduled V8 heap snapshots of the node processes and their growth.
+
+Processes of the selected roles start with --heapsnapshot-signal, each with a
+diagnostic dir of its own. A small script on every host signals them on
+wall-clock multiples of the interval, so all hosts snapshot at about the same
+moment. Collecting renames the snapshots to <session>.Heap.<date>.<time>...
+and downloads them with the logs.
+
+The analyzer reads a snapshot in chunks without loading the JSON text: the
+node and edge arrays go straight into numpy, and only the strings naming
+constructors are kept. It then builds the dominator tree and sums retained
+size by constructor, like the DevTools summary view. Summaries are cached in
+<snapshot>.summary.json, and successive snapshots of every process are diffed.
+
+    python heapsnap.py <collect dir>                 # growth per process and interval
+    python heapsnap.py <collect dir> --top 20 --csv growth.csv
+    python heapsnap.py --summary h3/vmb_level_2_1.Heap.20261019.120000.4242.0.001.heapsnapshot
+
+A snapshot pauses the process for a few seconds and needs about as much memory
+again while it's written.
+"""
+
+import argparse
+import csv
+import json
+import re
+import shlex
+import sys
+from pathlib import Path
+
+import numpy as np
+
+SIGNAL = "SIGUSR2"
+HEAP_DIR = "heap"
+DEFAULT_INTERVAL = 300
+SUFFIX = ".heapsnapshot"
+SUMMARY_SUFFIX = ".summary.json"
+CHUNK_SIZE = 8 << 20
+# <session>.Heap.<yyyymmdd>.<hhmmss>.<pid>.<tid>.<seq>.heapsnapshot
+NAME = re.compile(
+    r"^(?P<session>.+)\.Heap\.(?P<date>\d{8})\.(?P<time>\d{6})\.(?P<pid>\d+)\.\d+\.(?P<seq>\d+)\.heapsnapshot$"
+)
+BRACKET = re.compile(rb"[\[\]]")
+STRING = re.compile(rb'"((?:[^"\\]|\\.)*)"', re.S)
+# DevTools names for the nodes that aren't grouped by constructor
+TYPE_CLASSES = {"hidden": "(system)", "code": "(compiled code)"}
+# the GC roots, which retain the whole heap
+ROOT_CLASS = "(synthetic)"
+
+
+def node_options(diagnostic_dir: str) -> str:
+    """NODE_OPTIONS making a process write a snapshot on SIGNAL"""
+    return f"--heapsnapshot-signal={SIGNAL} --diagnostic-dir={diagnostic_dir}"
+
+
+def trigger_script(targets: list[tuple[str, str]], interval: int) -> str:
+    """sh script signalling the (script, config file) processes every interval
+
+    Only node itself matches, not the shell tmux runs it from, which the
+    signal would kill, and only in the script's own network namespace, so
+    emulated hosts don't signal each other's processes.
+    """
+    patterns = [
+        f"^node .*{re.escape(script)} --configFile {re.escape(config)}( |$)"
+        for script, config in targets
+    ]
+    return (
+        f"interval={interval}\n"
+        "while :; do\n"
+        "    sleep $((interval - $(date +%s) % interval))\n"
+        + "".join(
+            f"    pkill -{SIGNAL.removeprefix('SIG')} --ns $$ --nslist net -f -- {shlex.quote(pattern)}\n"
+            for pattern in patterns
+        )
+        + "done\n"
+    )
+
+
+class _Reader:
+    """Sequential access to the top level of a snapshot's JSON"""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = b""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        chunk = self.f.read(CHUNK_SIZE)
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def skip(self, chars: bytes = b" \t\r\n,"):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in chars:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def expect(self, char: bytes):
+        self.skip()
+        if self.buf[self.pos : self.pos + 1] != char:
+            raise ValueError(
+                f"Expected {char!r} at {self.buf[self.pos:self.pos + 40]!r}"
+            )
+        self.pos += 1
+
+    def next_key(self) -> str | None:
+        """Key of the next top-level value, None at the end of the object"""
+        self.skip()
+        if self.buf[self.pos : self.pos + 1] in (b"}", b""):
+            return None
+        while (match := STRING.match(self.buf, self.pos)) is None:
+            if not self.fill():
+                raise ValueError("Truncated snapshot")
+        self.pos = match.end()
+        self.expect(b":")
+        self.skip(b" \t\r\n")
+        return match[1].decode()
+
+    def read_json(self):
+        decoder = json.JSONDecoder()
+        while True:
+            text = self.buf[self.pos :].decode(errors="ignore")
+            try:
+                value, end = decoder.raw_decode(text)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            self.pos += len(text[:end].encode())
+            return value
+
+    def read_numbers(self) -> np.ndarray:
+        """A flat array of integers, parsed a chunk at a time"""
+        self.expect(b"[")
+        arrays = []
+        while True:
+            end = self.buf.find(b"]", self.pos)
+            if end >= 0:
+                arrays.append(self._parse(self.buf[self.pos : end]))
+                self.pos = end + 1
+                break
+            # up to the last complete number, the rest waits for the next chunk
+            cut = self.buf.rfind(b",", self.pos)
+            if cut > self.pos:
+                arrays.append(self._parse(self.buf[self.pos : cut]))
+                self.pos = cut + 1
+            if not self.fill():
+                raise ValueError("Truncated snapshot")
+        return np.concatenate(arrays)
+
+    @staticmethod
+    def _parse(text: bytes) -> np.ndarray:
+        text = text.strip(b" \t\r\n,")
+        if not text:
+            return np.empty(0, np.uint32)
+        return np.fromstring(text.decode(), dtype=np.int64, sep=",").astype(np.uint32)
+
+    def skip_value(self):
+        """Skip an array of numbers or nested arrays of numbers"""
+        depth = 0
+        while True:
+            match = BRACKET.search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("Truncated snapshot")
+                continue
+            self.pos = match.end()
+            depth += 1 if match[0] == b"[" else -1
+            if depth == 0:
+                return
+
+    def read_strings(self, wanted: set[int]) -> dict[int, str]:
+        self.expect(b"[")
+        strings, index = {}, 0
+        while True:
+            self.skip()
+            if self.buf[self.pos : self.pos + 1] == b"]":
+                self.pos += 1
+                return strings
+            while (match := STRING.match(self.buf, self.pos)) is None:
+                if not self.fill():
+                    raise ValueError("Truncated snapshot")
+            if index in wanted:
+                strings[index] = json.loads(b'"' + match[1] + b'"')
+            self.pos = match.end()
+            index += 1
+
+
+def read_snapshot(path: str | Path) -> dict:
+    """Nodes, edges and constructor names of a snapshot, streamed from disk"""
+    with open(path, "rb") as f:
+        reader = _Reader(f)
+        reader.fill()
+        reader.expect(b"{")
+        data = {}
+        while (key := reader.next_key()) is not None:
+            if key == "snapshot":
+                data["meta"] = reader.read_json()["meta"]
+            elif key in ("nodes", "edges"):
+                data[key] = reader.read_numbers()
+            elif key == "strings":
+                meta = data["meta"]
+                fields = meta["node_fields"]
+                types = meta["node_types"][0]
+                nodes = data["nodes"].reshape(-1, len(fields))
+                grouped = np.isin(
+                    nodes[:, fields.index("type")],
+                    [types.index("object"), types.index("native")],
+                )
+                wanted = set(np.unique(nodes[grouped, fields.index("name")]).tolist())
+                data["strings"] = reader.read_strings(wanted)
+            else:
+                reader.skip_value()
+    return data
+
+
+def dominators(succ_offsets, succ, pred_offsets, pred, n: int):
+    """Postorder from node 0 and immediate dominators (Cooper, Harvey, Kennedy)
+
+    Unreachable nodes are left out of the order and keep -1.
+    """
+    # plain lists index several times faster than numpy arrays from Python
+    so, sv = succ_offsets.tolist(), succ.tolist()
+    visited = bytearray(n)
+    order = []
+    visited[0] = 1
+    nodes, edges = [0], [so[0]]
+    while nodes:
+        v, e = nodes[-1], edges[-1]
+        end = so[v + 1]
+        while e < end and visited[sv[e]]:
+            e += 1
+        if e < end:
+            w = sv[e]
+            edges[-1] = e + 1
+            visited[w] = 1
+            nodes.append(w)
+            edges.append(so[w])
+        else:
+            nodes.pop()
+            edges.pop()
+            order.append(v)
+    del so, sv, visited
+
+    post = [-1] * n
+    for i, v in enumerate(order):
+        post[v] = i
+    idom = [-1] * n
+    idom[0] = 0
+    po, pv = pred_offsets.tolist(), pred.tolist()
+    changed = True
+    while changed:
+        changed = False
+        for v in reversed(order[:-1]):
+            new = -1
+            for p in pv[po[v] : po[v + 1]]:
+                if idom[p] == -1:
+                    continue
+                if new == -1:
+                    new = p
+                    continue
+                a, b = p, new
+                while a != b:
+                    while post[a] < post[b]:
+                        a = idom[a]
+                    while post[b] < post[a]:
+                        b = idom[b]
+                new = a
+            if idom[v] != new:
+                idom[v] = new
+                changed = True
+    return order, np.array(idom, np.int64)
+
+
+def summarize(path: str | Path) -> dict:
+    """Count, self size and retained size by constructor of a snapshot"""
+    data = read_snapshot(path)
+    meta = data["meta"]
+    node_fields, edge_fields = meta["node_fields"], meta["edge_fields"]
+    node_types, edge_types = meta["node_types"][0], meta["edge_types"][0]
+    nodes = data.pop("nodes").reshape(-1, len(node_fields))
+    edges = data.pop("edges").reshape(-1, len(edge_fields))
+    n = len(nodes)
+
+    edge_count = nodes[:, node_fields.index("edge_count")].astype(np.int64)
+    owner = np.repeat(np.arange(n, dtype=np.int64), edge_count)
+    edge_type = edges[:, edge_fields.index("type")]
+    target = edges[:, edge_fields.index("to_node")].astype(np.int64) // len(node_fields)
+    del edges
+    # weak edges don't retain, shortcuts only from the root (DevTools' rules)
+    essential = (edge_type != edge_types.index("weak")) & (
+        (edge_type != edge_types.index("shortcut")) | (owner == 0)
+    )
+    owner, target = owner[essential], target[essential]
+    succ_offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(owner, minlength=n), out=succ_offsets[1:])
+    by_target = np.argsort(target, kind="stable")
+    pred = owner[by_target]
+    pred_offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(target, minlength=n), out=pred_offsets[1:])
+    order, idom = dominators(succ_offsets, target, pred_offsets, pred, n)
+    del owner, target, pred, by_target
+
+    self_size = nodes[:, node_fields.index("self_size")].astype(np.int64)
+    retained, parent = self_size.tolist(), idom.tolist()
+    for v in order[:-1]:
+        retained[parent[v]] += retained[v]
+    del parent
+
+    # objects are grouped by constructor name, everything else by type
+    types = nodes[:, node_fields.index("type")].astype(np.int64)
+    names = nodes[:, node_fields.index("name")].astype(np.int64)
+    grouped = np.isin(types, [node_types.index("object"), node_types.index("native")])
+    offset = int(names.max(initial=0)) + 1
+    cls = np.where(grouped, names, offset + types)
+    reachable = idom >= 0
+
+    # retained size of the outermost object of a class on every dominator path
+    children = np.argsort(idom, kind="stable")
+    children = children[idom[children] >= 0]
+    children = children[children != 0]
+    child_offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(idom[children], minlength=n), out=child_offsets[1:])
+    cm, com, clm = children.tolist(), child_offsets.tolist(), cls.tolist()
+    on_path = {}
+    outer = {}
+    stack = [(0, False)]
+    while stack:
+        v, leaving = stack.pop()
+        c = clm[v]
+        if leaving:
+            on_path[c] -= 1
+            continue
+        if not on_path.get(c):
+            outer[c] = outer.get(c, 0) + retained[v]
+        on_path[c] = on_path.get(c, 0) + 1
+        stack.append((v, True))
+        stack.extend((w, False) for w in cm[com[v] : com[v + 1]])
+
+    counts = np.bincount(cls[reachable])
+    sizes = np.bincount(cls[reachable], weights=self_size[reachable])
+    strings = data["strings"]
+    classes = {}
+    for c in np.nonzero(counts)[0].tolist():
+        if c < offset:
+            name = strings.get(c, f"(string {c})")
+        else:
+            kind = node_types[c - offset]
+            name = TYPE_CLASSES.get(kind, f"({kind})")
+        entry = classes.setdefault(name, [0, 0, 0])
+        entry[0] += int(counts[c])
+        entry[1] += int(sizes[c])
+        entry[2] += int(outer.get(c, 0))
+    return {
+        "nodes": int(reachable.sum()),
+        "total": int(retained[0]),
+        "classes": classes,
+    }
+
+
+def load_summary(path: str | Path) -> dict:
+    """Summary of a snapshot, from its cache when that's newer than the snapshot"""
+    path = Path(path)
+    cache = path.with_name(path.name + SUMMARY_SUFFIX)
+    if cache.exists() and cache.stat().st_mtime >= path.stat().st_mtime:
+        with open(cache, "r") as f:
+            return json.load(f)
+    summary = summarize(path)
+    with open(cache, "w") as f:
+        json.dump(summary, f)
+    return summary
+
+
+def snapshots(collect_dir: str | Path) -> dict[str, list[tuple[str, Path]]]:
+    """Snapshots of every <host>/<session>, as (hh:mm:ss, path) in time order"""
+    found = {}
+    for path in Path(collect_dir).glob(f"*/*{SUFFIX}"):
+        match = NAME.match(path.name)
+        if match is None:
+            continue
+        key = f"{path.parent.name}/{match['session']}"
+        found.setdefault(key, []).append(
+            ((match["date"], match["time"], int(match["seq"])), path)
+        )
+    return {
+        key: [
+            (f"{t[1][:2]}:{t[1][2:4]}:{t[1][4:]}", path) for t, path in sorted(entries)
+        ]
+        for key, entries in sorted(found.items())
+    }
+
+
+def diff(before: dict, after: dict) -> list[tuple[str, int, int, int]]:
+    """(class, count, self size, retained size) changes, largest growth first"""
+    rows = []
+    for name in set(before["classes"]) | set(after["classes"]):
+        a = before["classes"].get(name, [0, 0, 0])
+        b = after["classes"].get(name, [0, 0, 0])
+        rows.append((name, b[0] - a[0], b[1] - a[1], b[2] - a[2]))
+    return sorted(rows, key=lambda row: -row[3])
+
+
+def _mb(size: float) -> str:
+    return f"{size / 1e6:+.2f} MB"
+
+
+def report(collect_dir: str | Path, top: int = 10, csv_path: str | None = None) -> str:
+    lines, rows = [], []
+    for key, entries in snapshots(collect_dir).items():
+        summaries, broken = [], []
+        for t, path in entries:
+            try:
+                summaries.append((t, load_summary(path)))
+            except ValueError:
+                # the process was stopped while writing it
+                broken.append(t)
+        if broken:
+            lines.append(f"{key}: skipped unreadable snapshots {', '.join(broken)}")
+        if not summaries:
+            continue
+        first, last = summaries[0][1], summaries[-1][1]
+        lines.append(
+            f"{key}: {len(summaries)} snapshots {summaries[0][0]} -> {summaries[-1][0]}, "
+            f"heap {first['total'] / 1e6:.1f} MB -> {last['total'] / 1e6:.1f} MB"
+        )
+        growth = {}
+        intervals = len(summaries) - 1
+        for (t0, a), (t1, b) in zip(summaries, summaries[1:]):
+            changes = diff(a, b)
+            lines.append(f"  {t0} -> {t1}  {_mb(b['total'] - a['total'])}")
+            shown = [row for row in changes if row[0] != ROOT_CLASS and row[3] > 0]
+            for name, count, size, kept in shown[:top]:
+                lines.append(f"    {_mb(kept):>12} {count:+9d}  {name[:60]}")
+            for name, count, size, kept in changes:
+                rows.append([key, t0, t1, name, count, size, kept])
+                if kept > 0 and name != ROOT_CLASS:
+                    grew = growth.setdefault(name, [0, 0])
+                    grew[0] += 1
+                    grew[1] += kept
+        # growing in every interval is what a leak looks like
+        suspects = sorted(
+            (kept, name)
+            for name, (times, kept) in growth.items()
+            if times == intervals and intervals > 1
+        )[::-1]
+        if suspects:
+            lines.append("  grew in every interval:")
+            for kept, name in suspects[:top]:
+                lines.append(f"    {_mb(kept):>12}  {name[:60]}")
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                [
+                    "process",
+                    "from",
+                    "to",
+                    "class",
+                    "count",
+                    "self_size",
+                    "retained_size",
+                ]
+            )
+            writer.writerows(rows)
+    return "\n".join(lines) if lines else f"No heap snapshots in {collect_dir}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diff collected V8 heap snapshots")
+    parser.add_argument(
+        "collect_dir", nargs="?", help="Directory get_logs collected into"
+    )
+    parser.add_argument("--top", type=int, default=10, help="Classes per interval")
+    parser.add_argument("--csv", help="Write every class change here")
+    parser.add_argument("--summary", help="Print the summary of one snapshot instead")
+    args = parser.parse_args()
+
+    if args.summary:
+        summary = load_summary(args.summary)
+        print(f"{summary['nodes']} reachable nodes, {summary['total'] / 1e6:.1f} MB")
+        by_retained = sorted(summary["classes"].items(), key=lambda kv: -kv[1][2])
+        for name, (count, size, kept) in by_retained[: args.top]:
+            print(
+                f"  {kept / 1e6:10.2f} MB {size / 1e6:10.2f} MB {count:9d}  {name[:60]}"
+            )
+    elif args.collect_dir:
+        print(report(args.collect_dir, args.top, args.csv))
+    else:
+        parser.print_usage()
+        sys.exit(1)
@@ -0,0 +1,278 @@
+"""Live CPU, memory and UDP traffic of every host for the deploy dashboard.
+
+A small stdlib sampler runs on each host over its SSH session and prints one
+JSON line per second: CPU and RSS of the node processes (from /proc) and the
+UDP bytes in and out on the run's ports. The bytes are counted by ip6tables
+and iptables rules in chains of the sampler's own (the tree talks IPv6), which
+are removed again when the session goes away; only if neither family can be
+set up, the interface counters of /proc/net/dev stand in, which include every
+other off-host packet. Reading /proc once a second and a
+few counters is all the load it puts on a VM.
+
+The dashboard keeps the last minute of every host and draws sparklines and
+fleet totals from it.
+"""
+
+import json
+import shlex
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass, field
+
+from invoke.watchers import StreamWatcher
+
+INTERVAL = 1.0
+HISTORY = 60
+# a host that hasn't reported for this long is shown as stale
+STALE_AFTER = 5.0
+SPARK = " .:-=+*#%@"
+
+SAMPLER = r"""
+import json, os, signal, subprocess, sys, time
+
+ranges, interval = json.loads(sys.argv[1]), float(sys.argv[2])
+chains = {"INPUT": "CS525_LIVE_IN", "OUTPUT": "CS525_LIVE_OUT"}
+ticks = os.sysconf("SC_CLK_TCK")
+page_kib = os.sysconf("SC_PAGE_SIZE") // 1024
+netns = os.readlink("/proc/self/ns/net")
+
+
+def iptables(tool, *args):
+    try:
+        return subprocess.run([tool, "-w", *args], capture_output=True, text=True)
+    except OSError:
+        return None
+
+
+def cleanup(tool):
+    for hook, chain in chains.items():
+        iptables(tool, "-D", hook, "-j", chain)
+        iptables(tool, "-F", chain)
+        iptables(tool, "-X", chain)
+
+
+def setup(tool):
+    cleanup(tool)
+    for hook, chain in chains.items():
+        result = iptables(tool, "-N", chain)
+        if result is None or result.returncode:
+            cleanup(tool)
+            return False
+        for low, high in ranges:
+            for side in ("--dport", "--sport"):
+                iptables(tool, "-A", chain, "-p", "udp", side, f"{low}:{high}", "-j", "RETURN")
+        iptables(tool, "-I", hook, "-j", chain)
+    return True
+
+
+def udp_bytes():
+    if counting:
+        # the same chains in both families, the tree talks IPv6
+        totals = [0, 0]
+        for tool in counting:
+            for i, chain in enumerate(chains.values()):
+                out = iptables(tool, "-nvxL", chain).stdout.splitlines()[2:]
+                totals[i] += sum(int(line.split()[1]) for line in out if line.strip())
+        return totals
+    rx = tx = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, values = line.split(":", 1)
+            if name.strip() != "lo":
+                values = values.split()
+                rx, tx = rx + int(values[0]), tx + int(values[8])
+    return [rx, tx]
+
+
+def node_processes():
+    usage = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                args = f.read().split(b"\0")
+            if not (args[0].endswith(b"node") and b"dist/esm/" in b" ".join(args[1:])):
+                continue
+            # emulated hosts share /proc, their network namespace tells them apart
+            if os.readlink(f"/proc/{pid}/ns/net") != netns:
+                continue
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/statm") as f:
+                rss = int(f.read().split()[1]) * page_kib
+        except OSError:
+            continue
+        usage[pid] = (int(fields[11]) + int(fields[12]), rss)
+    return usage
+
+
+signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+signal.signal(signal.SIGHUP, lambda *_: sys.exit(0))
+counting = [tool for tool in ("ip6tables", "iptables") if setup(tool)]
+try:
+    last, last_t = node_processes(), time.time()
+    while True:
+        time.sleep(interval)
+        usage, t = node_processes(), time.time()
+        cpu = sum(u - last[pid][0] for pid, (u, _) in usage.items() if pid in last)
+        rx, tx = udp_bytes()
+        sample = {
+            "t": t,
+            "cpu": round(cpu / ticks / (t - last_t) * 100, 1),
+            "rss_kib": sum(rss for _, rss in usage.values()),
+            "processes": len(usage),
+            "rx": rx,
+            "tx": tx,
+            "scope": "ports" if counting else "all",
+        }
+        last, last_t = usage, t
+        print(json.dumps(sample), flush=True)
+except (BrokenPipeError, KeyboardInterrupt):
+    pass
+finally:
+    for tool in counting:
+        cleanup(tool)
+"""
+
+
+def sampler_command(ranges: list[tuple[int, int]], interval: float = INTERVAL) -> str:
+    """Command (to run with sudo) streaming a host's samples until it's closed"""
+    return (
+        f"python3 -u -c {shlex.quote(SAMPLER)} "
+        f"{shlex.quote(json.dumps(ranges))} {interval}"
+    )
+
+
+def sparkline(values, width: int = HISTORY) -> str:
+    values = list(values)[-width:]
+    top = max(values, default=0)
+    if top <= 0:
+        return " " * len(values)
+    steps = len(SPARK) - 1
+    return "".join(SPARK[min(steps, round(v / top * steps))] for v in values)
+
+
+def human_bytes(n: float) -> str:
+    for unit in ["B", "K", "M", "G"]:
+        if abs(n) < 1024 or unit == "G":
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+@dataclass
+class HostSeries:
+    cpu: deque = field(default_factory=lambda: deque(maxlen=HISTORY))
+    rss_kib: deque = field(default_factory=lambda: deque(maxlen=HISTORY))
+    rx_rate: deque = field(default_factory=lambda: deque(maxlen=HISTORY))
+    tx_rate: deque = field(default_factory=lambda: deque(maxlen=HISTORY))
+    processes: int = 0
+    scope: str = "ports"
+    last: dict | None = None
+    updated: float = 0.0
+    error: str | None = None
+
+
+class LiveMetrics:
+    """The last minute of samples of every host"""
+
+    def __init__(self):
+        self.hosts: dict[str, HostSeries] = {}
+        self.lock = threading.Lock()
+
+    def add(self, host: str, sample: dict):
+        with self.lock:
+            series = self.hosts.setdefault(host, HostSeries())
+            last = series.last
+            if last is not None and sample["t"] > last["t"]:
+                dt = sample["t"] - last["t"]
+                # counters restart when the sampler does
+                series.rx_rate.append(max(0, sample["rx"] - last["rx"]) / dt)
+                series.tx_rate.append(max(0, sample["tx"] - last["tx"]) / dt)
+            series.cpu.append(sample["cpu"])
+            series.rss_kib.append(sample["rss_kib"])
+            series.processes = sample["processes"]
+            series.scope = sample["scope"]
+            series.last = sample
+            series.updated = time.time()
+            series.error = None
+
+    def error(self, host: str, message: str):
+        with self.lock:
+            self.hosts.setdefault(host, HostSeries()).error = message
+
+    def watcher(self, host: str) -> StreamWatcher:
+        metrics = self
+
+        class SampleWatcher(StreamWatcher):
+            """Feeds every complete line of the sampler's output to add()
+
+            Like deploy's output watcher, progress is tracked per reader
+            thread since stdout and stderr are submitted separately.
+            """
+
+            def __init__(self):
+                super().__init__()
+                self.seen = weakref.WeakKeyDictionary()
+
+            def submit(self, stream):
+                reader = threading.current_thread()
+                offset = self.seen.get(reader, 0)
+                end = stream.rfind("\n") + 1
+                if end > offset:
+                    for line in stream[offset:end].splitlines():
+                        try:
+                            metrics.add(host, json.loads(line))
+                        except (ValueError, KeyError):
+                            continue
+                    self.seen[reader] = end
+                return []
+
+        return SampleWatcher()
+
+    def row(self, host: str, now: float | None = None) -> str | None:
+        """One line of sparklines for a host, None before its first sample"""
+        now = now or time.time()
+        with self.lock:
+            series = self.hosts.get(host)
+            if series is None:
+                return None
+            if series.error:
+                return f"metrics: {series.error}"
+            if not series.cpu:
+                return None
+            stale = " STALE" if now - series.updated > STALE_AFTER else ""
+            udp = "udp" if series.scope == "ports" else "net"
+            rx = series.rx_rate[-1] if series.rx_rate else 0
+            tx = series.tx_rate[-1] if series.tx_rate else 0
+            return (
+                f"cpu {series.cpu[-1]:6.1f}% [{sparkline(series.cpu, 20)}] "
+                f"rss {human_bytes(series.rss_kib[-1] * 1024):>6} "
+                f"({series.processes} node) "
+                f"{udp} in {human_bytes(rx):>6}/s [{sparkline(series.rx_rate, 20)}] "
+                f"out {human_bytes(tx):>6}/s [{sparkline(series.tx_rate, 20)}]{stale}"
+            )
+
+    def totals(self, now: float | None = None) -> str:
+        """Fleet totals over the hosts that reported recently"""
+        now = now or time.time()
+        with self.lock:
+            fresh = [
+                series
+                for series in self.hosts.values()
+                if series.cpu and now - series.updated <= STALE_AFTER
+            ]
+            if not fresh:
+                return ""
+            cpu = sum(series.cpu[-1] for series in fresh)
+            rss = sum(series.rss_kib[-1] for series in fresh)
+            rx = sum(series.rx_rate[-1] for series in fresh if series.rx_rate)
+            tx = sum(series.tx_rate[-1] for series in fresh if series.tx_rate)
+            processes = sum(series.processes for series in fresh)
+            return (
+                f"Fleet ({len(fresh)}/{len(self.hosts)} hosts, {processes} node): "
+                f"cpu {cpu:.1f}% rss {human_bytes(rss * 1024)} "
+                f"in {human_bytes(rx)}/s out {human_bytes(tx)}/s"
+            )
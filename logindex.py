@@ -0,0 +1,278 @@
+"""Time and node indexes over the collected node logs.
+
+The VMBs log every attribute update they get (<nodeId>.<endpointId>.average10
+= ..., measuredValue, ...) and every "Recalculating aggregates" tick, so the
+logs of a run are large and finding what one node reported in a few seconds
+means reading all of them. Indexing a log once memory-maps it and writes
+<log>.idx next to it with
+
+    sparse    (timestamp, byte offset) of the first line every 64 KiB
+    postings  byte offsets of every line about an entity: <nodeId>.<endpointId>
+              on the VMBs, the child name on the root, "aggregates" for the ticks
+
+A time range then maps to a byte range through the sparse index, an entity to
+its postings inside that range, and only those regions are read. Indexes are
+rebuilt when the log changed since.
+
+    python logindex.py <collect dir> build
+    python logindex.py <collect dir> entities
+    python logindex.py <collect dir> query --entity 4.2 --start 1760000100 --end 1760000160
+    python logindex.py <collect dir> query --log h2/vmb_level_1 --start 1760000100
+
+Timestamps are epoch seconds on the root's clock when the collect dir has
+clock_offsets.json, and the hosts' own clocks otherwise.
+"""
+
+import argparse
+import bisect
+import json
+import mmap
+import re
+from pathlib import Path
+
+from applog import HEAD, TIME, UPDATE, Clock, log_tier
+from clocks import ClockOffsets
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+STRIDE = 64 << 10
+TICK = "aggregates"
+
+LINE = re.compile(TIME, re.M)
+ENTRY = re.compile(
+    TIME + HEAD + rb"(?:" + UPDATE + rb"|(?P<tick>Recalculating aggregates))", re.M
+)
+ESCAPES = re.compile(rb"\x1b\[[0-9;]*m")
+
+
+def entity_of(key: bytes) -> str:
+    """4.2 out of 4.2.average10, vmb-1 out of vmb-1.temperature"""
+    return key.decode().rsplit(".", 1)[0]
+
+
+def _map(path: Path):
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LogIndex:
+    """Sparse time index and entity postings of one node log"""
+
+    def __init__(self, path: str | Path, data: dict):
+        self.path = Path(path)
+        self.size = data["size"]
+        self.mtime = data["mtime"]
+        self.times = [t for t, _ in data["sparse"]]
+        self.offsets = [offset for _, offset in data["sparse"]]
+        self.postings = {}
+        for entity, deltas in data["postings"].items():
+            offsets, offset = [], 0
+            for delta in deltas:
+                offset += delta
+                offsets.append(offset)
+            self.postings[entity] = offsets
+        self._data = None
+
+    @staticmethod
+    def index_path(path: str | Path) -> Path:
+        path = Path(path)
+        return path.with_name(path.name + INDEX_SUFFIX)
+
+    @classmethod
+    def build(cls, path: str | Path, stride: int = STRIDE) -> "LogIndex":
+        path = Path(path)
+        stat = path.stat()
+        clock = Clock(path.parent.name, None)
+        sparse, postings = [], {}
+        data = _map(path)
+        try:
+            position, latest = 0, None
+            while (line := LINE.search(data, position)) is not None:
+                # a line logged late can't move the index backwards
+                t = clock(line["ts"], line["ms"])
+                latest = t if latest is None else max(latest, t)
+                sparse.append((latest, line.start()))
+                position = max(line.end(), line.start() + stride)
+            for entry in ENTRY.finditer(data):
+                entity = TICK if entry["tick"] else entity_of(entry["key"])
+                postings.setdefault(entity, []).append(entry.start())
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        data = {
+            "version": INDEX_VERSION,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sparse": sparse,
+            "postings": {
+                entity: [b - a for a, b in zip([0] + offsets, offsets)]
+                for entity, offsets in postings.items()
+            },
+        }
+        with open(cls.index_path(path), "w") as f:
+            json.dump(data, f)
+        return cls(path, data)
+
+    @classmethod
+    def open(cls, path: str | Path) -> "LogIndex":
+        """The index of a log, built first if it's missing or stale"""
+        path = Path(path)
+        index_path = cls.index_path(path)
+        if index_path.exists():
+            with open(index_path, "r") as f:
+                data = json.load(f)
+            stat = path.stat()
+            if (
+                data.get("version") == INDEX_VERSION
+                and data["size"] == stat.st_size
+                and data["mtime"] == stat.st_mtime
+            ):
+                return cls(path, data)
+        return cls.build(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = _map(self.path)
+        return self._data
+
+    def region(self, start: float | None, end: float | None) -> tuple[int, int]:
+        """Byte range holding every line logged in [start, end)"""
+        low, high = 0, self.size
+        if start is not None:
+            i = bisect.bisect_left(self.times, start) - 1
+            low = self.offsets[i] if i >= 0 else 0
+        if end is not None:
+            i = bisect.bisect_right(self.times, end)
+            high = self.offsets[i] if i < len(self.offsets) else self.size
+        return low, high
+
+    def lines(
+        self,
+        start: float | None = None,
+        end: float | None = None,
+        entity: str | None = None,
+    ):
+        """Yield (timestamp, line) of the lines in [start, end), all or an entity's"""
+        low, high = self.region(start, end)
+        clock = Clock(self.path.parent.name, None)
+        if entity is None:
+            t = None
+            for raw in self.data[low:high].splitlines():
+                raw = ESCAPES.sub(b"", raw)
+                line = LINE.match(raw)
+                if line is not None:
+                    t = clock(line["ts"], line["ms"])
+                # continuation lines go with the line before
+                if t is None or (start is not None and t < start):
+                    continue
+                if end is not None and t >= end:
+                    break
+                yield t, raw.decode(errors="replace")
+            return
+
+        offsets = self.postings.get(entity, [])
+        first = bisect.bisect_left(offsets, low)
+        last = bisect.bisect_left(offsets, high)
+        data = self.data
+        for offset in offsets[first:last]:
+            stop = data.find(b"\n", offset)
+            raw = data[offset : stop if stop >= 0 else self.size]
+            line = LINE.match(raw)
+            t = clock(line["ts"], line["ms"])
+            if (start is not None and t < start) or (end is not None and t >= end):
+                continue
+            yield t, ESCAPES.sub(b"", raw).decode(errors="replace")
+
+
+def node_logs(collect_dir: str | Path) -> list[Path]:
+    return [
+        path
+        for path in sorted(Path(collect_dir).glob("*/*.log"))
+        if log_tier(path.stem) is not None
+    ]
+
+
+def query(
+    collect_dir: str | Path,
+    start: float | None = None,
+    end: float | None = None,
+    entity: str | None = None,
+    log: str | None = None,
+):
+    """Yield (timestamp, host/log, line) from every node log, or just one
+
+    start, end and the timestamps are on the root's clock if the collect dir
+    has clock offsets. Lines come log by log, each in time order.
+    """
+    collect_dir = Path(collect_dir)
+    offsets = ClockOffsets.load(collect_dir)
+    for path in node_logs(collect_dir):
+        name = f"{path.parent.name}/{path.stem}"
+        if log is not None and log not in (name, path.stem):
+            continue
+        host = path.parent.name
+        local_start, local_end = start, end
+        if offsets is not None:
+            # the host's clock reads relative() ahead of the root's
+            if start is not None:
+                local_start = start + offsets.relative(host, start)
+            if end is not None:
+                local_end = end + offsets.relative(host, end)
+        with LogIndex.open(path) as index:
+            if entity is not None and entity not in index.postings:
+                continue
+            for t, line in index.lines(local_start, local_end, entity):
+                if offsets is not None:
+                    t = offsets.to_reference(host, t)
+                yield t, name, line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index and query the node logs")
+    parser.add_argument("collect_dir", help="Directory get_logs collected into")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="(Re)build the index of every node log")
+    subparsers.add_parser("entities", help="Entities and their line counts per log")
+    query_parser = subparsers.add_parser("query", help="Lines in a time range")
+    query_parser.add_argument("--start", type=float, help="Epoch seconds")
+    query_parser.add_argument("--end", type=float, help="Epoch seconds")
+    query_parser.add_argument(
+        "--entity", help=f"<nodeId>.<endpointId>, a child name or {TICK}"
+    )
+    query_parser.add_argument("--log", help="Only this log (<host>/<name> or <name>)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for path in node_logs(args.collect_dir):
+            index = LogIndex.build(path)
+            print(
+                f"{path}: {len(index.offsets)} sparse entries, "
+                f"{len(index.postings)} entities"
+            )
+    elif args.command == "entities":
+        for path in node_logs(args.collect_dir):
+            with LogIndex.open(path) as index:
+                if not index.postings:
+                    continue
+                print(f"{path.parent.name}/{path.stem}:")
+                for entity, offsets in sorted(index.postings.items()):
+                    print(f"  {entity:<24} {len(offsets)}")
+    else:
+        for t, name, line in query(
+            args.collect_dir, args.start, args.end, args.entity, args.log
+        ):
+            print(f"{t:.3f} {name} {line}")
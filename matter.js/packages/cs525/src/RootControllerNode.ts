@@ -24,6 +24,8 @@ import path from 'path';
 
 Logger.level = "info";
 const logger = Logger.get("RootController");
+// How long a reconnect to a stored south node may take before it is commissioned again
+const RECONNECT_TIMEOUT_MS = 30_000;
 
 const environment = Environment.default;
 
@@ -60,7 +62,7 @@ function readConfigFile(configFile: string): Config {
 class RootControllerNode {
     controller: CommissioningController | undefined = undefined;
 
-    async start(config: Config) {
+    async start(config: Config, reusable: (name: string) => boolean = () => false) {
         logger.info(`node-matter Controller started`);
 
         const controllerStorage = (await storageService.open("controller")).createContext("data");
@@ -87,14 +89,43 @@ class RootControllerNode {
         /** Start the Matter Controller Node */
         await commissioningController.start();
 
-        const promises = config.south.map(({ name, ip, port }) => {
+        // Node IDs of the south nodes by name, the reusable ones are reconnected to
+        const southNodes = await controllerStorage.get<Record<string, string>>("southNodes", {});
+        const commissioned = commissioningController.getCommissionedNodes();
+        const failed = new Array<string>();
+        const promises = config.south.map(async ({ name, ip, port }) => {
+            const known = southNodes[name] !== undefined ? NodeId(BigInt(southNodes[name])) : undefined;
+            if (known !== undefined && commissioned.includes(known)) {
+                if (reusable(name)) {
+                    logger.info(`Reusing commissioned node ${name} (${known})`);
+                    try {
+                        await withTimeout(this.pairNode(known, name), RECONNECT_TIMEOUT_MS, `Reconnecting ${name}`);
+                        return;
+                    } catch (error) {
+                        logger.warn(`Could not reconnect ${name} (${known}), commissioning it again: ${error}`);
+                    }
+                }
+                // The node was started with a new storage, forget the old pairing
+                await commissioningController.removeNode(known, false).catch(error => logger.warn(`Removing ${known}: ${error}`));
+                delete southNodes[name];
+            }
             return this.commissionAndPairNode({ name, ip, port, longDiscriminator: port, setupPin: parseInt(`${port}${port}`) })
+                .then(nodeId => {
+                    southNodes[name] = nodeId.toString();
+                })
                 .catch(error => {
                     logger.error(`Error commissioning node ${name}: ${error}`);
+                    failed.push(name);
                 });
         });
         // Wait until all commissioning/connecting is done
         await Promise.all(promises);
+        await controllerStorage.set("southNodes", southNodes);
+        // warmstart.py snapshots the storage on the marker below, so only a complete tree prints it
+        if (failed.length > 0) {
+            logger.error(`Failed to commission ${failed.length} of ${config.south.length} south nodes: ${failed.join(", ")}`);
+            return;
+        }
         console.log("All nodes commissioned and connected!");
     }
 
@@ -122,6 +153,7 @@ class RootControllerNode {
         }
         logger.debug(`Commissioning done for ${name}, assigned nodeID: ${nodeId}`);
         await this.pairNode(nodeId, name);
+        return nodeId;
     }
 
     async pairNode(nodeId: NodeId, name: string) {
@@ -207,21 +239,33 @@ class RootControllerNode {
     }
 }
 
+function withTimeout<T>(promise: Promise<T>, ms: number, what: string): Promise<T> {
+    let timer: ReturnType<typeof setTimeout> | undefined;
+    const timeout = new Promise<never>((_, reject) => {
+        timer = setTimeout(() => reject(new Error(`${what} timed out after ${ms} ms`)), ms);
+    });
+    return Promise.race([promise, timeout]).finally(() => clearTimeout(timer));
+}
+
 async function main() {
     const program = new Command();
     program.name("root");
 
     program
         .requiredOption("--configFile <file>")
-        .option("--storage-clear");
+        .option("--storage-clear")
+        // Stored south nodes are only reused when they kept their storage too
+        .option("--warm-start", "reuse every stored south node")
+        .option("--reuse-south <names>", "comma separated south nodes to reuse");
 
     program.parse(process.argv);
     const args = program.opts();
     const configFile = args.configFile;
     const config = readConfigFile(configFile);
+    const reusable = new Set<string>(args.reuseSouth ? args.reuseSouth.split(",") : []);
 
     const node = new RootControllerNode()
-    node.start(config).catch(error => logger.error(error));
+    node.start(config, name => args.warmStart || reusable.has(name)).catch(error => logger.error(error));
     // setInterval(() => {
     //     const totalIn = Object.entries(node.controller?.controllerInstance?.exchangeManager.transmissionMetadata || {}).reduce((acc, [key, value]) => {
     //         return acc + value;
@@ -47,6 +47,8 @@ const logger = Logger.get("VirtualMatterBrokerNode");
 Logger.level = "info";
 
 const NUM_DEVICES = 5;
+// How long a reconnect to a stored south node may take before it is commissioned again
+const RECONNECT_TIMEOUT_MS = 30_000;
 
 const environment = Environment.default;
 const storageService = environment.get(StorageService);
@@ -277,6 +279,40 @@ class VirtualMatterBrokerNode {
         return nodeId;
     }
 
+    // Reconnect to a south node commissioned before, if its stored node ID is still valid (reuse), or pair it
+    async reconnectOrPairNode(name: string, ip: string, port: number, longDiscriminator: number, setupPin: number, reuse: boolean): Promise<NodeId> {
+        const southNodes = await this.#controllerStorage.get<Record<string, string>>("southNodes", {});
+        if (southNodes[name] !== undefined) {
+            const nodeId = NodeId(BigInt(southNodes[name]));
+            const commissioned = this.#controller.getCommissionedNodes().includes(nodeId);
+            if (reuse && commissioned) {
+                logger.info(`Reusing commissioned node ${name} (${nodeId})`);
+                try {
+                    const node = await this.#controller.getNode(nodeId);
+                    if (!node.isConnected) {
+                        node.connect({ autoSubscribe: false });
+                    }
+                    if (!node.initialized) {
+                        await withTimeout(node.events.initialized, RECONNECT_TIMEOUT_MS, `Reconnecting ${name}`);
+                    }
+                    await this.onNodeCommission(nodeId);
+                    return nodeId;
+                } catch (error) {
+                    logger.warn(`Could not reconnect ${name} (${nodeId}), commissioning it again: ${error}`);
+                }
+            }
+            // The node was started with a new storage, forget the old pairing
+            if (commissioned) {
+                await this.#controller.removeNode(nodeId, false).catch(error => logger.warn(`Removing ${nodeId}: ${error}`));
+            }
+            delete southNodes[name];
+            await this.#controllerStorage.set("southNodes", southNodes);
+        }
+        const nodeId = await this.pairNode(ip, port, longDiscriminator, setupPin);
+        await this.#controllerStorage.set("southNodes", { ...southNodes, [name]: nodeId.toString() });
+        return nodeId;
+    }
+
     // Create a virtual node/endpoints (use Node Label) in the aggregator
     async onNodeCommission(nodeId: NodeId) {
         // Query the original node for all its endpoints
@@ -582,18 +618,30 @@ function readConfigFile(configFile: string): Config {
 }
 
 
+function withTimeout<T>(promise: Promise<T>, ms: number, what: string): Promise<T> {
+    let timer: ReturnType<typeof setTimeout> | undefined;
+    const timeout = new Promise<never>((_, reject) => {
+        timer = setTimeout(() => reject(new Error(`${what} timed out after ${ms} ms`)), ms);
+    });
+    return Promise.race([promise, timeout]).finally(() => clearTimeout(timer));
+}
+
 async function main() {
     const program = new Command();
     program.name("vmb");
     program
         .requiredOption("--configFile <file>")
-        .option("--storage-clear");
+        .option("--storage-clear")
+        // Stored south nodes are only reused when they kept their storage too
+        .option("--warm-start", "reuse every stored south node")
+        .option("--reuse-south <names>", "comma separated south nodes to reuse");
 
     program.parse(process.argv);
     const args = program.opts();
     const configFile = args.configFile;
     const config = readConfigFile(configFile);
     console.log({ config });
+    const reusable = new Set<string>(args.reuseSouth ? args.reuseSouth.split(",") : []);
 
     // Create a new instance of the VirtualMatterBrokerNode
     const vmb = new VirtualMatterBrokerNode();
@@ -612,12 +660,16 @@ async function main() {
     // Pair each node with the VMB
     for (const [index, { name, ip, port }] of config.south.entries()) {
         console.log(`Pairing node ${index} with name ${name} at ${ip}:${port}`);
-        const nodeId = await vmb.pairNode(ip, port, 
+        const nodeId = await vmb.reconnectOrPairNode(name, ip, port,
             port, // discriminator
-            parseInt(`${port}${port}`) // setup pin
+            parseInt(`${port}${port}`), // setup pin
+            args.warmStart || reusable.has(name),
         );
+        // applog.py maps the reports of this node (logged by node ID) back to its name
+        logger.info(`South node ${name} is node ${nodeId}`);
         await vmb.connectNode(nodeId);
     }
+    logger.info("All south nodes commissioned and connected");
 }
 
 await main();
@@ -0,0 +1,225 @@
+"""Network impairment (tc netem) per role or per link of the tree.
+
+An impairment spec maps targets to named profiles (or inline ones):
+
+    level_1=wan,link:endpoints=thread,root=delay=20/jitter=5/loss=1/rate=5000
+
+A role target (root, level_<n>, endpoints) impairs everything that role's
+processes send: replies from its own port and requests to its children's
+ports. A link target (link:level_<n>, link:endpoints) impairs both directions
+of the links between that tier and its parents, on both ends. Links are
+matched before roles. Delay, jitter, loss and rate apply per direction.
+
+Every host gets a prio qdisc on the interface holding its address and on lo
+(parents and children on the same host talk over lo), with one netem band per
+profile and flower filters on the UDP ports of the matching nodes. Stopping a
+host removes the qdiscs again, and only those with this module's handle. In
+the local emulation each namespace shapes its own interfaces.
+
+    python netem.py level_1=wan,link:endpoints=lossy   # rules of every host
+"""
+
+import argparse
+import shlex
+from dataclasses import asdict, dataclass
+
+from topology import DEFAULT_TOPOLOGY_FILE, Topology, load_topology
+
+# prio qdisc handle, marks the qdiscs this module added
+HANDLE = "525"
+# prio has 16 bands, the first carries everything else
+MAX_PROFILES = 15
+LINK_PREFIX = "link:"
+# the baseline's controller talks to its endpoints directly
+BASELINE_TARGETS = {"root", "endpoints", "link:endpoints"}
+
+
+@dataclass(frozen=True)
+class NetemProfile:
+    delay_ms: float = 0
+    jitter_ms: float = 0
+    loss_pct: float = 0
+    rate_kbit: int | None = None
+
+    def args(self) -> str:
+        """netem options, empty for a profile that changes nothing"""
+        options = []
+        if self.delay_ms or self.jitter_ms:
+            options.append(f"delay {self.delay_ms:g}ms")
+            if self.jitter_ms:
+                options[-1] += f" {self.jitter_ms:g}ms"
+        if self.loss_pct:
+            options.append(f"loss {self.loss_pct:g}%")
+        if self.rate_kbit:
+            options.append(f"rate {self.rate_kbit}kbit")
+        return " ".join(options)
+
+
+PROFILES = {
+    "lan": NetemProfile(),
+    "wifi": NetemProfile(delay_ms=5, jitter_ms=3, loss_pct=0.5),
+    "wan": NetemProfile(delay_ms=40, jitter_ms=10, loss_pct=0.5, rate_kbit=10000),
+    "lossy": NetemProfile(loss_pct=5),
+    # roughly a multi-hop 802.15.4 mesh
+    "thread": NetemProfile(delay_ms=20, jitter_ms=10, loss_pct=2, rate_kbit=250),
+}
+# inline profile keys
+FIELDS = {"delay": "delay_ms", "jitter": "jitter_ms", "loss": "loss_pct"}
+
+
+def parse_profile(text: str) -> NetemProfile:
+    """A profile name, or delay=<ms>/jitter=<ms>/loss=<%>/rate=<kbit>"""
+    if text in PROFILES:
+        return PROFILES[text]
+    values = {}
+    for part in text.split("/"):
+        key, _, value = part.partition("=")
+        try:
+            if key == "rate":
+                values["rate_kbit"] = int(value)
+            elif key in FIELDS:
+                values[FIELDS[key]] = float(value)
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(
+                f"Unknown profile '{text}', expected one of {', '.join(PROFILES)} "
+                "or delay=<ms>/jitter=<ms>/loss=<%>/rate=<kbit>"
+            ) from None
+    return NetemProfile(**values)
+
+
+def parse_spec(text: str, topology: Topology) -> dict[str, NetemProfile]:
+    """target: profile of an impairment spec, links first"""
+    impairments = {}
+    for entry in filter(None, (entry.strip() for entry in text.split(","))):
+        target, _, profile = entry.partition("=")
+        role = target.removeprefix(LINK_PREFIX)
+        level = topology.role_level(role)
+        if target.startswith(LINK_PREFIX) and level == 0:
+            raise ValueError("The root has no link above it, use link:level_1")
+        impairments[target] = parse_profile(profile)
+    if len(set(impairments.values())) > MAX_PROFILES:
+        raise ValueError(f"At most {MAX_PROFILES} different profiles per run")
+    return dict(
+        sorted(impairments.items(), key=lambda kv: not kv[0].startswith(LINK_PREFIX))
+    )
+
+
+def describe(impairments: dict[str, NetemProfile]) -> dict[str, dict]:
+    """JSON-friendly form, kept with the run"""
+    return {target: asdict(profile) for target, profile in impairments.items()}
+
+
+def _ranges(ports: set[int]) -> list[tuple[int, int]]:
+    ranges = []
+    for port in sorted(ports):
+        if ranges and ranges[-1][1] == port - 1:
+            ranges[-1] = (ranges[-1][0], port)
+        else:
+            ranges.append((port, port))
+    return ranges
+
+
+def host_rules(
+    topology: Topology,
+    server: str,
+    impairments: dict[str, NetemProfile],
+    baseline_ports: tuple[int, int] | None = None,
+) -> list[tuple[NetemProfile, str, tuple[int, int]]]:
+    """(profile, "src" or "dst", port range) a host's egress is matched on
+
+    baseline_ports: the baseline's endpoint ports, whose only parent is the
+    controller on the topology's root host.
+    """
+    rules = []
+    for target, profile in impairments.items():
+        link = target.startswith(LINK_PREFIX)
+        level = topology.role_level(target.removeprefix(LINK_PREFIX))
+        src, dst = set(), set()
+        if baseline_ports is not None:
+            endpoints = level == topology.depth + 1
+            on_root = server == topology.root
+            if endpoints and not on_root:
+                src.add(baseline_ports)
+            if (level == 0 or (link and endpoints)) and on_root:
+                dst.add(baseline_ports)
+        else:
+            # a link is its child's north side and its parent's south side
+            for instance in topology.levels[level]:
+                if instance.host == server and instance.port is not None:
+                    src.add((instance.port, instance.port))
+            parents = topology.levels[level - 1 if link else level]
+            for parent in parents:
+                if parent.host == server:
+                    dst.update(_ranges({child.port for child in parent.children}))
+        for direction, ranges in [("src", src), ("dst", dst)]:
+            merged = _ranges({p for low, high in ranges for p in range(low, high + 1)})
+            rules.extend((profile, direction, r) for r in merged)
+    return rules
+
+
+def _device_commands(device: str, rules: list) -> list[str]:
+    profiles = list(dict.fromkeys(profile for profile, _, _ in rules))
+    bands = max(3, len(profiles) + 1)
+    commands = [
+        f"tc qdisc del dev {device} root 2>/dev/null || true",
+        f"tc qdisc add dev {device} root handle {HANDLE}: prio bands {bands} "
+        f"priomap {' '.join(['0'] * 16)}",
+    ]
+    for i, profile in enumerate(profiles):
+        commands.append(
+            f"tc qdisc add dev {device} parent {HANDLE}:{i + 2:x} "
+            f"handle {HANDLE}{i:x}: netem {profile.args()}".rstrip()
+        )
+    # a filter priority belongs to one protocol
+    for i, (profile, direction, (low, high)) in enumerate(rules):
+        ports = str(low) if low == high else f"{low}-{high}"
+        for j, protocol in enumerate(["ipv6", "ip"]):
+            commands.append(
+                f"tc filter add dev {device} parent {HANDLE}: protocol {protocol} "
+                f"pref {2 * i + j + 1} flower ip_proto udp {direction}_port {ports} "
+                f"classid {HANDLE}:{profiles.index(profile) + 2:x}"
+            )
+    return commands
+
+
+def apply_command(address: str, rules: list) -> str:
+    """Shape the interface holding address and lo, replacing their root qdiscs"""
+    body = " && ".join(_device_commands('"$dev"', rules))
+    script = (
+        "set -e; "
+        f"dev=$(ip -o addr show | awk -v a={shlex.quote(address)} "
+        "'index($4, a \"/\") == 1 {print $2; exit}'); "
+        f'[ -n "$dev" ] || {{ echo "No interface has {address}" >&2; exit 1; }}; '
+        f'for dev in $(printf "%s\\n" "$dev" lo | sort -u); do {body}; done'
+    )
+    return f"sh -c {shlex.quote(script)}"
+
+
+def clear_command() -> str:
+    """Remove the qdiscs this module added, from every interface"""
+    script = (
+        "for dev in $(ip -o link show | awk -F': ' '{print $2}' | cut -d@ -f1); do "
+        f'tc qdisc show dev "$dev" root | grep -q "prio {HANDLE}:" '
+        '&& tc qdisc del dev "$dev" root; done; true'
+    )
+    return f"sh -c {shlex.quote(script)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the netem rules of a spec")
+    parser.add_argument("spec", help="e.g. level_1=wan,link:endpoints=lossy")
+    parser.add_argument("--topology", default=DEFAULT_TOPOLOGY_FILE)
+    args = parser.parse_args()
+
+    topology = load_topology(args.topology)
+    impairments = parse_spec(args.spec, topology)
+    for target, profile in impairments.items():
+        print(f"{target}: {profile.args() or 'no impairment'}")
+    for server in topology.servers:
+        rules = host_rules(topology, server, impairments)
+        if rules:
+            print(f"{server}:")
+            for profile, direction, (low, high) in rules:
+                print(f"  {direction} ports {low}-{high}: {profile.args()}")
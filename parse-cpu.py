@@ -1,46 +1,28 @@
 import sys
-import matplotlib.pyplot as plt
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python parse-cpu.py baseline_cpu_usage.txt vmb_cpu_usage.txt")
-        sys.exit(1)
-
-    cpu_file_baseline = sys.argv[1]
-    cpu_file_vmb = sys.argv[2]
-
-    with open(cpu_file_baseline, "r") as f:
-        lines_baseline = f.readlines()
-      
-    with open(cpu_file_vmb, "r") as f:
-        lines_vmb = f.readlines()
+def read_cpu_usage(cpu_file):
+    """(timestamp, cpu) of every sample in a cpu_usage log"""
+    with open(cpu_file, "r") as f:
+        lines = f.readlines()
 
     '''
     1746991569   14151 root      20   0   11.3g 163484  43776 S   0.0   4.4   0:03.61 node
     '''
-    cpu_usage_baseline = []
-    for line in lines_baseline:
-        parts = line.split()
-        if len(parts) < 13:
-            continue
-        if 'TIMESTAMP' in parts[0]:
-            continue
-        timestamp, pid, user, pr, ni, virt, res, shr, s, cpu, mem, time, command = parts
-        
-        cpu_usage_baseline.append((timestamp, cpu))
-    
-    cpu_usage_vmb = []
-    for line in lines_vmb:
+    cpu_usage = []
+    for line in lines:
         parts = line.split()
         if len(parts) < 13:
             continue
         if 'TIMESTAMP' in parts[0]:
             continue
         timestamp, pid, user, pr, ni, virt, res, shr, s, cpu, mem, time, command = parts
-        
-        cpu_usage_vmb.append((timestamp, cpu))
-      
-  
+
+        cpu_usage.append((timestamp, cpu))
+    return cpu_usage
+
+def plot_cpu_usage(cpu_usage_baseline, cpu_usage_vmb, out="cpu_usage.png", show=True):
+    import matplotlib.pyplot as plt
+
     # Plot the CPU usage and memory usage
     timestamps_vmb = [int(x[0]) for x in cpu_usage_vmb]
     cpu_vmb = [float(x[1]) for x in cpu_usage_vmb]
@@ -62,7 +44,7 @@ if __name__ == "__main__":
     timestamps_baseline = timestamps_baseline[:240]
     cpu_baseline = cpu_baseline[:240]
     average_baseline = average_baseline[:240]
-    
+
 
     plt.figure(figsize=(10, 5))
     plt.plot(timestamps_baseline, cpu_baseline, label="Baseline", color='sandybrown', linestyle=':', marker='x')
@@ -79,5 +61,19 @@ if __name__ == "__main__":
     plt.title("CPU Usage Over Time (Baseline vs VMB)")
     plt.legend()
     plt.grid()
-    plt.savefig("cpu_usage.png")
-    plt.show()
\ No newline at end of file
+    plt.savefig(out)
+    if show:
+        plt.show()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("Usage: python parse-cpu.py baseline_cpu_usage.txt vmb_cpu_usage.txt")
+        sys.exit(1)
+
+    cpu_usage_baseline = read_cpu_usage(argv[0])
+    cpu_usage_vmb = read_cpu_usage(argv[1])
+    plot_cpu_usage(cpu_usage_baseline, cpu_usage_vmb)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
-import pyshark
-import sys
-import pandas as pd
-import matplotlib.pyplot as plt
 import argparse
-import matplotlib.ticker as plticker
+from pcap_aggregate import capture_set
+from topology import BASELINE_PORT_RANGE, DEFAULT_TOPOLOGY_FILE, load_topology
+
+# pyshark, pandas and matplotlib take seconds to import, so only the
+# functions that need them do
+
+def extract_udp_packets(pcap_file, min_port, max_port):
+    import pandas as pd
+    import pyshark
 
-def extract_udp_packets(pcap_file, min_port=3000, max_port=3400):
     capture = pyshark.FileCapture(
         pcap_file,
         display_filter=f'udp.dstport >= {min_port} && udp.dstport <= {max_port}',
@@ -41,13 +44,38 @@ def process_data(df, interval=1.0):
     grouped["cumulative_throughput"] = grouped["throughput_bps"].cumsum()
     return grouped
 
-def plot_graphs(df):
+def process_aggregated(df, interval=1.0):
+    """Same columns as process_data, from a pcap_aggregate.py per-second table"""
+    grouped = df[["bucket", "bytes_sent"]].sort_values("bucket").reset_index(drop=True)
+    grouped["rel_time"] = grouped["bucket"] * interval
+    grouped["cumulative_bytes"] = grouped["bytes_sent"].cumsum()
+    grouped["throughput_bps"] = grouped["bytes_sent"] / interval
+    grouped["cumulative_throughput"] = grouped["throughput_bps"].cumsum()
+    return grouped
+
+def load_processed(path, min_port, max_port):
+    """Process a raw capture (with the rest of its rotated set), or load the per-second table aggregated on the host"""
+    import pandas as pd
+
+    if path.endswith(".csv"):
+        return process_aggregated(pd.read_csv(path))
+    df = pd.concat(
+        [extract_udp_packets(str(f), min_port, max_port) for f in capture_set(path)],
+        ignore_index=True
+    )
+    if df.empty:
+        return df
+    return process_data(df)
+
+def plot_graphs(df, min_port, max_port):
+    import matplotlib.pyplot as plt
+
     # Cumulative Bytes Sent
     plt.figure(figsize=(12, 6))
     plt.plot(df["rel_time"], df["cumulative_bytes"], label="Cumulative Bytes Sent")
     plt.xlabel("Time (s)")
     plt.ylabel("Bytes")
-    plt.title("Cumulative UDP Bytes Over Time (Ports 3000–3400)")
+    plt.title(f"Cumulative UDP Bytes Over Time (Ports {min_port}–{max_port})")
     plt.grid(True)
     plt.legend()
     plt.xlim(left=0)
@@ -61,7 +89,7 @@ def plot_graphs(df):
     plt.plot(df["rel_time"], df["cumulative_throughput"], label="Cumulative Throughput")
     plt.xlabel("Time (s)")
     plt.ylabel("Bytes/sec")
-    plt.title("UDP Throughput Over Time (Ports 3000–3400)")
+    plt.title(f"UDP Throughput Over Time (Ports {min_port}–{max_port})")
     plt.grid(True)
     plt.legend()
     plt.xlim(left=0)
@@ -70,6 +98,9 @@ def plot_graphs(df):
     plt.show()
 
 def plot_merged_graphs(baseline_df, vmb_df):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+
     # only graph between 110 and 180 seconds, shift graphs vertically to start at 0 cumulative bytes
     # baseline_df = baseline_df[(baseline_df["rel_time"] >= 110) & (baseline_df["rel_time"] <= 170)]
     # vmb_df = vmb_df[(vmb_df["rel_time"] >= 110) & (vmb_df["rel_time"] <= 170)]
@@ -125,24 +156,31 @@ def plot_merged_graphs(baseline_df, vmb_df):
     fig.tight_layout()
     plt.show()
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f"Usage: python {sys.argv[0]} <baseline_pcap> <vmb_pcap>")
-        sys.exit(1)
-
-    baseline_pcap = sys.argv[1]
-    baseline_df = extract_udp_packets(baseline_pcap, 5540, 5560)
-    if baseline_df.empty:
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plot baseline vs VMB traffic from two captures",
+                                     epilog="Either capture can also be a .per_second.csv from pcap_aggregate.py")
+    parser.add_argument("baseline_pcap")
+    parser.add_argument("vmb_pcap")
+    parser.add_argument("--topology", default=DEFAULT_TOPOLOGY_FILE, help="Topology of the VMB run, for its port range")
+    parser.add_argument("--min-port", type=int, help="VMB port range, default: the topology's")
+    parser.add_argument("--max-port", type=int, help="VMB port range, default: the topology's")
+    args = parser.parse_args(argv)
+
+    processed_baseline = load_processed(args.baseline_pcap, *BASELINE_PORT_RANGE)
+    if processed_baseline.empty:
         print("No matching UDP packets found.")
-        sys.exit(0)
+        return
 
-    vmb_pcap = sys.argv[2]
-    vmb_df = extract_udp_packets(vmb_pcap, 3000, 3400)
-    if vmb_df.empty:
+    min_port, max_port = load_topology(args.topology).port_range()
+    min_port = min_port if args.min_port is None else args.min_port
+    max_port = max_port if args.max_port is None else args.max_port
+    processed_vmb = load_processed(args.vmb_pcap, min_port, max_port)
+    if processed_vmb.empty:
         print("No matching UDP packets found.")
-        sys.exit(0)
+        return
 
-    processed_baseline = process_data(baseline_df)
-    processed_vmb = process_data(vmb_df)
-    # plot_graphs(processed)
+    # plot_graphs(processed_vmb, min_port, max_port)
     plot_merged_graphs(processed_baseline, processed_vmb)
+
+if __name__ == "__main__":
+    main()
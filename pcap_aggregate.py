@@ -0,0 +1,271 @@
+"""Aggregate UDP captures into compact per-second, per-flow and per-port tables.
+
+Uses only the standard library so it can run on the testbed hosts right after
+tcpdump stops, which means only the tables have to be downloaded:
+
+    python3 pcap_aggregate.py tcpdump_sp25-cs525-2501.pcap --min-port 3100 --max-port 3619
+
+Without the port range it is the VMB range of --topology (topology.py is only
+needed then).
+
+The per-second table matches what parse-pcap.py's process_data computes from
+the raw capture (buckets relative to the first packet whose UDP destination
+port is in range, bytes counted as original frame length, so header-only
+captures count the same). The per-flow-second table keeps every flow that
+touches the port range per interval, which reduction.py splits by tier.
+
+Captures rotated by tcpdump (tcpdump_x.pcap, tcpdump_x.pcap1, ... for -C and
+tcpdump_x.<time>.pcap for -G) are read as one capture.
+"""
+
+import argparse
+import csv
+import ipaddress
+import re
+import struct
+from collections import defaultdict
+from pathlib import Path
+
+# Link-layer header types written by tcpdump
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+IPV6_EXTENSION_HEADERS = {0, 43, 60}
+UDP = 17
+# <stem>[.<%Y%m%d%H%M%S>].pcap[<n>], as written by tcpdump -G/-C
+CAPTURE_NAME = re.compile(r"^(?P<stem>.+?)(?:\.(?P<time>\d{14}))?\.pcap(?P<n>\d*)$")
+
+
+def capture_sets(paths):
+    """Group capture files into rotated sets, each in capture order"""
+    sets = {}
+    for path in paths:
+        match = CAPTURE_NAME.match(Path(path).name)
+        if match is None:
+            raise ValueError(f"{path} doesn't look like a tcpdump capture")
+        key = str(Path(path).parent / match["stem"])
+        order = (match["time"] or "", int(match["n"] or 0))
+        sets.setdefault(key, []).append((order, str(path)))
+    return {stem: [path for _, path in sorted(files)] for stem, files in sets.items()}
+
+
+def capture_set(path):
+    """Every file of the rotated set a capture file belongs to"""
+    path = Path(path)
+    stem = CAPTURE_NAME.match(path.name)["stem"]
+    siblings = [
+        sibling
+        for sibling in path.parent.glob(f"{stem}*.pcap*")
+        if (match := CAPTURE_NAME.match(sibling.name)) and match["stem"] == stem
+    ]
+    return next(iter(capture_sets(siblings).values()))
+
+
+def read_packets(pcap_file):
+    """Yield (timestamp, frame length, linktype, packet bytes) from a pcap file"""
+    with open(pcap_file, "rb") as f:
+        header = f.read(24)
+        if len(header) < 24:
+            return
+        magic = header[:4]
+        if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+            endian = "<"
+        elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+            endian = ">"
+        else:
+            raise ValueError(f"{pcap_file} is not a pcap file (pcapng isn't supported)")
+        nanos = magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+        divisor = 1e9 if nanos else 1e6
+        linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+        record = struct.Struct(endian + "IIII")
+
+        while True:
+            head = f.read(16)
+            if len(head) < 16:
+                return
+            sec, frac, incl_len, orig_len = record.unpack(head)
+            data = f.read(incl_len)
+            if len(data) < incl_len:
+                # tcpdump was killed mid-write
+                return
+            yield sec + frac / divisor, orig_len, linktype, data
+
+
+def parse_udp(linktype, data):
+    """Return (src, dst, sport, dport) for a UDP packet, or None"""
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype, offset = struct.unpack("!H", data[12:14])[0], 14
+        while ethertype in (0x8100, 0x88A8):
+            ethertype, offset = (
+                struct.unpack("!H", data[offset + 2 : offset + 4])[0],
+                offset + 4,
+            )
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype, offset = struct.unpack("!H", data[14:16])[0], 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype, offset = struct.unpack("!H", data[0:2])[0], 20
+    elif linktype == LINKTYPE_RAW:
+        ethertype, offset = None, 0
+    elif linktype == LINKTYPE_NULL:
+        ethertype, offset = None, 4
+    else:
+        return None
+
+    if len(data) < offset + 1:
+        return None
+    version = data[offset] >> 4
+    if ethertype == 0x0800 or (ethertype is None and version == 4):
+        if len(data) < offset + 20:
+            return None
+        ihl = (data[offset] & 0x0F) * 4
+        if data[offset + 9] != UDP:
+            return None
+        src = ".".join(str(b) for b in data[offset + 12 : offset + 16])
+        dst = ".".join(str(b) for b in data[offset + 16 : offset + 20])
+        offset += ihl
+    elif ethertype == 0x86DD or (ethertype is None and version == 6):
+        if len(data) < offset + 40:
+            return None
+        next_header = data[offset + 6]
+        src = _ipv6(data[offset + 8 : offset + 24])
+        dst = _ipv6(data[offset + 24 : offset + 40])
+        offset += 40
+        while next_header in IPV6_EXTENSION_HEADERS and len(data) >= offset + 2:
+            next_header, length = data[offset], data[offset + 1]
+            offset += (length + 1) * 8
+        if next_header != UDP:
+            return None
+    else:
+        return None
+
+    if len(data) < offset + 4:
+        return None
+    sport, dport = struct.unpack("!HH", data[offset : offset + 4])
+    return src, dst, sport, dport
+
+
+def _ipv6(raw):
+    return str(ipaddress.IPv6Address(bytes(raw)))
+
+
+def aggregate(pcap_files, min_port, max_port, interval=1.0, per_flow_second=None):
+    """Aggregate one capture (or rotated set) into per-second, per-flow and per-port tables
+
+    If per_flow_second is a dict, the packets and bytes of every flow touching
+    the port range are also added to it per interval, keyed by
+    (interval start, src, dst, sport, dport).
+    """
+    if isinstance(pcap_files, (str, Path)):
+        pcap_files = [pcap_files]
+    per_second = defaultdict(lambda: [0, 0])
+    per_flow = defaultdict(lambda: [0, 0])
+    per_port = defaultdict(lambda: [0, 0, 0, 0])
+    start = None
+
+    packets = (packet for path in pcap_files for packet in read_packets(path))
+    for ts, length, linktype, data in packets:
+        udp = parse_udp(linktype, data)
+        if udp is None:
+            continue
+        src, dst, sport, dport = udp
+        flow = per_flow[(src, dst, sport, dport)]
+        flow[0] += 1
+        flow[1] += length
+        per_port[dport][0] += 1
+        per_port[dport][1] += length
+        per_port[sport][2] += 1
+        per_port[sport][3] += length
+
+        if per_flow_second is not None and (
+            min_port <= dport <= max_port or min_port <= sport <= max_port
+        ):
+            key = (int(ts // interval) * interval, src, dst, sport, dport)
+            counts = per_flow_second.setdefault(key, [0, 0])
+            counts[0] += 1
+            counts[1] += length
+
+        if min_port <= dport <= max_port:
+            if start is None:
+                start = ts
+            bucket = per_second[int((ts - start) // interval)]
+            bucket[0] += 1
+            bucket[1] += length
+
+    return start, dict(per_second), dict(per_flow), dict(per_port)
+
+
+def write_tables(pcap_files, out_dir, min_port, max_port, interval=1.0):
+    """Write <capture>.per_second.csv, .per_flow.csv, .per_flow_second.csv and .per_port.csv"""
+    if isinstance(pcap_files, (str, Path)):
+        pcap_files = [pcap_files]
+    per_flow_second = {}
+    start, per_second, per_flow, per_port = aggregate(
+        pcap_files, min_port, max_port, interval, per_flow_second
+    )
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stem = CAPTURE_NAME.match(Path(pcap_files[0]).name)["stem"]
+    written = []
+
+    path = out_dir / f"{stem}.per_second.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["bucket", "timestamp", "packets", "bytes_sent"])
+        for bucket in sorted(per_second):
+            packets, length = per_second[bucket]
+            writer.writerow([bucket, start + bucket * interval, packets, length])
+    written.append(path)
+
+    path = out_dir / f"{stem}.per_flow.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["src", "dst", "sport", "dport", "packets", "bytes"])
+        for key in sorted(per_flow, key=lambda k: -per_flow[k][1]):
+            writer.writerow([*key, *per_flow[key]])
+    written.append(path)
+
+    path = out_dir / f"{stem}.per_flow_second.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["timestamp", "src", "dst", "sport", "dport", "packets", "bytes"]
+        )
+        for key in sorted(per_flow_second):
+            writer.writerow([*key, *per_flow_second[key]])
+    written.append(path)
+
+    path = out_dir / f"{stem}.per_port.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["port", "packets_in", "bytes_in", "packets_out", "bytes_out"])
+        for port in sorted(per_port):
+            writer.writerow([port, *per_port[port]])
+    written.append(path)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pcap", nargs="+", help="Captures, rotated files are grouped")
+    parser.add_argument("--min-port", type=int, help="Default: the topology's range")
+    parser.add_argument("--max-port", type=int, help="Default: the topology's range")
+    parser.add_argument("--topology", help="Topology file (default: topology.json)")
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--out", default=".", help="Folder for the tables")
+    args = parser.parse_args()
+    if args.min_port is None or args.max_port is None:
+        from topology import DEFAULT_TOPOLOGY_FILE, load_topology
+
+        min_port, max_port = load_topology(
+            args.topology or DEFAULT_TOPOLOGY_FILE
+        ).port_range()
+        args.min_port = min_port if args.min_port is None else args.min_port
+        args.max_port = max_port if args.max_port is None else args.max_port
+
+    for pcap_files in capture_sets(args.pcap).values():
+        for path in write_tables(
+            pcap_files, args.out, args.min_port, args.max_port, args.interval
+        ):
+            print(path)
@@ -0,0 +1,139 @@
+"""Idempotent host provisioning.
+
+The state of a host (tmux, git safe.directory, ownership and ACLs of the
+shared /opt/matter folder, repo commit, node version, CPUs and memory) is
+gathered in a single remote call and cached in .host_facts.json. Only the
+steps whose desired state differs are run, batched into one sudo call, so a
+deploy to an already provisioned fleet costs one round-trip per host.
+
+    python provision.py          # show the cached facts of every host
+"""
+
+import json
+import shlex
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+FACTS_FILE = ".host_facts.json"
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class Step:
+    name: str
+    command: str
+    sudo: bool = True
+
+
+def facts_command(mp_dir: str, repo_dir: str) -> str:
+    """Shell snippet printing key=value facts about a host"""
+    return "; ".join(
+        [
+            "echo user=$(whoami)",
+            "command -v tmux >/dev/null && echo tmux=1 || echo tmux=0",
+            f"git config --global --get-all safe.directory 2>/dev/null | grep -qxF {repo_dir}"
+            " && echo safe_directory=1 || echo safe_directory=0",
+            f"stat -c 'mp_dir=%U:%G %a' {mp_dir} 2>/dev/null || echo mp_dir=",
+            f"echo mp_dir_acl=$(getfacl -pc {mp_dir} 2>/dev/null | grep '^default:')",
+            f"echo repo_commit=$(git -C {repo_dir} rev-parse HEAD 2>/dev/null)",
+            "echo node=$(node --version 2>/dev/null)",
+            "echo cpus=$(nproc)",
+            "echo mem_kib=$(awk '/^MemTotal/ {print $2}' /proc/meminfo)",
+            f"[ -d {repo_dir}/matter.js/packages/cs525/dist ] && echo built=1 || echo built=0",
+        ]
+    )
+
+
+def parse_facts(stdout: str) -> dict:
+    facts = {}
+    for line in stdout.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            facts[key.strip()] = value.strip()
+    owner, _, mode = facts.get("mp_dir", "").partition(" ")
+    facts["mp_dir_owner"], facts["mp_dir_mode"] = owner, mode
+    facts["mp_dir_acl"] = facts.get("mp_dir_acl", "").split()
+    for key in ["tmux", "safe_directory", "built"]:
+        facts[key] = facts.get(key) == "1"
+    for key in ["cpus", "mem_kib"]:
+        facts[key] = int(facts[key]) if facts.get(key, "").isdigit() else None
+    return facts
+
+
+def gather_facts(conn, mp_dir: str, repo_dir: str) -> dict:
+    """Everything provisioning needs to know about a host, in one round-trip"""
+    result = conn.run(facts_command(mp_dir, repo_dir), warn=True, hide=True)
+    facts = parse_facts(result.stdout)
+    facts["gathered"] = time.time()
+    return facts
+
+
+def plan(facts: dict, mp_dir: str, repo_dir: str, group: str) -> list[Step]:
+    """Steps needed to bring a host from its facts to the desired state"""
+    steps = []
+    if not facts["tmux"]:
+        steps.append(Step("install tmux", "dnf install -y tmux"))
+    if not facts["safe_directory"]:
+        steps.append(
+            Step(
+                "git safe.directory",
+                f"git config --global --add safe.directory {repo_dir}",
+                sudo=False,
+            )
+        )
+    if not facts["mp_dir_owner"]:
+        steps.append(Step(f"create {mp_dir}", f"mkdir -p {mp_dir}"))
+    if facts["mp_dir_owner"] != f"root:{group}":
+        steps.append(Step(f"change owner for {mp_dir}", f"chown root:{group} {mp_dir}"))
+    if facts["mp_dir_mode"] != "2775":
+        steps.append(Step(f"change permissions for {mp_dir}", f"chmod 2775 {mp_dir}"))
+    if f"default:group:{group}:rwx" not in facts["mp_dir_acl"]:
+        steps.append(
+            Step(
+                f"set default group ACL for {mp_dir}",
+                f"setfacl -d -m g:{group}:rwx {mp_dir}",
+            )
+        )
+    if "default:other::---" not in facts["mp_dir_acl"]:
+        steps.append(
+            Step(f"set default other ACL for {mp_dir}", f"setfacl -d -m o::0 {mp_dir}")
+        )
+    return steps
+
+
+def batch(steps: list[Step]) -> str:
+    """One shell script running the steps in order, naming the one that failed"""
+    return "; ".join(
+        f"{{ {step.command}; }} || {{ echo {shlex.quote('Failed to ' + step.name)} >&2; exit 1; }}"
+        for step in steps
+    )
+
+
+def load_cache(path: str | Path = FACTS_FILE) -> dict:
+    path = Path(path)
+    if path.exists():
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_facts(server: str, facts: dict, path: str | Path = FACTS_FILE):
+    with _cache_lock:
+        cache = load_cache(path)
+        cache[server] = facts
+        tmp = Path(f"{path}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=4)
+        tmp.replace(path)
+
+
+if __name__ == "__main__":
+    for server, facts in load_cache().items():
+        age = (time.time() - facts["gathered"]) / 60
+        print(
+            f"{server}: node {facts.get('node') or '-'}, "
+            f"commit {(facts.get('repo_commit') or '-')[:10]}, "
+            f"built {facts.get('built')}, gathered {age:.0f} min ago"
+        )
@@ -0,0 +1,395 @@
+"""Traffic reduction across the tiers of the VMB tree.
+
+Every host's capture is split into the links of the topology: a child (VMB or
+endpoint) listens on its own port and its parent talks to it from an
+ephemeral port, so a packet from (child ip, child port) to the parent's ip is
+a report going up the link, and one the other way is a request or ack going
+down. Each link is counted in the capture of the parent's host (what actually
+arrived), or the child's if the parent's is missing. A tier boundary (or VMB)
+with a link neither end captured is left out, its partial traffic would look
+like a reduction or an amplification.
+
+Per second this gives, for every VMB and the root, the bytes and packets it
+receives from its children against what it sends to its parent, and for every
+tier boundary (endpoints -> level N, ..., level 1 -> root) the traffic
+crossing it. The reduction of a VMB or tier is ingress / egress: above 1 the
+aggregation pays off, below 1 it amplifies.
+
+    python reduction.py experiments/fanout/vmb-f4x8-e10-d300-r0
+    python reduction.py <collect dir> --topology topology.json --out reduction.csv
+
+Reads the per_flow_second tables pcap_aggregate.py writes on the hosts, or the
+raw captures. The topology is the collect dir's topology.json (written by
+experiment.py) unless given.
+"""
+
+import argparse
+import ipaddress
+from pathlib import Path
+
+import pandas as pd
+
+from clocks import ClockOffsets
+from pcap_aggregate import aggregate, capture_sets
+from topology import DEFAULT_TOPOLOGY_FILE, Instance, Topology, load_topology
+
+TOPOLOGY_FILE = "topology.json"
+REDUCTION_FILE = "reduction.csv"
+
+
+def _ip(address: str) -> str:
+    return ipaddress.ip_address(address.split("%")[0]).compressed
+
+
+def tier_label(topology: Topology, level: int) -> str:
+    if level == 0:
+        return "root"
+    if level > topology.depth:
+        return "endpoints"
+    return f"level_{level}"
+
+
+def boundary_label(topology: Topology, level: int) -> str:
+    """Boundary the links of a level's children cross, e.g. endpoints->level_2"""
+    return f"{tier_label(topology, level)}->{tier_label(topology, level - 1)}"
+
+
+def links(topology: Topology) -> dict[tuple[str, int], Instance]:
+    """Every child instance by its (ip, port)"""
+    return {
+        (_ip(topology.hosts[instance.host]), instance.port): instance
+        for level in topology.levels[1:]
+        for instance in level
+    }
+
+
+def flow_seconds(host_dir: Path, min_port: int, max_port: int) -> pd.DataFrame:
+    """t, src, dst, sport, dport, packets, bytes of one host's capture"""
+    tables = list(host_dir.glob("*.per_flow_second.csv"))
+    if tables:
+        return pd.concat([pd.read_csv(path) for path in tables], ignore_index=True)
+    counts = {}
+    for pcap_files in capture_sets(host_dir.glob("*.pcap*")).values():
+        aggregate(pcap_files, min_port, max_port, per_flow_second=counts)
+    return pd.DataFrame(
+        [(*key, *value) for key, value in counts.items()],
+        columns=["timestamp", "src", "dst", "sport", "dport", "packets", "bytes"],
+    )
+
+
+def captured_hosts(collect_dir: str | Path) -> set[str]:
+    """Host folders of a collection holding a capture or its per-flow tables"""
+    return {
+        path.name
+        for path in Path(collect_dir).iterdir()
+        if path.is_dir()
+        and (any(path.glob("*.per_flow_second.csv")) or any(path.glob("*.pcap*")))
+    }
+
+
+def link_sources(
+    collect_dir: str | Path, topology: Topology
+) -> dict[Instance, str | None]:
+    """Host whose capture every link is counted in, None if neither end has one
+
+    The parent's capture saw what arrived, the child's is the fallback.
+    """
+    captured = captured_hosts(collect_dir)
+    sources = {}
+    for instance in links(topology).values():
+        parent, child = [
+            node.host.split(".")[0] for node in (instance.parent, instance)
+        ]
+        sources[instance] = next(
+            (host for host in (parent, child) if host in captured), None
+        )
+    return sources
+
+
+def coverage(sources: dict[Instance, str | None], topology: Topology) -> pd.DataFrame:
+    """Links and captured links of every tier boundary, lowest first"""
+    rows = []
+    for level in range(topology.depth + 1, 0, -1):
+        instances = [instance for instance in sources if instance.level == level]
+        captured = sum(sources[instance] is not None for instance in instances)
+        rows.append((boundary_label(topology, level), len(instances), captured))
+    return pd.DataFrame(rows, columns=["boundary", "links", "captured"]).set_index(
+        "boundary"
+    )
+
+
+def link_traffic(
+    collect_dir: str | Path,
+    topology: Topology,
+    offsets: ClockOffsets | None = None,
+    sources: dict[Instance, str | None] | None = None,
+) -> pd.DataFrame:
+    """Packets and bytes per second, link and direction
+
+    Columns: t, child, parent, level (of the child), direction (up/down),
+    packets, bytes. Timestamps are on the root's clock if offsets are given.
+    Links without a capture on either end are missing.
+    """
+    collect_dir = Path(collect_dir)
+    by_address = links(topology)
+    min_port, max_port = topology.port_range()
+    host_dirs = {path.name: path for path in collect_dir.iterdir() if path.is_dir()}
+    if sources is None:
+        sources = link_sources(collect_dir, topology)
+
+    wanted: dict[str, set] = {}
+    for instance, source in sources.items():
+        if source is not None:
+            wanted.setdefault(source, set()).add(instance)
+
+    rows = []
+    for host, instances in wanted.items():
+        if host not in host_dirs:
+            continue
+        flows = flow_seconds(host_dirs[host], min_port, max_port)
+        if flows.empty:
+            continue
+        if offsets is not None:
+            flows["timestamp"] = offsets.to_reference(host, flows["timestamp"])
+        for row in flows.itertuples(index=False):
+            src, dst = _ip(row.src), _ip(row.dst)
+            up = by_address.get((src, row.sport))
+            down = by_address.get((dst, row.dport))
+            for instance, direction, peer in ((up, "up", dst), (down, "down", src)):
+                if instance is None or instance not in instances:
+                    continue
+                if _ip(topology.hosts[instance.parent.host]) != peer:
+                    continue
+                rows.append(
+                    (
+                        int(row.timestamp),
+                        topology.name(instance),
+                        topology.name(instance.parent),
+                        instance.level,
+                        direction,
+                        row.packets,
+                        row.bytes,
+                    )
+                )
+                break
+    columns = ["t", "child", "parent", "level", "direction", "packets", "bytes"]
+    df = pd.DataFrame(rows, columns=columns)
+    return df.groupby(columns[:5], as_index=False)[["packets", "bytes"]].sum()
+
+
+def node_reduction(traffic: pd.DataFrame, topology: Topology) -> pd.DataFrame:
+    """Per second and VMB (and the root): ingress from children vs egress up
+
+    Columns: t, node, tier, in_packets, in_bytes, out_packets, out_bytes.
+    """
+    up = traffic[traffic["direction"] == "up"]
+    ingress = (
+        up.groupby(["t", "parent"])[["packets", "bytes"]]
+        .sum()
+        .rename(columns={"packets": "in_packets", "bytes": "in_bytes"})
+    )
+    egress = (
+        up.groupby(["t", "child"])[["packets", "bytes"]]
+        .sum()
+        .rename(columns={"packets": "out_packets", "bytes": "out_bytes"})
+    )
+    ingress.index.names = egress.index.names = ["t", "node"]
+    df = ingress.join(egress, how="outer").fillna(0).reset_index()
+    tiers = {
+        topology.name(instance): tier_label(topology, instance.level)
+        for level in topology.levels[: topology.depth + 1]
+        for instance in level
+    }
+    # endpoints only send, they're on the boundaries but not nodes here
+    df = df[df["node"].isin(tiers)].copy()
+    df.insert(2, "tier", df["node"].map(tiers))
+    return df.astype({c: "int64" for c in df.columns if c.startswith(("in_", "out_"))})
+
+
+def boundaries(traffic: pd.DataFrame, topology: Topology) -> pd.DataFrame:
+    """Per second and tier boundary: traffic going up into the tier above
+
+    Columns: t, boundary (e.g. endpoints->level_2), packets, bytes, and the
+    same for the down direction as down_packets, down_bytes.
+    """
+    labels = {
+        level: boundary_label(topology, level) for level in range(1, topology.depth + 2)
+    }
+    df = traffic.pivot_table(
+        index=["t", "level"],
+        columns="direction",
+        values=["packets", "bytes"],
+        aggfunc="sum",
+        fill_value=0,
+    )
+    df.columns = [
+        name if direction == "up" else f"down_{name}" for name, direction in df.columns
+    ]
+    for column in ["packets", "bytes", "down_packets", "down_bytes"]:
+        if column not in df:
+            df[column] = 0
+    df = df.reset_index()
+    df.insert(1, "boundary", df.pop("level").map(labels))
+    return df[["t", "boundary", "packets", "bytes", "down_packets", "down_bytes"]]
+
+
+def summarize(
+    traffic: pd.DataFrame,
+    topology: Topology,
+    start: float | None = None,
+    end: float | None = None,
+    sources: dict[Instance, str | None] | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Mean rates and reductions per boundary/tier and per node over [start, end)
+
+    With the link sources, boundaries and nodes with a link nobody captured
+    are left out, as their partial traffic would look like a reduction.
+    """
+    if start is not None:
+        traffic = traffic[traffic["t"] >= start]
+    if end is not None:
+        traffic = traffic[traffic["t"] < end]
+    if traffic.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    seconds = traffic["t"].max() - traffic["t"].min() + 1
+
+    per_boundary = boundaries(traffic, topology).groupby("boundary", sort=False)
+    tiers = per_boundary[["packets", "bytes", "down_packets", "down_bytes"]].sum()
+    tiers = (tiers / seconds).add_suffix("_per_s")
+    order = [
+        boundary_label(topology, level) for level in range(topology.depth + 1, 0, -1)
+    ]
+    tiers = tiers.reindex([b for b in order if b in tiers.index])
+    nodes = node_reduction(traffic, topology)
+    rates = tiers["bytes_per_s"].reindex(order)
+    if sources is not None:
+        counts = coverage(sources, topology).reindex(order)
+        rates = rates.where(counts["links"] == counts["captured"])
+        tiers = tiers[tiers.index.isin(rates.dropna().index)]
+        uncovered = {
+            topology.name(node)
+            for instance, source in sources.items()
+            if source is None
+            for node in (instance, instance.parent)
+        }
+        nodes = nodes[~nodes["node"].isin(uncovered)]
+    # what goes into a tier against what leaves it
+    below = rates.shift(1).reindex(tiers.index)
+    tiers["reduction"] = (below / tiers["bytes_per_s"]).round(2)
+
+    per_node = nodes.groupby(["node", "tier"], sort=False)[
+        ["in_packets", "in_bytes", "out_packets", "out_bytes"]
+    ].sum()
+    per_node = (per_node / seconds).add_suffix("_per_s")
+    # the root has nothing to send upstream
+    egress = per_node["out_bytes_per_s"].where(per_node["out_bytes_per_s"] > 0)
+    per_node["reduction"] = (per_node["in_bytes_per_s"] / egress).round(2)
+    # spread of the per-second ratio, seconds without egress left out
+    ratio = nodes[nodes["out_bytes"] > 0].assign(
+        ratio=lambda df: df["in_bytes"] / df["out_bytes"]
+    )
+    spread = ratio.groupby(["node", "tier"])["ratio"].quantile([0.1, 0.5, 0.9])
+    spread = spread.unstack().rename(columns=lambda q: f"ratio_p{round(q * 100)}")
+    per_node = per_node.join(spread.round(2))
+    return tiers, per_node.reset_index()
+
+
+def metrics(tiers: pd.DataFrame, counts: pd.DataFrame | None = None) -> dict:
+    """Flat reduction per tier for experiment results"""
+    result = {}
+    if counts is not None:
+        # share of every boundary's links that were captured
+        for boundary, row in counts.iterrows():
+            upper = boundary.split("->")[1]
+            result[f"{upper}_links_captured"] = round(
+                float(row["captured"] / max(row["links"], 1)), 3
+            )
+    for boundary, row in tiers.iterrows():
+        upper = boundary.split("->")[1]
+        result[f"{upper}_ingress_bytes_per_s"] = round(float(row["bytes_per_s"]), 1)
+        if pd.notna(row["reduction"]):
+            # reduction of the tier the traffic came up through
+            result[f"{boundary.split('->')[0]}_reduction"] = float(row["reduction"])
+    # from the endpoints up to the root, if both ends were fully captured
+    ends = [
+        b for b in tiers.index if b.startswith("endpoints->") or b.endswith("->root")
+    ]
+    if len(ends) == 2 and tiers.loc[ends[1], "bytes_per_s"] > 0:
+        result["tree_reduction"] = round(
+            float(
+                tiers.loc[ends[0], "bytes_per_s"] / tiers.loc[ends[1], "bytes_per_s"]
+            ),
+            2,
+        )
+    return result
+
+
+def report(
+    tiers: pd.DataFrame, per_node: pd.DataFrame, counts: pd.DataFrame | None = None
+) -> str:
+    lines = []
+    if counts is not None:
+        lines.append("Links captured on either end:")
+        for boundary, row in counts.iterrows():
+            left_out = "" if row["captured"] == row["links"] else "  (left out)"
+            lines.append(
+                f"  {boundary:<24} {row['captured']:>5}/{row['links']:<5}{left_out}"
+            )
+    if tiers.empty and per_node.empty:
+        return "\n".join(lines + ["No traffic on the topology's links"])
+    lines.append(
+        "Tier boundaries (up B/s, pkt/s; down B/s; reduction of the lower tier):"
+    )
+    for boundary, row in tiers.iterrows():
+        reduction = "" if pd.isna(row["reduction"]) else f"  x{row['reduction']:.2f}"
+        lines.append(
+            f"  {boundary:<24} {row['bytes_per_s']:>12.1f} {row['packets_per_s']:>9.1f}"
+            f" {row['down_bytes_per_s']:>12.1f}{reduction}"
+        )
+    lines.append("Nodes (in B/s, out B/s, reduction, per-second p10/p50/p90):")
+    for row in per_node.itertuples(index=False):
+        flag = "  amplifies" if row.reduction < 1 else ""
+        reduction = "-" if pd.isna(row.reduction) else f"x{row.reduction}"
+        spread = "/".join(
+            "-" if pd.isna(v) else f"{v:.2f}"
+            for v in (row.ratio_p10, row.ratio_p50, row.ratio_p90)
+        )
+        lines.append(
+            f"  {row.node:<40} {row.tier:<9} {row.in_bytes_per_s:>11.1f} "
+            f"{row.out_bytes_per_s:>11.1f} {reduction:<7} {spread}{flag}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Traffic reduction per tier boundary and VMB"
+    )
+    parser.add_argument("collect_dir", help="Directory get_logs collected into")
+    parser.add_argument(
+        "-t", "--topology", help=f"Topology of the run (default: its {TOPOLOGY_FILE})"
+    )
+    parser.add_argument("--start", type=float, help="Window start (epoch seconds)")
+    parser.add_argument("--end", type=float, help="Window end (epoch seconds)")
+    parser.add_argument(
+        "--out",
+        nargs="?",
+        const=REDUCTION_FILE,
+        help=f"Write the per-second, per-node table as CSV (default name {REDUCTION_FILE})",
+    )
+    args = parser.parse_args()
+
+    collect_dir = Path(args.collect_dir)
+    topology_file = args.topology or collect_dir / TOPOLOGY_FILE
+    if not Path(topology_file).exists():
+        topology_file = DEFAULT_TOPOLOGY_FILE
+    topology = load_topology(topology_file)
+    sources = link_sources(collect_dir, topology)
+    traffic = link_traffic(
+        collect_dir, topology, ClockOffsets.load(collect_dir), sources
+    )
+    tiers, per_node = summarize(traffic, topology, args.start, args.end, sources)
+    print(report(tiers, per_node, coverage(sources, topology)))
+    if args.out:
+        node_reduction(traffic, topology).to_csv(args.out, index=False)
+        print(f"Wrote {args.out}")
@@ -0,0 +1,99 @@
+"""Timeouts, retries and partial-failure policies for fleet deploys.
+
+A flaky SSH session or a registry hiccup during npm ci shouldn't fail a host,
+and one slow host shouldn't hold up the whole tree. Remote commands that fail
+with a transient error are retried with jittered exponential backoff, and a
+startup stage that is missing hosts (failed, timed out or straggling) is
+handled by a policy:
+
+    wait    every host has to come up, a failed host fails the deploy
+    quorum  go on once a fraction of the stage is up, leaving the rest out
+    spare   move the roles of a lost host to a spare from the topology
+"""
+
+import math
+import random
+import re
+import time
+from dataclasses import dataclass
+
+from invoke.exceptions import CommandTimedOut
+from paramiko.ssh_exception import (
+    AuthenticationException,
+    BadHostKeyException,
+    NoValidConnectionsError,
+    SSHException,
+)
+
+POLICIES = ["wait", "quorum", "spare"]
+
+# Raised by fabric/paramiko when the connection, not the command, went wrong
+TRANSIENT_ERRORS = (
+    TimeoutError,
+    ConnectionError,
+    EOFError,
+    NoValidConnectionsError,
+    SSHException,
+    CommandTimedOut,
+)
+# SSHExceptions a retry can't fix, a wrong password or key or a changed host key
+PERMANENT_ERRORS = (AuthenticationException, BadHostKeyException)
+# Output of commands that failed because of the network, not the code
+TRANSIENT_OUTPUT = re.compile(
+    r"ECONNRESET|ETIMEDOUT|EAI_AGAIN|ENOTFOUND|socket hang up|"
+    r"Could not resolve host|Connection (?:timed out|reset|refused)|"
+    r"early EOF|RPC failed|502 Bad Gateway|503 Service Unavailable"
+)
+
+
+@dataclass
+class Policy:
+    mode: str = "wait"
+    # fraction of a stage's hosts that have to be up for quorum to go on
+    quorum: float = 0.9
+    # seconds a stage may take before its missing hosts are given up on
+    stage_timeout: float = 900
+    # hosts slower than this times the fleet median of a phase are stragglers
+    straggler_factor: float = 3.0
+
+    def quorum_size(self, hosts: int) -> int:
+        return math.ceil(self.quorum * hosts)
+
+
+def backoff(attempt: int, base: float = 2.0, cap: float = 60.0) -> float:
+    """Seconds to sleep before retry number attempt + 1 (full jitter)"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def is_transient(result) -> bool:
+    """Whether a failed command looks like it could succeed when run again"""
+    return bool(TRANSIENT_OUTPUT.search(f"{result.stdout}\n{result.stderr}"))
+
+
+def retry(fn, attempts: int = 3, on_retry=None, base: float = 2.0, cap: float = 60.0):
+    """Call fn until it succeeds or fails for a reason retrying won't fix
+
+    fn runs a remote command with warn=True. Transient exceptions and failed
+    results with transient output are retried up to attempts times in total;
+    on_retry(attempt, reason, delay) is called before each retry.
+    """
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            result = fn()
+        except PERMANENT_ERRORS:
+            raise
+        except TRANSIENT_ERRORS as e:
+            if last:
+                raise
+            reason = (
+                str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+            )
+        else:
+            if last or not (getattr(result, "failed", False) and is_transient(result)):
+                return result
+            reason = TRANSIENT_OUTPUT.search(f"{result.stdout}\n{result.stderr}")[0]
+        delay = backoff(attempt, base, cap)
+        if on_retry:
+            on_retry(attempt + 1, reason, delay)
+        time.sleep(delay)
@@ -0,0 +1,546 @@
+"""Indexed store of experiment results.
+
+Every run is indexed in results/index.sqlite by its configuration, git commit,
+topology and time. Its time series (throughput per host, root CPU, the
+controller's byte counters, CPU and memory per node process) are stored as
+Parquet files next to the index, so comparing hundreds of runs never
+re-parses captures or logs:
+
+    python results.py ingest experiments/fanout
+    python results.py ingest-files --mode baseline baseline_cpu_usage.txt
+    python results.py list --mode vmb
+
+    store = ResultsStore()
+    runs = store.runs(mode="vmb", endpoints_per_node=20)
+    throughput = store.aligned(runs["run_id"], "throughput", "bytes")
+
+Parquet needs pyarrow (pip install pyarrow).
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import shutil
+import sqlite3
+import subprocess
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from clocks import ClockOffsets
+from pcap_aggregate import aggregate, capture_sets
+from topology import (
+    BASELINE_PORT_RANGE,
+    DEFAULT_TOPOLOGY_FILE,
+    Topology,
+    load_topology,
+)
+
+DEFAULT_STORE_DIR = "results"
+INDEX_FILE = "index.sqlite"
+SERIES_DIR = "series"
+# How hosts of the same series are combined when aligning runs
+SERIES_AGGREGATION = {
+    "throughput": "sum",
+    "cpu": "mean",
+    "counters": "max",
+    "processes": "sum",
+}
+# Per node process samples of every host, see experiment.start_process_samplers
+PROCESS_LOG = "node_usage.log"
+RUN_COLUMNS = [
+    "run_id",
+    "sweep",
+    "mode",
+    "fanout",
+    "endpoints_per_node",
+    "duration",
+    "repetition",
+    "netem",
+    "started",
+    "ended",
+    "git_commit",
+    "topology_hash",
+    "topology",
+    "metrics",
+    "source",
+    "indexed",
+]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    sweep TEXT,
+    mode TEXT,
+    fanout TEXT,
+    endpoints_per_node INTEGER,
+    duration REAL,
+    repetition INTEGER,
+    netem TEXT,
+    started REAL,
+    ended REAL,
+    git_commit TEXT,
+    topology_hash TEXT,
+    topology TEXT,
+    metrics TEXT,
+    source TEXT,
+    indexed REAL
+);
+CREATE INDEX IF NOT EXISTS runs_config
+    ON runs (mode, fanout, endpoints_per_node, duration, netem);
+CREATE INDEX IF NOT EXISTS runs_commit ON runs (git_commit);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS series (
+    run_id TEXT REFERENCES runs (run_id) ON DELETE CASCADE,
+    name TEXT,
+    path TEXT,
+    rows INTEGER,
+    start REAL,
+    end REAL,
+    PRIMARY KEY (run_id, name)
+);
+"""
+
+
+def _require_parquet():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "The results store keeps series as Parquet, install pyarrow "
+            "(pip install pyarrow)"
+        ) from None
+
+
+def git_commit(repo: str | Path = ".") -> str | None:
+    result = subprocess.run(
+        ["git", "-C", str(repo), "rev-parse", "HEAD"], capture_output=True, text=True
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def topology_hash(spec: dict | None) -> str | None:
+    if spec is None:
+        return None
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def memory_kib(value: str) -> float:
+    # top switches to m/g/t suffixes for large resident sizes
+    units = {"m": 1 << 10, "g": 1 << 20, "t": 1 << 30}
+    if value[-1].lower() in units:
+        return float(value[:-1]) * units[value[-1].lower()]
+    return float(value)
+
+
+def read_cpu_log(path: str | Path) -> pd.DataFrame:
+    """t, cpu, rss_kib from a top log like baseline_cpu_usage.txt"""
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 13 or not parts[0].isdigit():
+                continue
+            rows.append((int(parts[0]), float(parts[9]), memory_kib(parts[6])))
+    return pd.DataFrame(rows, columns=["t", "cpu", "rss_kib"])
+
+
+def process_role(command: str) -> str | None:
+    """Role of a node process (root, level_<n> or endpoints) from its command line"""
+    if "RootControllerNode" in command:
+        return "root"
+    if "MultiSensorDeviceNode" in command:
+        return "endpoints"
+    match = re.search(r"vmb_level_(\d+)_config", command)
+    if "VirtualMatterBrokerNode" in command and match:
+        return f"level_{match[1]}"
+    return None
+
+
+def read_process_log(path: str | Path) -> pd.DataFrame:
+    """t, pid, role, cpu, rss_kib from top -c samples of every node process"""
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 13 or not parts[0].isdigit():
+                continue
+            role = process_role(" ".join(parts[12:]))
+            if role is not None:
+                rows.append(
+                    (
+                        int(parts[0]),
+                        int(parts[1]),
+                        role,
+                        float(parts[9]),
+                        memory_kib(parts[6]),
+                    )
+                )
+    return pd.DataFrame(rows, columns=["t", "pid", "role", "cpu", "rss_kib"])
+
+
+def read_counters(path: str | Path) -> pd.DataFrame:
+    """t, bytes_in, bytes_out from a controller's results_*.txt"""
+    pattern = re.compile(r"^(\d+),\s*in (\d+),\s*out (\d+)")
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            match = pattern.match(line)
+            if match:
+                ms, bytes_in, bytes_out = (int(x) for x in match.groups())
+                rows.append((ms / 1000, bytes_in, bytes_out))
+    return pd.DataFrame(rows, columns=["t", "bytes_in", "bytes_out"])
+
+
+def read_throughput(path, min_port: int, max_port: int) -> pd.DataFrame:
+    """t, packets, bytes per second from a per_second table or a (rotated) capture"""
+    if isinstance(path, (str, Path)) and Path(path).suffix == ".csv":
+        df = pd.read_csv(path)
+        return pd.DataFrame(
+            {"t": df["timestamp"], "packets": df["packets"], "bytes": df["bytes_sent"]}
+        )
+    start, per_second, _, _ = aggregate(path, min_port, max_port)
+    rows = [
+        (start + bucket, packets, length)
+        for bucket, (packets, length) in sorted(per_second.items())
+    ]
+    return pd.DataFrame(rows, columns=["t", "packets", "bytes"])
+
+
+def detect_series(path: str | Path) -> str:
+    """Which series a loose result file holds"""
+    path = Path(path)
+    if path.suffix == ".csv" or ".pcap" in path.suffix:
+        return "throughput"
+    with open(path, "r") as f:
+        for line in f:
+            if re.match(r"^\d+,\s*in \d+", line):
+                return "counters"
+            if line.split() and line.split()[0].isdigit():
+                return "cpu"
+    raise ValueError(f"Don't know what kind of results {path} holds")
+
+
+class ResultsStore:
+    def __init__(self, root: str | Path = DEFAULT_STORE_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.root / INDEX_FILE)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Bring an index made by an older version up to the current schema"""
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(runs)")}
+        if "netem" not in columns:
+            # the netem spec of the run, "" for none, NULL if not recorded
+            with self.db:
+                self.db.execute("ALTER TABLE runs ADD COLUMN netem TEXT")
+                self.db.execute("DROP INDEX IF EXISTS runs_config")
+                self.db.execute(
+                    "CREATE INDEX runs_config ON runs "
+                    "(mode, fanout, endpoints_per_node, duration, netem)"
+                )
+
+    def close(self):
+        self.db.close()
+
+    def has_run(self, run_id: str) -> bool:
+        row = self.db.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,))
+        return row.fetchone() is not None
+
+    def add_run(self, run_id: str, meta: dict, series: dict[str, pd.DataFrame]):
+        """Index a run (replacing an earlier version) and store its series"""
+        _require_parquet()
+        series = {name: df for name, df in series.items() if not df.empty}
+        run_dir = self.root / SERIES_DIR / run_id
+        shutil.rmtree(run_dir, ignore_errors=True)
+        run_dir.mkdir(parents=True)
+        for name, df in series.items():
+            df.to_parquet(run_dir / f"{name}.parquet", index=False)
+
+        if meta.get("started") is None and series:
+            meta["started"] = float(min(df["t"].min() for df in series.values()))
+        if meta.get("ended") is None and series:
+            meta["ended"] = float(max(df["t"].max() for df in series.values()))
+        row = {column: meta.get(column) for column in RUN_COLUMNS}
+        row.update(run_id=run_id, indexed=time.time())
+        for column in ["topology", "metrics"]:
+            if row[column] is not None:
+                row[column] = json.dumps(row[column])
+        if isinstance(row["fanout"], list):
+            row["fanout"] = "x".join(str(n) for n in row["fanout"])
+
+        with self.db:
+            self.db.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+            self.db.execute(
+                f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(RUN_COLUMNS))})",
+                [row[column] for column in RUN_COLUMNS],
+            )
+            self.db.executemany(
+                "INSERT INTO series VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        name,
+                        str(Path(SERIES_DIR) / run_id / f"{name}.parquet"),
+                        len(df),
+                        float(df["t"].min()),
+                        float(df["t"].max()),
+                    )
+                    for name, df in series.items()
+                ],
+            )
+
+    def runs(self, **filters) -> pd.DataFrame:
+        """Runs matching every filter; a list value matches any of its items
+
+        store.runs(mode="vmb", fanout=["4x8", "2x16"], git_commit="6f16888...")
+        """
+        clauses, params = [], []
+        for column, value in filters.items():
+            if column not in RUN_COLUMNS:
+                raise ValueError(f"Unknown run column '{column}'")
+            if isinstance(value, (list, tuple, set, pd.Series)):
+                values = list(value)
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params += values
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return pd.read_sql_query(
+            f"SELECT * FROM runs {where} ORDER BY started", self.db, params=params
+        )
+
+    def series(self, run_id: str, name: str) -> pd.DataFrame:
+        _require_parquet()
+        row = self.db.execute(
+            "SELECT path FROM series WHERE run_id = ? AND name = ?", (run_id, name)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"Run '{run_id}' has no '{name}' series")
+        return pd.read_parquet(self.root / row[0])
+
+    def aligned(
+        self,
+        run_ids,
+        name: str,
+        column: str,
+        interval: float = 1.0,
+        host: str | None = None,
+    ) -> pd.DataFrame:
+        """One column per run, indexed by seconds since the run started
+
+        Hosts are combined with SERIES_AGGREGATION unless a host is picked.
+        """
+        how = SERIES_AGGREGATION.get(name, "mean")
+        columns = {}
+        for run_id in run_ids:
+            started = self.db.execute(
+                "SELECT started FROM runs WHERE run_id = ?", (run_id,)
+            ).fetchone()
+            df = self.series(run_id, name)
+            if host is not None and "host" in df:
+                df = df[df["host"] == host]
+            if df.empty:
+                continue
+            origin = started[0] if started and started[0] is not None else df["t"].min()
+            rel_time = ((df["t"] - origin) // interval) * interval
+            # several hosts share a bucket; first combine per bucket and host
+            keys = [rel_time, df["host"]] if "host" in df else [rel_time]
+            per_host = df.groupby(keys)[column].mean()
+            if "host" in df:
+                per_host = per_host.groupby(level=0).agg(how)
+            columns[run_id] = per_host
+        result = pd.DataFrame(columns)
+        result.index.name = "rel_time"
+        return result.sort_index()
+
+
+def point_series(point_dir: Path, min_port: int, max_port: int) -> dict:
+    """Series of one experiment point from its per-host collection folders
+
+    Timestamps are moved onto the root's clock when the point has clock offsets.
+    """
+    offsets = ClockOffsets.load(point_dir)
+    throughput, cpu, processes = [], [], []
+    for host_dir in sorted(p for p in point_dir.iterdir() if p.is_dir()):
+        tables = list(host_dir.glob("*.per_second.csv"))
+        captures = capture_sets(host_dir.glob("*.pcap*")).values()
+        for path in tables or captures:
+            df = read_throughput(path, min_port, max_port)
+            df.insert(0, "host", host_dir.name)
+            throughput.append(df)
+        for path in host_dir.glob("cpu_usage.log"):
+            df = read_cpu_log(path)
+            df.insert(0, "host", host_dir.name)
+            cpu.append(df)
+        for path in host_dir.glob(PROCESS_LOG):
+            df = read_process_log(path)
+            df.insert(0, "host", host_dir.name)
+            processes.append(df)
+    if offsets is not None:
+        for df in throughput + cpu + processes:
+            if not df.empty:
+                df["t"] = offsets.to_reference(df["host"].iloc[0], df["t"])
+    series = {}
+    if throughput:
+        series["throughput"] = pd.concat(throughput, ignore_index=True)
+    if cpu:
+        series["cpu"] = pd.concat(cpu, ignore_index=True)
+    if processes:
+        series["processes"] = pd.concat(processes, ignore_index=True)
+    return series
+
+
+def point_port_range(entry: dict) -> tuple[int, int]:
+    """Port range of a sweep point recorded before experiment.py kept it"""
+    if entry["point"]["mode"] == "baseline":
+        return BASELINE_PORT_RANGE
+    if entry.get("topology") is not None:
+        return Topology(entry["topology"]).port_range()
+    return load_topology().port_range()
+
+
+def ingest_sweep(
+    store: ResultsStore, sweep_dir: str | Path, force: bool = False
+) -> list[str]:
+    """Index every finished point of an experiment.py sweep"""
+    sweep_dir = Path(sweep_dir)
+    with open(sweep_dir / "state.json", "r") as f:
+        state = json.load(f)
+    added = []
+    for point_id, entry in state.items():
+        run_id = f"{sweep_dir.name}/{point_id}"
+        if entry["status"] != "done" or (store.has_run(run_id) and not force):
+            continue
+        min_port, max_port = entry.get("port_range") or point_port_range(entry)
+        started, ended = entry.get("measure_start"), entry.get("measure_end")
+        # the window was taken on the deploy machine, the series are on the root's clock
+        offsets = ClockOffsets.load(sweep_dir / point_id)
+        if offsets is not None and started is not None:
+            started = offsets.local_to_reference(started)
+            ended = offsets.local_to_reference(ended)
+        meta = {
+            **entry["point"],
+            "sweep": sweep_dir.name,
+            "started": started,
+            "ended": ended,
+            "git_commit": entry.get("git_commit"),
+            "topology": entry.get("topology"),
+            "topology_hash": topology_hash(entry.get("topology")),
+            "metrics": entry.get("metrics"),
+            "source": str(sweep_dir / point_id),
+        }
+        store.add_run(
+            run_id, meta, point_series(sweep_dir / point_id, min_port, max_port)
+        )
+        added.append(run_id)
+    return added
+
+
+def ingest_files(
+    store: ResultsStore,
+    files: list[str],
+    run_id: str | None = None,
+    mode: str | None = None,
+    commit: str | None = None,
+    min_port: int | None = None,
+    max_port: int | None = None,
+    topology_file: str | Path = DEFAULT_TOPOLOGY_FILE,
+) -> str:
+    """Index loose result files (top logs, results_*.txt, captures) as one run
+
+    Captures are counted on the baseline's ports for a baseline run and on the
+    topology's VMB range otherwise, unless a port is given.
+    """
+    run_id = run_id or Path(files[0]).stem
+    if min_port is None or max_port is None:
+        low, high = (
+            BASELINE_PORT_RANGE
+            if mode == "baseline"
+            else load_topology(topology_file).port_range()
+        )
+        min_port = low if min_port is None else min_port
+        max_port = high if max_port is None else max_port
+    readers = {
+        "cpu": read_cpu_log,
+        "counters": read_counters,
+        "throughput": lambda path: read_throughput(path, min_port, max_port),
+    }
+    captures = [path for path in files if ".pcap" in Path(path).suffix]
+    # a rotated capture is read as one, the rest file by file
+    sources = list(capture_sets(captures).values())
+    sources += [path for path in files if path not in captures]
+    series = {}
+    for source in sources:
+        name = detect_series(source[0] if isinstance(source, list) else source)
+        df = readers[name](source)
+        series[name] = pd.concat([series[name], df]) if name in series else df
+    meta = {
+        "mode": mode,
+        "git_commit": commit,
+        "source": ", ".join(str(Path(path)) for path in files),
+    }
+    store.add_run(run_id, meta, series)
+    return run_id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index and query experiment results")
+    parser.add_argument("--store", default=DEFAULT_STORE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="Index experiment.py sweeps")
+    ingest.add_argument("sweep_dir", nargs="+")
+    ingest.add_argument("--force", action="store_true", help="Re-index known runs")
+
+    files = subparsers.add_parser("ingest-files", help="Index loose files as one run")
+    files.add_argument("files", nargs="+")
+    files.add_argument("--run-id")
+    files.add_argument("--mode", choices=["baseline", "vmb"])
+    files.add_argument("--commit", help="Git commit the run was made with")
+    files.add_argument("--min-port", type=int, help="Default: by --mode")
+    files.add_argument("--max-port", type=int, help="Default: by --mode")
+    files.add_argument("--topology", default=DEFAULT_TOPOLOGY_FILE)
+
+    listing = subparsers.add_parser("list", help="List indexed runs")
+    listing.add_argument("--mode", choices=["baseline", "vmb"])
+    listing.add_argument("--sweep")
+    listing.add_argument("--netem", help='Impairment spec, "" for none')
+    listing.add_argument("--git-commit")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    if args.command == "ingest":
+        for sweep_dir in args.sweep_dir:
+            for run_id in ingest_sweep(store, sweep_dir, force=args.force):
+                print(run_id)
+    elif args.command == "ingest-files":
+        print(
+            ingest_files(
+                store,
+                args.files,
+                args.run_id,
+                args.mode,
+                args.commit,
+                args.min_port,
+                args.max_port,
+                args.topology,
+            )
+        )
+    else:
+        filters = {
+            "mode": args.mode,
+            "sweep": args.sweep,
+            "git_commit": args.git_commit,
+            "netem": args.netem,
+        }
+        runs = store.runs(**{k: v for k, v in filters.items() if v is not None})
+        columns = ["run_id", "mode", "fanout", "endpoints_per_node", "netem", "started"]
+        print(runs[columns].to_string(index=False))
+    store.close()
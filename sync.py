@@ -0,0 +1,204 @@
+"""Delta upload of the local checkout to the hosts.
+
+Instead of every host pulling from GitHub, the working tree here (tracked and
+untracked files git doesn't ignore, uncommitted changes included) is hashed
+into a manifest. Each host keeps the manifest of what it was last sent next to
+the source, so a deploy reads it in one round-trip, and only the files whose
+hash differs go out, in a single gzipped tar per host along with the list of
+files deleted since. Hosts that are in the same state share one archive.
+
+    python sync.py               # manifest of this checkout and a full upload's size
+"""
+
+import hashlib
+import io
+import json
+import os
+import shlex
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+from pathlib import Path, PurePosixPath
+
+MANIFEST_FILE = ".sync_manifest.json"
+DELETED_FILE = ".sync_deleted"
+ARCHIVE_FILE = ".sync.tar.gz"
+CHUNK_SIZE = 1 << 20
+COMPRESS_LEVEL = 6
+# Walked around when the checkout isn't a git repo
+SKIP_DIRS = {".git", "node_modules", "dist", "build", "__pycache__", "venv", ".venv"}
+# A change to one of these needs npm ci on the host
+INSTALL_FILES = {"package.json", "package-lock.json"}
+
+
+def local_files(root: str | Path) -> list[str]:
+    """Relative paths of every file worth sending, as git would see them"""
+    root = Path(root)
+    result = subprocess.run(
+        ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+        cwd=root,
+        capture_output=True,
+    )
+    if result.returncode == 0:
+        paths = result.stdout.decode().split("\0")
+    else:
+        paths = []
+        for directory, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+            base = Path(directory).relative_to(root)
+            paths.extend(str(PurePosixPath(base / name)) for name in files)
+    # tracked files deleted from the working tree are still listed
+    return sorted(path for path in paths if path and (root / path).is_file())
+
+
+def hash_file(path: str | Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(root: str | Path) -> dict[str, list]:
+    """path: [sha256, mode] of every file of the checkout"""
+    root = Path(root)
+    manifest = {}
+    for path in local_files(root):
+        mode = os.stat(root / path).st_mode
+        manifest[path] = [
+            hash_file(root / path),
+            0o755 if mode & stat.S_IXUSR else 0o644,
+        ]
+    return manifest
+
+
+def diff(local: dict, remote: dict) -> tuple[list[str], list[str]]:
+    """Files to send and files to delete to bring remote to local"""
+    changed = [path for path, entry in local.items() if remote.get(path) != entry]
+    deleted = [path for path in remote if path not in local]
+    return changed, deleted
+
+
+def needs_install(changed: list[str]) -> bool:
+    return any(PurePosixPath(path).name in INSTALL_FILES for path in changed)
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def make_archive(
+    root: str | Path, manifest: dict, changed: list[str], deleted: list[str]
+) -> bytes:
+    """gzipped tar of the changed files, the deleted list and the new manifest"""
+    root = Path(root)
+    buffer = io.BytesIO()
+    with tarfile.open(
+        fileobj=buffer,
+        mode="w:gz",
+        compresslevel=COMPRESS_LEVEL,
+        format=tarfile.PAX_FORMAT,
+    ) as tar:
+        for path in changed:
+            info = tar.gettarinfo(root / path, arcname=path)
+            # extracted as whoever deploys, whatever the owner is here
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            info.mode = manifest[path][1]
+            with open(root / path, "rb") as f:
+                tar.addfile(info, f)
+        if deleted:
+            _add_bytes(tar, DELETED_FILE, "\0".join(deleted).encode())
+        # only moved in place once everything else is
+        _add_bytes(
+            tar,
+            MANIFEST_FILE + ".new",
+            json.dumps(manifest, separators=(",", ":")).encode(),
+        )
+    return buffer.getvalue()
+
+
+def apply_command(remote_dir: str) -> str:
+    """Unpack the uploaded archive, delete what's gone and commit the manifest"""
+    return (
+        f"cd {shlex.quote(remote_dir)} && tar -xzf {ARCHIVE_FILE} && rm -f {ARCHIVE_FILE}"
+        f" && {{ [ ! -s {DELETED_FILE} ] || xargs -0 rm -f -- < {DELETED_FILE}; }}"
+        f" && rm -f {DELETED_FILE} && mv {MANIFEST_FILE}.new {MANIFEST_FILE}"
+    )
+
+
+class SourceSync:
+    """The manifest of one checkout and the archives built from it so far"""
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        self.lock = threading.Lock()
+        self._manifest = None
+        self.archives: dict[str, tuple[bytes, list[str]]] = {}
+
+    @property
+    def manifest(self) -> dict:
+        # every deploy thread asks, the tree is hashed once
+        with self.lock:
+            if self._manifest is None:
+                self._manifest = build_manifest(self.root)
+            return self._manifest
+
+    def archive(self, remote_text: str) -> tuple[bytes, list[str]]:
+        """Archive and changed files for a host whose manifest reads remote_text"""
+        key = hashlib.sha256(remote_text.encode()).hexdigest()
+        manifest = self.manifest
+        with self.lock:
+            if key not in self.archives:
+                try:
+                    remote = json.loads(remote_text) if remote_text.strip() else {}
+                except ValueError:
+                    remote = {}
+                changed, deleted = diff(manifest, remote)
+                archive = (
+                    make_archive(self.root, manifest, changed, deleted)
+                    if changed or deleted
+                    else b""
+                )
+                self.archives[key] = (archive, changed)
+            return self.archives[key]
+
+    def push(self, conn, remote_dir: str, timeout: float | None = None) -> list[str]:
+        """Bring a host's copy up to date, returns the files that changed
+
+        Raises RuntimeError with the host's last error line if that fails.
+        """
+        remote_dir = remote_dir.rstrip("/")
+        quoted = shlex.quote(remote_dir)
+        result = conn.run(
+            f"mkdir -p {quoted} && cat {quoted}/{MANIFEST_FILE} 2>/dev/null; true",
+            warn=True,
+            hide=True,
+            timeout=timeout,
+        )
+        archive, changed = self.archive(result.stdout)
+        if not archive:
+            return []
+        conn.put(io.BytesIO(archive), f"{remote_dir}/{ARCHIVE_FILE}")
+        result = conn.run(
+            apply_command(remote_dir), warn=True, hide=True, timeout=timeout
+        )
+        if result.failed:
+            errors = result.stderr.strip().splitlines()
+            raise RuntimeError(errors[-1] if errors else "unpacking failed")
+        return changed
+
+
+if __name__ == "__main__":
+    root = Path(sys.argv[1] if len(sys.argv) > 1 else ".")
+    source = SourceSync(root)
+    manifest = source.manifest
+    size = sum((root / path).stat().st_size for path in manifest)
+    archive, _ = source.archive("")
+    print(f"{len(manifest)} files, {size / 1e6:.1f} MB in {root.resolve()}")
+    print(f"Full upload to a new host: {len(archive) / 1e6:.1f} MB")
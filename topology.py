@@ -0,0 +1,515 @@
+"""Topology model for the VMB testbed.
+
+A topology declares the hosts, the fan-out of every tier and the number of
+endpoints per MultiSensorDeviceNode. Everything else (config files, ports,
+process layout and startup order) is derived from it.
+
+    python topology.py topology.json --fanout 4,8 --endpoints 20 --out configs/
+"""
+
+import argparse
+import json
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+
+DEFAULT_TOPOLOGY_FILE = Path(__file__).parent / "topology.json"
+DEFAULT_PORT_BASE = 3100
+# mDNS and the default Matter port are used by the controllers themselves
+RESERVED_PORTS = {5353, 5540}
+# Ports of the baseline's endnodes (startup.sh), which has no topology
+BASELINE_PORT_RANGE = (5540, 5560)
+
+
+# Compared by identity, parent and children would make equality recursive
+@dataclass(eq=False)
+class Instance:
+    """A single node in the hierarchy (root, VMB or endpoint)"""
+
+    host: str
+    level: int
+    index: int
+    local_index: int
+    port: int | None = None
+    parent: "Instance | None" = None
+    children: list["Instance"] = field(default_factory=list)
+
+
+@dataclass
+class Process:
+    """A node process started on a host"""
+
+    host: str
+    session: str
+    script: str
+    config: str
+    log: str
+    level: int
+    instances: list[Instance] = field(default_factory=list)
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return self.host, self.session
+
+
+class Topology:
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.hosts: dict[str, str] = dict(spec["hosts"])
+        self.root: str = spec["root"]
+        self.fanout: list[int] = list(spec["fanout"])
+        self.endpoints_per_node: int = spec["endpoints_per_node"]
+        self.depth = len(self.fanout)
+        if self.depth < 1:
+            raise ValueError("Topology needs at least one VMB tier")
+        if self.root not in self.hosts:
+            raise ValueError(f"Root host {self.root} is not in the host list")
+
+        tier_specs = list(spec.get("tiers", []))
+        tier_specs += [{}] * (self.depth - len(tier_specs))
+        if len(tier_specs) != self.depth:
+            raise ValueError(
+                f"{len(tier_specs)} tiers declared but fanout has {self.depth} entries"
+            )
+
+        self.root_instance = Instance(self.root, 0, 0, 1)
+        # levels[0] is the root, levels[1..depth] the VMB tiers and
+        # levels[depth + 1] the endpoints
+        self.levels: list[list[Instance]] = [[self.root_instance]]
+        port_base = spec.get("port_base", DEFAULT_PORT_BASE)
+        for level in range(1, self.depth + 2):
+            parents = self.levels[level - 1]
+            fanout = (
+                self.fanout[level - 1]
+                if level <= self.depth
+                else self.endpoints_per_node
+            )
+            if level <= self.depth:
+                tier = tier_specs[level - 1]
+                port_base = tier.get("port_base", port_base)
+                placement = self._place(tier, len(parents) * fanout, level)
+            else:
+                port_base = spec.get("endpoint_port_base", port_base)
+                # endpoints live on the same host as the VMB that owns them
+                placement = [
+                    (parent.host, parent.local_index)
+                    for parent in parents
+                    for _ in range(fanout)
+                ]
+
+            instances = []
+            for i, (host, local_index) in enumerate(placement):
+                parent = parents[i // fanout]
+                instance = Instance(host, level, i, local_index, port_base + i, parent)
+                parent.children.append(instance)
+                instances.append(instance)
+            self.levels.append(instances)
+            port_base = _next_hundred(port_base + len(instances))
+
+        self.check_ports()
+
+    def _place(self, tier: dict, count: int, level: int) -> list[tuple[str, int]]:
+        """Assign the instances of a tier to hosts, filling each host in order"""
+        hosts = tier.get("hosts")
+        if hosts is None:
+            hosts = [host for host in self.hosts if host != self.root]
+        for host in hosts:
+            if host not in self.hosts:
+                raise ValueError(f"Tier {level} host {host} is not in the host list")
+        per_host = tier.get("instances_per_host", -(-count // len(hosts)))
+        if per_host * len(hosts) < count:
+            raise ValueError(
+                f"Tier {level} needs {count} instances but {len(hosts)} hosts "
+                f"x {per_host} instances per host only fit {per_host * len(hosts)}"
+            )
+        return [(hosts[i // per_host], i % per_host + 1) for i in range(count)]
+
+    def check_ports(self):
+        """Make sure no two listeners share a host port and tiers don't overlap"""
+        seen = {}
+        ranges = []
+        for level in self.levels[1:]:
+            ports = [instance.port for instance in level]
+            ranges.append((min(ports), max(ports), level[0].level))
+            for instance in level:
+                if not 1024 <= instance.port <= 65535:
+                    raise ValueError(f"Port {instance.port} is out of range")
+                if instance.port in RESERVED_PORTS:
+                    raise ValueError(
+                        f"Port {instance.port} of level {instance.level} is reserved, "
+                        "move the tier with port_base/endpoint_port_base"
+                    )
+                key = (self.hosts[instance.host], instance.port)
+                if key in seen:
+                    raise ValueError(
+                        f"Port collision on {instance.host}:{instance.port} "
+                        f"between {self.name(seen[key])} and {self.name(instance)}"
+                    )
+                seen[key] = instance
+        ranges.sort()
+        for (_, high, level_a), (low, _, level_b) in zip(ranges, ranges[1:]):
+            if low <= high:
+                raise ValueError(
+                    f"Port ranges of level {level_a} and level {level_b} overlap"
+                )
+
+    @property
+    def vmb_levels(self) -> list[list[Instance]]:
+        return self.levels[1 : self.depth + 1]
+
+    @property
+    def servers(self) -> list[str]:
+        """Every host taking part in the topology, root first"""
+        servers = [self.root]
+        for level in self.levels[1:]:
+            for instance in level:
+                if instance.host not in servers:
+                    servers.append(instance.host)
+        return servers
+
+    def tier_hosts(self, level: int) -> list[str]:
+        return list(dict.fromkeys(instance.host for instance in self.levels[level]))
+
+    def host_levels(self, server: str) -> list[int]:
+        """Levels (0 = root) of the nodes running on a server"""
+        return [
+            level
+            for level in range(self.depth + 1)
+            if any(instance.host == server for instance in self.levels[level])
+        ]
+
+    def port_range(self) -> tuple[int, int]:
+        ports = [instance.port for level in self.levels[1:] for instance in level]
+        return min(ports), max(ports)
+
+    def capture_ports(self, server: str) -> list[tuple[int, int]]:
+        """Port ranges carrying the Matter traffic of a host's nodes
+
+        A node's own port covers the sessions it serves, the ports of its
+        parent and children those it opens from an ephemeral port.
+        """
+        ports = set()
+        for level in self.levels:
+            for instance in level:
+                if instance.host != server:
+                    continue
+                for node in [instance, instance.parent, *instance.children]:
+                    if node is not None and node.port is not None:
+                        ports.add(node.port)
+        ranges = []
+        for port in sorted(ports):
+            if ranges and ranges[-1][1] == port - 1:
+                ranges[-1] = (ranges[-1][0], port)
+            else:
+                ranges.append((port, port))
+        return ranges
+
+    def _suffixed(self, level: int) -> bool:
+        # the endpoint nodes read the leaf VMB configs, which are always numbered
+        hosts = self.tier_hosts(level)
+        return level == self.depth or len(self.levels[level]) > len(hosts)
+
+    def name(self, instance: Instance) -> str:
+        """Name of an instance as used in the south list of its parent"""
+        if instance.level == 0:
+            return "root"
+        if instance.level > self.depth:
+            parent = instance.parent
+            offset = instance.index - parent.children[0].index
+            return f"endpoint_{instance.host}_{parent.local_index}_{offset}"
+        if self._suffixed(instance.level):
+            return f"level_{instance.level}_vmb_{instance.host}_{instance.local_index}"
+        return f"level_{instance.level}_vmb_{instance.host}"
+
+    def config_file(self, instance: Instance) -> str:
+        if instance.level == 0:
+            return "root_config.json"
+        if self._suffixed(instance.level):
+            return f"vmb_level_{instance.level}_config_{instance.local_index}.json"
+        return f"vmb_level_{instance.level}_config.json"
+
+    def config(self, instance: Instance, exclude: set[str] = frozenset()) -> dict:
+        """Config file of a root or VMB, leaving out children on excluded hosts"""
+        south = [
+            {
+                "name": self.name(child),
+                "ip": self.hosts[child.host],
+                "port": child.port,
+            }
+            for child in instance.children
+            if child.host not in exclude
+        ]
+        if instance.level == 0:
+            return {"south": south}
+        return {
+            "north": {"ip": self.hosts[instance.host], "port": instance.port},
+            "south": south,
+        }
+
+    def configs_for(
+        self, server: str, exclude: set[str] = frozenset()
+    ) -> dict[str, dict]:
+        """All config files a server needs, keyed by file name"""
+        return {
+            self.config_file(instance): self.config(instance, exclude)
+            for level in self.levels[: self.depth + 1]
+            for instance in level
+            if instance.host == server
+        }
+
+    def processes_for(self, server: str) -> list[Process]:
+        return [
+            process
+            for stage in self.startup_stages()
+            for process in stage
+            if process.host == server
+        ]
+
+    def startup_stages(self) -> list[list[Process]]:
+        """Node processes grouped by startup order, endpoints first and root last"""
+        stages = []
+        leaf_vmbs = self.levels[self.depth]
+        stages.append(
+            [
+                Process(
+                    host=vmb.host,
+                    session=f"multiendnode_{vmb.local_index}",
+                    script="MultiSensorDeviceNode.js",
+                    config=self.config_file(vmb),
+                    log=f"multiendnode_{vmb.local_index}.log",
+                    level=self.depth + 1,
+                    instances=vmb.children,
+                )
+                for vmb in leaf_vmbs
+            ]
+        )
+        for level in range(self.depth, 0, -1):
+            stage = []
+            for vmb in self.levels[level]:
+                session = Path(self.config_file(vmb)).stem.replace("_config", "")
+                stage.append(
+                    Process(
+                        host=vmb.host,
+                        session=session,
+                        script="VirtualMatterBrokerNode.js",
+                        config=self.config_file(vmb),
+                        log=f"{session}.log",
+                        level=level,
+                        instances=[vmb],
+                    )
+                )
+            stages.append(stage)
+        stages.append(
+            [
+                Process(
+                    host=self.root,
+                    session="root",
+                    script="RootControllerNode.js",
+                    config=self.config_file(self.root_instance),
+                    log="root.log",
+                    level=0,
+                    instances=[self.root_instance],
+                )
+            ]
+        )
+        return stages
+
+    def startup_dependencies(
+        self, processes: list[Process] | None = None
+    ) -> dict[tuple[str, str], set[tuple[str, str]]]:
+        """Key of every process mapped to the keys of the processes it waits for
+
+        A VMB waits for the processes running its own children (the device
+        nodes on its host, or its VMBs one tier down) and the root for the
+        level 1 VMBs. Given a subset of the processes, like a scope, children
+        outside it are taken to be running.
+        """
+        if processes is None:
+            processes = [
+                process for stage in self.startup_stages() for process in stage
+            ]
+        owner = {
+            instance: process.key
+            for process in processes
+            for instance in process.instances
+        }
+        return {
+            process.key: {
+                owner[child]
+                for instance in process.instances
+                for child in instance.children
+                if child in owner
+            }
+            for process in processes
+        }
+
+    @property
+    def spares(self) -> dict[str, str]:
+        """Hosts (name -> ip) that can stand in for a failed one"""
+        return {
+            host: ip
+            for host, ip in self.spec.get("spares", {}).items()
+            if host not in self.hosts
+        }
+
+    def with_host_replaced(self, failed: str, spare: str) -> "Topology":
+        """Same topology with every role of a failed host moved to a spare"""
+        spec = json.loads(json.dumps(self.spec))
+        spec["hosts"] = {
+            (spare if host == failed else host): (
+                self.spares[spare] if host == failed else ip
+            )
+            for host, ip in spec["hosts"].items()
+        }
+        spec["spares"] = {
+            host: ip for host, ip in spec.get("spares", {}).items() if host != spare
+        }
+        if spec["root"] == failed:
+            spec["root"] = spare
+        for tier in spec.get("tiers", []):
+            if "hosts" in tier:
+                tier["hosts"] = [spare if h == failed else h for h in tier["hosts"]]
+        return Topology(spec)
+
+    def role_level(self, role: str) -> int:
+        """Level of a role: root, level_<n> or endpoints"""
+        if role == "root":
+            return 0
+        if role == "endpoints":
+            return self.depth + 1
+        match = re.fullmatch(r"level_(\d+)", role)
+        if match is None or not 1 <= int(match[1]) <= self.depth:
+            raise ValueError(
+                f"Unknown role '{role}', expected root, level_1..level_{self.depth} "
+                "or endpoints"
+            )
+        return int(match[1])
+
+    def scope(self, subtree: str | None = None, role: str | None = None) -> set:
+        """Instances of the level 1 subtree(s) on a host and/or of one role
+
+        subtree is a host (full or short name), optionally with :<n> to pick
+        one of several level 1 VMBs on it.
+        """
+        instances = [instance for level in self.levels for instance in level]
+        if subtree is not None:
+            host, _, local_index = subtree.partition(":")
+            roots = [
+                vmb
+                for vmb in self.levels[1]
+                if host in (vmb.host, vmb.host.split(".")[0])
+                and (not local_index or vmb.local_index == int(local_index))
+            ]
+            if not roots:
+                raise ValueError(f"No level 1 VMB on {subtree}")
+            instances = []
+            stack = list(roots)
+            while stack:
+                instance = stack.pop()
+                instances.append(instance)
+                stack.extend(instance.children)
+        if role is not None:
+            level = self.role_level(role)
+            instances = [instance for instance in instances if instance.level == level]
+        return set(instances)
+
+    def scoped_stages(self, scope: set) -> list[list[Process]]:
+        """Startup stages restricted to the processes running instances in scope"""
+        return [
+            [
+                process
+                for process in stage
+                if any(instance in scope for instance in process.instances)
+            ]
+            for stage in self.startup_stages()
+        ]
+
+    @staticmethod
+    def is_scope_top(process: Process, scope: set) -> bool:
+        """Whether the parent of a process keeps running outside the scope"""
+        parent = process.instances[0].parent
+        return parent is None or parent not in scope
+
+    def running_children(self, process: Process, scope: set) -> list[str]:
+        """South names of the children of a process left running outside the scope"""
+        return [
+            self.name(child)
+            for instance in process.instances
+            for child in instance.children
+            if child not in scope
+        ]
+
+    def vmb_vmb_mappings(self) -> list[dict[str, list[str]]]:
+        """Level 1 to level 2 host mappings in the legacy deploy.py shape"""
+        mappings = []
+        for vmb in self.levels[1]:
+            children = list(dict.fromkeys(child.host for child in vmb.children))
+            mappings.append({vmb.host: children})
+        return mappings
+
+    def summary(self) -> str:
+        lines = [f"root: {self.root}"]
+        for level in range(1, self.depth + 2):
+            instances = self.levels[level]
+            label = f"level {level}" if level <= self.depth else "endpoints"
+            lines.append(
+                f"{label}: {len(instances)} on {len(self.tier_hosts(level))} hosts, "
+                f"ports {instances[0].port}-{instances[-1].port}"
+            )
+        return "\n".join(lines)
+
+
+def _next_hundred(port: int) -> int:
+    return -(-port // 100) * 100
+
+
+def load_topology(
+    path: str | Path = DEFAULT_TOPOLOGY_FILE,
+    fanout: list[int] | None = None,
+    endpoints_per_node: int | None = None,
+) -> Topology:
+    """Load a topology file, optionally overriding the fan-out for scaling runs"""
+    with open(path, "r") as f:
+        spec = json.load(f)
+    if fanout is not None:
+        spec["fanout"] = fanout
+    if endpoints_per_node is not None:
+        spec["endpoints_per_node"] = endpoints_per_node
+    return Topology(spec)
+
+
+def write_configs(topology: Topology, out_dir: str | Path):
+    """Write every host's config files to out_dir/<host>/"""
+    for server in topology.servers:
+        for name, config in topology.configs_for(server).items():
+            path = Path(out_dir) / server.split(".")[0] / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(config, f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or render a topology")
+    parser.add_argument("file", nargs="?", default=DEFAULT_TOPOLOGY_FILE)
+    parser.add_argument("--fanout", help="Comma separated fan-out per VMB tier")
+    parser.add_argument("--endpoints", type=int, help="Endpoints per device node")
+    parser.add_argument("--out", help="Write the generated configs to this folder")
+    args = parser.parse_args()
+
+    topology = load_topology(
+        args.file,
+        fanout=[int(x) for x in args.fanout.split(",")] if args.fanout else None,
+        endpoints_per_node=args.endpoints,
+    )
+    print(topology.summary())
+    for i, stage in enumerate(topology.startup_stages()):
+        print(f"stage {i}: {', '.join(sorted({p.session for p in stage}))}")
+    graph = topology.startup_dependencies()
+    waits = [len(dependencies) for dependencies in graph.values() if dependencies]
+    print(
+        f"{len(graph)} processes, {len(waits)} wait for "
+        f"{min(waits, default=0)}-{max(waits, default=0)} others each"
+    )
+    if args.out:
+        write_configs(topology, args.out)
+        print(f"Configs written to {args.out}")
@@ -0,0 +1,277 @@
+"""Span tracing for fleet deploys.
+
+Every deploy phase (connect, setup, stop, git pull, npm ci, build, tcpdump,
+node start, startup waits) and every remote command is recorded as a span.
+Spans are written as plain JSON and as a Chrome trace-event file (open it in
+chrome://tracing or https://ui.perfetto.dev), and summarized as the fleet
+critical path plus the slowest host per phase:
+
+    python tracing.py traces/deploy_1746989092.json
+"""
+
+import functools
+import json
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+PHASE = "phase"
+COMMAND = "command"
+
+
+@dataclass
+class Span:
+    host: str
+    name: str
+    start: float
+    end: float
+    category: str = PHASE
+    # hosts a wait span was blocked on, used to follow the critical path
+    waits_on: list[str] = field(default_factory=list)
+    args: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer:
+    def __init__(self):
+        self.spans: list[Span] = []
+        # start time of the phases still running, per (host, phase)
+        self.active: dict[tuple[str, str], float] = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(
+        self,
+        host: str,
+        name: str,
+        category: str = PHASE,
+        waits_on: list[str] | None = None,
+        **args,
+    ):
+        start = time.time()
+        # waiting on other hosts isn't something a host can be slow at
+        tracked = category == PHASE and waits_on is None
+        if tracked:
+            with self.lock:
+                self.active[(host, name)] = start
+        try:
+            yield
+        finally:
+            span = Span(host, name, start, time.time(), category, waits_on or [], args)
+            with self.lock:
+                self.spans.append(span)
+                if tracked:
+                    self.active.pop((host, name), None)
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+            self.active.clear()
+
+    def stragglers(
+        self, factor: float = 3.0, min_samples: int = 3, min_elapsed: float = 10.0
+    ) -> dict[str, tuple[str, float, float]]:
+        """Hosts stuck in a phase for factor times the fleet median of that phase
+
+        Returns host -> (phase, elapsed, median) once at least min_samples
+        hosts have finished the phase.
+        """
+        now = time.time()
+        with self.lock:
+            durations: dict[str, list[float]] = {}
+            for span in self.spans:
+                if span.category == PHASE and not span.waits_on:
+                    durations.setdefault(span.name, []).append(span.duration)
+            active = dict(self.active)
+        result = {}
+        for (host, name), start in active.items():
+            done = durations.get(name, [])
+            if len(done) < min_samples:
+                continue
+            median = statistics.median(done)
+            elapsed = now - start
+            if elapsed > max(factor * median, min_elapsed):
+                result[host] = (name, elapsed, median)
+        return result
+
+    def phase(self, name: str):
+        """Decorator tracing a deploy step called as fn(conn, server, ...)"""
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(conn, server, *args, **kwargs):
+                with self.span(server, name):
+                    return fn(conn, server, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def write(self, out_dir: str | Path, name: str) -> tuple[Path, Path]:
+        """Write <name>.json (spans) and <name>.trace.json (Chrome trace events)"""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            spans = list(self.spans)
+
+        spans_path = out_dir / f"{name}.json"
+        with open(spans_path, "w") as f:
+            json.dump([asdict(span) for span in spans], f, indent=1)
+
+        trace_path = out_dir / f"{name}.trace.json"
+        with open(trace_path, "w") as f:
+            json.dump(chrome_trace(spans), f)
+        return spans_path, trace_path
+
+
+def load_spans(path: str | Path) -> list[Span]:
+    with open(path, "r") as f:
+        return [Span(**span) for span in json.load(f)]
+
+
+def chrome_trace(spans: list[Span]) -> dict:
+    """Chrome trace-event format: one process per host, phases and commands as threads"""
+    if not spans:
+        return {"traceEvents": []}
+    origin = min(span.start for span in spans)
+    hosts = list(dict.fromkeys(span.host for span in spans))
+    events = [
+        {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": host}}
+        for pid, host in enumerate(hosts)
+    ]
+    for span in spans:
+        events.append(
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "pid": hosts.index(span.host),
+                "tid": 0 if span.category == PHASE else 1,
+                "ts": (span.start - origin) * 1e6,
+                "dur": span.duration * 1e6,
+                "args": {**span.args, "waits_on": span.waits_on},
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def critical_path(spans: list[Span]) -> list[Span]:
+    """Chain of phases that determined when the last host finished
+
+    Walks back from the phase that ended last: through the previous phase on
+    the same host, or for a wait, through the phase that released it.
+    """
+    phases = sorted(
+        (span for span in spans if span.category == PHASE), key=lambda s: s.end
+    )
+    if not phases:
+        return []
+    slack = 1e-3
+    current = phases[-1]
+    path = [current]
+    # every span is visited once, so the walk ends even on overlapping phases
+    visited = {id(current)}
+    while True:
+        if current.waits_on:
+            candidates = [
+                span
+                for span in phases
+                if span.host in current.waits_on
+                and span.end <= current.end + slack
+                and not span.waits_on
+            ]
+        else:
+            # only phases that started before, the slack would let two
+            # phases ending within it pick each other
+            candidates = [
+                span
+                for span in phases
+                if span.host == current.host
+                and span.start < current.start
+                and span.end <= current.start + slack
+            ]
+        candidates = [span for span in candidates if id(span) not in visited]
+        if not candidates:
+            break
+        current = max(candidates, key=lambda span: span.end)
+        visited.add(id(current))
+        path.append(current)
+    return path[::-1]
+
+
+def slowest_per_phase(spans: list[Span]) -> dict[str, tuple[str, float, float]]:
+    """For every phase: (slowest host, its total time, fleet median time)"""
+    totals: dict[str, dict[str, float]] = {}
+    for span in spans:
+        if span.category != PHASE:
+            continue
+        per_host = totals.setdefault(span.name, {})
+        per_host[span.host] = per_host.get(span.host, 0.0) + span.duration
+    result = {}
+    for phase, per_host in totals.items():
+        host = max(per_host, key=per_host.get)
+        result[phase] = (host, per_host[host], statistics.median(per_host.values()))
+    return result
+
+
+def summary(spans: list[Span]) -> str:
+    if not spans:
+        return "No spans recorded"
+    lines = [
+        f"Deploy took {max(s.end for s in spans) - min(s.start for s in spans):.1f}s",
+        "",
+        "Critical path:",
+    ]
+    for span in critical_path(spans):
+        lines.append(f"  {span.duration:8.1f}s  {span.host}  {span.name}")
+    lines += ["", "Slowest host per phase (median across hosts):"]
+    for phase, (host, duration, median) in sorted(
+        slowest_per_phase(spans).items(), key=lambda item: -item[1][1]
+    ):
+        lines.append(f"  {phase:<20} {duration:8.1f}s ({median:6.1f}s)  {host}")
+    return "\n".join(lines)
+
+
+class TracedConnection:
+    """Wraps a connection so that every remote command becomes a span"""
+
+    def __init__(self, conn, server: str, tracer: Tracer):
+        self._conn = conn
+        self._server = server
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _traced(self, method: str, target: str, *args, **kwargs):
+        with self._tracer.span(
+            self._server, method, category=COMMAND, target=target[:200]
+        ):
+            return getattr(self._conn, method)(*args, **kwargs)
+
+    def run(self, command, *args, **kwargs):
+        return self._traced("run", str(command), command, *args, **kwargs)
+
+    def sudo(self, command, *args, **kwargs):
+        return self._traced("sudo", str(command), command, *args, **kwargs)
+
+    def put(self, local, *args, **kwargs):
+        remote = args[0] if args else kwargs.get("remote", "")
+        return self._traced("put", str(remote), local, *args, **kwargs)
+
+    def get(self, remote, *args, **kwargs):
+        return self._traced("get", str(remote), remote, *args, **kwargs)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: python {sys.argv[0]} <spans.json>")
+        sys.exit(1)
+    print(summary(load_spans(sys.argv[1])))
@@ -0,0 +1,105 @@
+"""Warm starts from snapshots of the nodes' commissioning state.
+
+Every cold start clears ~/.matter and launches the nodes with --storage-clear,
+so the root, the VMBs and the device nodes commission the whole hierarchy
+again. Once a tree has finished commissioning (every root and VMB log says so),
+each host's ~/.matter is archived under a snapshot set: the fingerprint of the
+topology and a generation shared by all hosts, recorded here in
+.storage_snapshots.json. A warm start restores the set on every host and
+launches the nodes with --warm-start instead of --storage-clear, and the root
+and the VMBs reconnect to the nodes they know instead of commissioning them.
+Commissioning state only fits the tree it was made for, so a host without the
+set makes the whole tree start cold.
+
+    python warmstart.py          # the recorded snapshot sets
+"""
+
+import hashlib
+import json
+import shlex
+import sys
+import time
+from pathlib import Path, PurePosixPath
+
+STORAGE_DIR = ".matter"
+RECORD_FILE = ".storage_snapshots.json"
+# Logged by the root and by every VMB once all their south nodes are connected
+DONE_MARKER = "commissioned and connected"
+
+
+def fingerprint(topology) -> str:
+    """Hash of everything commissioning depends on: hosts, tree and ports"""
+    spec = {key: value for key, value in topology.spec.items() if key != "spares"}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def snapshot_path(snapshot_dir: str, fingerprint: str, generation: int) -> str:
+    return str(PurePosixPath(snapshot_dir) / f"{fingerprint}-{generation}.tar.gz")
+
+
+def commissioned_command(package_dir: str, logs: list[str]) -> str:
+    """Prints how many of the logs have finished commissioning"""
+    paths = " ".join(shlex.quote(f"{package_dir}/{log}") for log in logs)
+    return f"grep -l {shlex.quote(DONE_MARKER)} {paths} 2>/dev/null | wc -l"
+
+
+def save_command(path: str) -> str:
+    """Archive root's ~/.matter to path, dropping older sets of the topology"""
+    directory = str(PurePosixPath(path).parent)
+    stem = PurePosixPath(path).name.split("-")[0]
+    script = (
+        f"mkdir -p {directory} && tar -czf {path}.tmp -C ~ {STORAGE_DIR}"
+        f" && mv {path}.tmp {path}"
+        f" && for old in {directory}/{stem}-*.tar.gz; do"
+        f' [ "$old" = {path} ] || rm -f "$old"; done'
+    )
+    return f"sh -c {shlex.quote(script)}"
+
+
+def restore_command(path: str) -> str:
+    """Replace root's ~/.matter by a snapshot, fails if there is none"""
+    script = f"test -f {path} && rm -rf ~/{STORAGE_DIR} && tar -xzf {path} -C ~"
+    return f"sh -c {shlex.quote(script)}"
+
+
+def load_record(path: str | Path = RECORD_FILE) -> dict:
+    path = Path(path)
+    if path.exists():
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def recorded_generation(fingerprint: str, path: str | Path = RECORD_FILE) -> int | None:
+    """Generation of the complete snapshot set of a topology, if there is one"""
+    entry = load_record(path).get(fingerprint)
+    return entry["generation"] if entry else None
+
+
+def save_record(
+    fingerprint: str,
+    generation: int,
+    hosts: list[str],
+    path: str | Path = RECORD_FILE,
+):
+    """Record a snapshot set once every host of the topology has saved it"""
+    record = load_record(path)
+    record[fingerprint] = {
+        "generation": generation,
+        "hosts": sorted(hosts),
+        "saved": time.time(),
+    }
+    with open(path, "w") as f:
+        json.dump(record, f, indent=4)
+
+
+if __name__ == "__main__":
+    record = load_record(sys.argv[1] if len(sys.argv) > 1 else RECORD_FILE)
+    if not record:
+        print("No snapshot sets recorded")
+    for fingerprint, entry in record.items():
+        saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["saved"]))
+        print(
+            f"{fingerprint}: generation {entry['generation']}, "
+            f"{len(entry['hosts'])} hosts, saved {saved}"
+        )